@@ -544,6 +544,37 @@
 # The value can be between 50 and 99
 content_server_thumbnail_compression_quality = 75
 
+#: Set the size of the thumbnail cache used by the Content server
+# The Content server stores the cover thumbnails it creates on disk, so that
+# they do not have to be created again for every request. This sets the
+# maximum total size of the stored thumbnails, in megabytes. When it is
+# exceeded, the least recently used thumbnails are removed.
+content_server_thumbnail_cache_size = 200
+
+#: Set the size of the cache of books rendered for the Content server viewer
+# The Content server stores the books it has prepared for reading in the
+# browser on disk, along with the individual files in them, so that they do not
+# have to be prepared again, and so that when a book changes only the changed
+# files have to be processed. This sets the maximum total size of the cache, in
+# megabytes. When it is exceeded, the least recently used books and files are
+# removed.
+content_server_book_cache_size = 1000
+
+#: Set the size of the response cache used by the Content server
+# The Content server keeps the data it sends for the book list and the Tag
+# browser in memory, so that it does not have to be created again for
+# every client, as long as the library has not changed. This sets the maximum
+# amount of memory used, in megabytes. Set it to zero to disable the cache.
+content_server_response_cache_size = 20
+
+#: Set the memory needed to start jobs in the Content server
+# The Content server runs jobs, such as converting books and preparing books for
+# reading in the browser, in separate processes. When less than this amount of
+# memory, in megabytes, is available, waiting jobs are not started until
+# running jobs finish, unless no jobs are running. Set it to zero to start jobs
+# regardless of the available memory.
+content_server_job_min_free_memory = 500
+
 #: Image file types to treat as e-books when dropping onto the "Book details" panel
 # Normally, if you drop any image file in a format known to calibre onto the
 # "Book details" panel, it will be used to set the cover. If you want to store
@@ -575,3 +606,67 @@
 # Sets the width of the tab stop in the template editor in "average characters".
 # For example, a value of 1 results in a space the width of one average character.
 template_editor_tab_stop_width = 4
+
+#: Use compact in-memory tables for very large libraries
+# calibre keeps the metadata for all books in memory. For libraries with
+# hundreds of thousands of books this can use a lot of RAM. Setting this tweak
+# to True causes calibre to store the per-book data in compact, array based
+# structures instead, which uses significantly less memory, at the cost of
+# slightly slower sorting and searching. You must restart calibre for changes
+# to this tweak to take effect.
+compact_in_memory_tables = False
+
+#: Use an in-memory index to speed up searching
+# Normally, searches such as title:foo or tags:=bar check the values of every
+# book in the library. For very large libraries, this can be slow. Setting this
+# tweak to True causes calibre to build an index of the words in the title,
+# authors, tags, series, publisher, comments and text-like custom columns, the
+# first time each of them is searched, and use it to speed up searches that
+# are not regular expression searches. Note that the index, particularly for
+# comments, can use a lot of memory. You must restart calibre for changes to
+# this tweak to take effect.
+use_search_index = False
+
+#: Remember the values of composite columns across restarts
+# The values of columns built from other columns are computed from their
+# templates the first time they are needed, which can be slow for libraries
+# with many books and complex templates. Setting this tweak to True causes
+# calibre to store the computed values, and their sort keys, when the library
+# is closed and use them the next time it is opened, for books that have not
+# been changed. Columns whose values depend on more than the metadata of the
+# book, for example, on the current date or on the connected device, are
+# never stored. You must restart calibre for changes to this tweak to take
+# effect.
+persist_composite_values = False
+
+#: Answer common read requests without waiting for writes
+# Normally, reading from the calibre library, for example searching, has to
+# wait while the library is being changed. When the calibre Content server is
+# handling many requests and some of them change metadata, this can make
+# reads slow. Setting this tweak to True causes calibre to keep a copy of the
+# book data that is updated after every change, which is used to search and to
+# read the values of fields without waiting. Note that this can as much as
+# double the memory used by the book data, and that searches on columns built
+# from other columns still have to wait. You must restart calibre for changes
+# to this tweak to take effect.
+lock_free_reads = False
+
+#: Open large libraries faster by reading book data in the background
+# When a library is opened, calibre normally reads the data for all fields
+# of all books into memory before the library can be used. For libraries with
+# very many books, or many custom columns, this can take a while. Setting this
+# tweak to True causes calibre to read the data for the fields in the
+# background instead, the data for a field is read immediately if it is needed
+# before that. You must restart calibre for changes to this tweak to take
+# effect.
+read_tables_lazily = False
+
+#: Open large libraries faster by saving book data on exit
+# When a library is opened, calibre reads the data for all books from the
+# database, which can take a while for libraries with very many books.
+# Setting this tweak to True causes calibre to save the book data to a file
+# in its cache folder when the library is closed, and use it the next time the
+# library is opened, if the library has not been changed in the meantime,
+# for example, by another program. You must restart calibre for changes to
+# this tweak to take effect.
+store_tables_on_close = False
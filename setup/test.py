@@ -122,6 +122,12 @@ def ok(x):
         a(find_tests())
         from calibre.gui2.viewer.annotations import find_tests
         a(find_tests())
+        from calibre.ebooks.oeb.transforms.parallel import find_tests
+        a(find_tests())
+        from calibre.ebooks.oeb.stylizer import find_tests
+        a(find_tests())
+        from calibre.ebooks.oeb.memory_budget import find_tests
+        a(find_tests())
     if ok('misc'):
         from calibre.ebooks.metadata.test_author_sort import find_tests
         a(find_tests())
@@ -7,8 +7,9 @@
 __docformat__ = 'restructuredtext en'
 
 # Imports {{{
-import os, shutil, uuid, json, glob, time, hashlib, errno, sys
+import os, shutil, uuid, json, glob, time, hashlib, errno, sys, traceback
 from functools import partial
+from threading import Event, Thread
 
 import apsw
 from polyglot.builtins import (iteritems, itervalues,
@@ -393,6 +394,49 @@ def rmtree_with_retry(path, sleep_time=1):
         shutil.rmtree(path)
 
 
+class TableLoader(object):
+
+    '''
+    Reads the tables whose reading was deferred by :meth:`DB.read_tables` in a
+    pool of background threads. Tables that are accessed before they are
+    reached are read immediately by the accessing thread instead.
+    '''
+
+    # Tables needed to show the list of books are read first
+    PRIORITY = ('uuid', 'title', 'sort', 'authors', 'author_sort', 'timestamp', 'pubdate', 'last_modified',
+                'series', 'series_index', 'rating', 'tags', 'path', 'size', 'formats')
+
+    def __init__(self, tables, num_workers=2):
+        order = {name:i for i, name in enumerate(self.PRIORITY)}
+        self.pending = sorted(tables, key=lambda t: (order.get(t.name, len(order)), t.name), reverse=True)
+        self.stop_running = Event()
+        self.workers = [Thread(target=self.run, name='TableLoader') for i in range(num_workers)]
+        for w in self.workers:
+            w.daemon = True
+            w.start()
+
+    def run(self):
+        while not self.stop_running.is_set():
+            try:
+                table = self.pending.pop()
+            except IndexError:
+                break
+            try:
+                table.read_deferred()
+            except Exception:
+                prints('Failed to read table:', table.name)
+                traceback.print_exc()
+
+    def wait(self):
+        ' Wait for all tables to be read '
+        for w in self.workers:
+            w.join()
+
+    def shutdown(self):
+        self.stop_running.set()
+        self.wait()
+
+
 class DB(object):
 
     PATH_LIMIT = 40 if iswindows else 100
@@ -402,8 +446,14 @@ class DB(object):
 
     def __init__(self, library_path, default_prefs=None, read_only=False,
                  restore_all_prefs=False, progress_callback=lambda x, y:True,
-                 load_user_formatter_functions=True):
+                 load_user_formatter_functions=True, compact_tables=None, lazy_tables=None, use_table_store=None):
         self.is_closed = False
+        self.compact_tables = tweaks.get('compact_in_memory_tables', False) if compact_tables is None else compact_tables
+        self.lazy_tables = tweaks.get('read_tables_lazily', False) if lazy_tables is None else lazy_tables
+        self.table_loader = None
+        self.use_table_store = tweaks.get('store_tables_on_close', False) if use_table_store is None else use_table_store
+        self.data_version_at_read = None
+        self.table_store_path = None
         try:
             if isbytestring(library_path):
                 library_path = library_path.decode(filesystem_encoding)
@@ -478,11 +528,33 @@ def __init__(self, library_path, default_prefs=None, read_only=False,
         self.initialize_prefs(default_prefs, restore_all_prefs, progress_callback)
         self.initialize_custom_columns()
         self.initialize_tables()
+        self.fts = None
+        if self.prefs['fts_enabled']:
+            self.initialize_fts()
         self.set_user_template_functions(compile_user_template_functions(
                                  self.prefs.get('user_template_functions', [])))
         if load_user_formatter_functions:
             set_global_state(self)
 
+    def initialize_fts(self):
+        from calibre.db.fts import FTS
+        self.fts = FTS(self.library_path)
+        return self.fts
+
+    def enable_fts(self, enabled=True):
+        ''' Enable or disable the full text index. Returns True iff the index
+        was newly enabled, in which case all existing formats need to be
+        queued for indexing. '''
+        newly_enabled = enabled and not self.prefs['fts_enabled']
+        if enabled:
+            if self.fts is None:
+                self.initialize_fts()
+        elif self.fts is not None:
+            self.fts.close()
+            self.fts = None
+        self.prefs['fts_enabled'] = bool(enabled)
+        return newly_enabled
+
     def get_template_functions(self):
         return self._template_functions
 
@@ -549,6 +621,7 @@ def initialize_prefs(self, default_prefs, restore_all_prefs, progress_callback):
         defs['cover_browser_title_template'] = '{title}'
         defs['cover_browser_subtitle_field'] = 'rating'
         defs['styled_columns'] = {}
+        defs['fts_enabled'] = False
 
         # Migrate the bool tristate tweak
         defs['bools_are_tristate'] = \
@@ -902,6 +975,10 @@ def initialize_tables(self):  # {{{
         self.FIELD_MAP['series_sort'] = base = base+1
         self.field_metadata.set_field_record_index('series_sort', base, prefer_custom=False)
 
+        if self.compact_tables:
+            for table in itervalues(tables):
+                table.compact = True
+
     # }}}
 
     @property
@@ -1141,8 +1218,16 @@ def delete_custom_column(self, label=None, num=None):
         data = self.custom_field_metadata(label, num)
         self.execute('UPDATE custom_columns SET mark_for_delete=1 WHERE id=?', (data['num'],))
 
-    def close(self, force=False, unload_formatter_functions=True):
+    def close(self, force=False, unload_formatter_functions=True, save_tables=True):
+        if getattr(self, 'table_loader', None) is not None:
+            self.table_loader.shutdown()
+            self.table_loader = None
+        if getattr(self, 'fts', None) is not None:
+            self.fts.close()
         if getattr(self, '_conn', None) is not None:
+            store = store_data = None
+            if save_tables and self.use_table_store:
+                store, store_data = self.table_store, self.dump_tables()
             if unload_formatter_functions:
                 try:
                     unload_user_template_functions(self.library_id)
@@ -1151,11 +1236,18 @@ def close(self, force=False, unload_formatter_functions=True):
             self._conn.close(force)
             del self._conn
             self.is_closed = True
+            if store_data is not None:
+                try:
+                    store.save(store_data)
+                except Exception:
+                    traceback.print_exc()
 
     def reopen(self, force=False):
-        self.close(force=force, unload_formatter_functions=False)
+        self.close(force=force, unload_formatter_functions=False, save_tables=False)
         self._conn = None
         self.conn
+        if self.data_version_at_read is not None:
+            self.data_version_at_read = self.data_version
 
     def dump_and_restore(self, callback=None, sql=None):
         import codecs
@@ -1312,11 +1404,57 @@ def last_modified(self):
         ''' Return last modified time as a UTC datetime object '''
         return utcfromtimestamp(os.stat(self.dbpath).st_mtime)
 
+    @property
+    def data_version(self):
+        ''' Changes whenever another connection commits a change to the
+        database, see PRAGMA data_version in the SQLite documentation '''
+        return self.conn.get('PRAGMA data_version', all=False)
+
+    @property
+    def table_store(self):
+        from calibre.db.table_store import TableStore, default_store_path
+        return TableStore(self.table_store_path or default_store_path(self.library_id))
+
+    def dump_tables(self):
+        ''' Return the data of the in-memory tables for the table store or None
+        if they may be out of date '''
+        from calibre.db.table_store import db_state
+        try:
+            # The state of the file is captured first, so that a change made
+            # by another connection after the check below makes the stored
+            # data stale, instead of being recorded as included in it
+            state = db_state(self.dbpath)
+            if self.data_version_at_read is None or self.data_version != self.data_version_at_read:
+                # The database was changed by another connection, which is
+                # not reflected in the in-memory tables
+                return None
+            return self.table_store.dump(self.tables, state)
+        except Exception:
+            traceback.print_exc()
+
     def read_tables(self):
         '''
-        Read all data from the db into the python in-memory tables
+        Read all data from the db into the python in-memory tables. If
+        use_table_store is True and the data stored by :meth:`close` is up to
+        date, it is used instead. If lazy_tables is True, reading each table
+        is deferred until its data is first accessed, while the tables are
+        read in the background, most commonly used first.
         '''
 
+        self.data_version_at_read = self.data_version
+        if self.use_table_store:
+            try:
+                if self.table_store.load(self.tables, self.dbpath):
+                    return
+            except Exception:
+                traceback.print_exc()
+        if self.lazy_tables:
+            if self.table_loader is not None:
+                self.table_loader.shutdown()
+            for table in itervalues(self.tables):
+                table.defer_read(self)
+            self.table_loader = TableLoader(tuple(itervalues(self.tables)))
+            return
         with self.conn:  # Use a single transaction, to ensure nothing modifies the db while we are reading
             for table in itervalues(self.tables):
                 try:
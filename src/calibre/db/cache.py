@@ -6,6 +6,7 @@
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import json
 import operator
 import os
 import random
@@ -25,7 +26,8 @@
 )
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
 from calibre.db.annotations import merge_annotations
-from calibre.db.categories import get_categories
+from calibre.db.categories import CategoryData, get_categories
+from calibre.db.dependencies import expand_changed_fields
 from calibre.db.errors import NoSuchBook, NoSuchFormat
 from calibre.db.fields import IDENTITY, InvalidLinkTable, create_field
 from calibre.db.lazy import FormatMetadata, FormatsList, ProxyMetadata
@@ -33,6 +35,7 @@
     DowngradeLockError, LockingError, SafeReadLock, create_locks, try_lock
 )
 from calibre.db.search import Search
+from calibre.db.snapshot import Snapshot, SnapshotUnavailable
 from calibre.db.tables import VirtualTable
 from calibre.db.utils import type_safe_sort_key_function
 from calibre.db.write import get_series_values, uniq
@@ -46,7 +49,7 @@
 from calibre.utils.icu import sort_key
 from calibre.utils.localization import canonicalize_lang
 from polyglot.builtins import (
-    cmp, iteritems, itervalues, string_or_bytes, unicode_type, zip
+    iteritems, itervalues, string_or_bytes, unicode_type, zip
 )
 
 
@@ -81,6 +84,25 @@ def call_func_with_lock(*args, **kwargs):
     return call_func_with_lock
 
 
+def wrap_snapshot(lock, func, dbcache):
+    ''' Answer the read from the current snapshot of dbcache, without locking,
+    falling back to the locked read if the snapshot cannot be used. '''
+    locked = wrap_simple(lock, func)
+    name = func.__name__
+
+    @wraps(func)
+    def call_func_with_snapshot(*args, **kwargs):
+        snapshot = dbcache.snapshot
+        # A thread holding the write lock must see its own changes
+        if snapshot is not None and not dbcache.write_lock.owns_exclusive_lock():
+            try:
+                return getattr(snapshot, name)(*args, **kwargs)
+            except SnapshotUnavailable:
+                pass
+        return locked(*args, **kwargs)
+    return call_func_with_snapshot
+
+
 def run_import_plugins(path_or_stream, fmt):
     fmt = fmt.lower()
     if hasattr(path_or_stream, 'seek'):
@@ -136,6 +158,11 @@ class Cache(object):
     was necessary for maximum performance and flexibility.
     '''
 
+    # The read API methods that can be answered from a snapshot, without
+    # locking, see calibre.db.snapshot
+    SNAPSHOT_READ_API = frozenset((
+        'all_book_ids', 'field_for', 'field_ids_for', 'books_for_field', 'get_id_map', 'search'))
+
     def __init__(self, backend):
         self.backend = backend
         self.fields = {}
@@ -143,12 +170,22 @@ def __init__(self, backend):
         self.read_lock, self.write_lock = create_locks()
         self.format_metadata_cache = defaultdict(dict)
         self.formatter_template_cache = {}
+        self.composite_dependencies = None
         self.dirtied_cache = {}
         self.vls_for_books_cache = None
         self.vls_cache_lock = Lock()
         self.dirtied_sequence = 0
         self.cover_caches = set()
         self.clear_search_cache_count = 0
+        # Incremented whenever the write lock is released, so it changes
+        # whenever the data held in memory may have changed
+        self.write_count = 0
+        self.category_data = CategoryData()
+        self.fts_indexer = None
+        self.use_snapshots = tweaks['lock_free_reads']
+        # The most recently published snapshot and the fields changed since
+        # it was published, None meaning all fields
+        self.snapshot = self.snapshot_stale_fields = None
 
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
@@ -162,7 +199,11 @@ def __init__(self, backend):
                 setattr(self, '_'+name, func)
                 # Wrap it in a lock
                 lock = self.read_lock if ira else self.write_lock
-                setattr(self, name, wrap_simple(lock, func))
+                if ira and self.use_snapshots and name in self.SNAPSHOT_READ_API:
+                    setattr(self, name, wrap_snapshot(lock, func, self))
+                else:
+                    setattr(self, name, wrap_simple(lock, func))
+        self.write_lock.before_release = self._before_write_lock_release
 
         self._search_api = Search(self, 'saved_searches', self.field_metadata.get_search_terms())
         self.initialize_dynamic()
@@ -240,21 +281,121 @@ def initialize_dynamic(self):
     @write_api
     def initialize_template_cache(self):
         self.formatter_template_cache = {}
+        self.composite_dependencies = None
 
     @write_api
     def set_user_template_functions(self, user_template_functions):
         self.backend.set_user_template_functions(user_template_functions)
+        self.composite_dependencies = None
 
     @write_api
-    def clear_composite_caches(self, book_ids=None):
-        for field in itervalues(self.composites):
+    def clear_composite_caches(self, book_ids=None, changed_fields=None):
+        ''' Clear the rendered values of composite columns for the specified
+        books. If changed_fields is specified, only the composite columns
+        that depend on those fields are cleared. '''
+        if changed_fields is None:
+            composites = itervalues(self.composites)
+        else:
+            composites = (self.composites[name] for name in self._get_composite_dependencies().composites_to_clear(changed_fields))
+        for field in composites:
             field.clear_caches(book_ids=book_ids)
 
+    def _get_composite_dependencies(self):
+        if self.composite_dependencies is None:
+            from calibre.db.dependencies import CompositeDependencies
+            from calibre.ebooks.metadata.book.formatter import SafeFormat
+            self.composite_dependencies = CompositeDependencies(
+                self.fields, self.field_metadata, self.composites, SafeFormat(), self.backend.get_template_functions())
+        return self.composite_dependencies
+
+    @read_api
+    def composite_dependency_graph(self):
+        '''
+        Return a description of the dependencies of composite columns on other
+        fields, for debugging. It is a dict with keys: ``dependencies``, a map
+        of composite column to the fields its template reads (None if they
+        cannot be determined), ``dependents``, a map of field to the composite
+        columns that must be re-rendered when it changes, ``always_cleared``,
+        the composite columns that are re-rendered on every change, and
+        ``cycles``, lists of composite columns that depend on each other.
+        '''
+        return self._get_composite_dependencies().as_dict()
+
+    def _composite_store(self, path=None):
+        from calibre.db.composite_store import CompositeStore, default_store_path
+        from calibre.utils.localization import get_lang
+        ufuncs = self.backend.get_user_template_functions()
+        custom_columns = {k:(m['datatype'], m['is_multiple'], m['display']) for k, m in iteritems(self.field_metadata.custom_field_metadata())}
+        salt = repr((
+            get_lang(), self.backend.prefs['bools_are_tristate'], sorted(iteritems(tweaks)),
+            sorted((name, getattr(f, 'program_text', '')) for name, f in iteritems(ufuncs)),
+            sorted((k, json.dumps(v, sort_keys=True, default=repr)) for k, v in iteritems(custom_columns))))
+        return CompositeStore(path or default_store_path(self.library_id), salt)
+
+    def _persistable_composites(self):
+        return {name:self.composites[name] for name in self._get_composite_dependencies().persistable()}
+
+    def _last_modified_for(self, book_id):
+        return self.fields['last_modified'].table.book_col_map.get(book_id)
+
     @write_api
-    def clear_search_caches(self, book_ids=None):
+    def load_composite_values(self, path=None):
+        '''
+        Use the values of composite columns stored by
+        :meth:`save_composite_values`, for the books that have not changed
+        since they were stored. Returns the number of values loaded. If path
+        is None, the store for this library in the calibre cache directory is
+        used.
+        '''
+        return self._composite_store(path).load(self._persistable_composites(), self._last_modified_for)
+
+    @write_api
+    def save_composite_values(self, path=None):
+        '''
+        Store the values of composite columns that have been computed, and
+        their sort keys, so they can be used again by
+        :meth:`load_composite_values`. Columns whose values depend on more than
+        the metadata of their book are not stored.
+        '''
+        self._composite_store(path).save(self._persistable_composites(), self._last_modified_for)
+
+    def _mark_snapshot_stale(self, field_names=None):
+        if self.use_snapshots and self.snapshot_stale_fields is not None:
+            if field_names is None:
+                self.snapshot_stale_fields = None
+            else:
+                self.snapshot_stale_fields.update(field_names)
+
+    def _before_write_lock_release(self):
+        self.write_count += 1
+        if self.use_snapshots:
+            self._publish_snapshot()
+
+    def _publish_snapshot(self):
+        ''' Called just before the write lock is released, copies the tables
+        changed since the last snapshot into a new snapshot '''
+        stale = self.snapshot_stale_fields
+        if self.fields and (self.snapshot is None or stale is None or stale):
+            try:
+                self.snapshot = Snapshot.create(self, self.snapshot, stale)
+            except Exception:
+                # Readers fall back to locking until the next write
+                traceback.print_exc()
+                self.snapshot = self.snapshot_stale_fields = None
+            else:
+                self.snapshot_stale_fields = set()
+
+    @write_api
+    def clear_search_caches(self, book_ids=None, changed_fields=None):
+        if changed_fields is not None:
+            changed_fields = expand_changed_fields(self.fields, changed_fields)
+        self._mark_snapshot_stale(changed_fields)
+        self.category_data.invalidate(book_ids, changed_fields)
         self.clear_search_cache_count += 1
         self._search_api.update_or_clear(self, book_ids)
         self.vls_for_books_cache = None
+        for field in itervalues(self.fields):
+            field.clear_sort_key_cache(book_ids)
 
     @read_api
     def last_modified(self):
@@ -267,6 +408,7 @@ def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
         for field in itervalues(self.fields):
             if hasattr(field, 'clear_caches'):
                 field.clear_caches(book_ids=book_ids)  # Clear the composite cache and ondevice caches
+        self.category_data.invalidate(book_ids)
         if book_ids:
             for book_id in book_ids:
                 self.format_metadata_cache.pop(book_id, None)
@@ -279,11 +421,12 @@ def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
     def reload_from_db(self, clear_caches=True):
         if clear_caches:
             self._clear_caches()
+        self._mark_snapshot_stale()
         with self.backend.conn:  # Prevent other processes, such as calibredb from interrupting the reload by locking the db
             self.backend.prefs.load_from_db()
             self._search_api.saved_searches.load_from_db()
             for field in itervalues(self.fields):
-                if hasattr(field, 'table'):
+                if hasattr(field, 'table') and not field.table.read_deferred():
                     field.table.read(self.backend)  # Reread data from metadata.db
 
     @property
@@ -414,6 +557,11 @@ def init(self):
                     field.author_sort_field = self.fields['author_sort']
                 elif name == 'title':
                     field.title_sort_field = self.fields['sort']
+            if self.composites and tweaks['persist_composite_values']:
+                try:
+                    self._load_composite_values()
+                except Exception:
+                    traceback.print_exc()
         if self.backend.prefs['update_all_last_mod_dates_on_start']:
             self.update_last_modified(self.all_book_ids())
             self.backend.prefs.set('update_all_last_mod_dates_on_start', False)
@@ -633,6 +781,7 @@ def format_metadata(self, book_id, fmt, allow_cache=True, update_db=False):
             with self.write_lock:
                 max_size = self.fields['formats'].table.update_fmt(book_id, fmt, name, ans['size'], self.backend)
                 self.fields['size'].table.update_sizes({book_id: max_size})
+                self._mark_snapshot_stale(('formats', 'size'))
 
         return ans
 
@@ -688,7 +837,8 @@ def get_metadata(self, book_id,
                 composite_cache_needs_to_be_cleared = True
         if composite_cache_needs_to_be_cleared:
             try:
-                self.clear_composite_caches()
+                # Only composites that use virtual_libraries() need to be cleared
+                self.clear_composite_caches(changed_fields=())
             except LockingError:
                 # We can't clear the composite caches because a read lock is set.
                 # As a consequence the value of a composite column that calls
@@ -1008,9 +1158,16 @@ def multisort(self, fields, ids_to_sort=None, virtual_fields=None):
         '''
         ids_to_sort = self._all_book_ids() if ids_to_sort is None else ids_to_sort
         get_metadata = self._get_proxy_metadata
-        lang_map = self.fields['languages'].book_value_map
+        lang_map = []
         virtual_fields = virtual_fields or {}
 
+        def get_lang_map():
+            # Building the lang map is expensive, and it is only needed if some
+            # series sort keys are not already cached
+            if not lang_map:
+                lang_map.append(self.fields['languages'].book_value_map)
+            return lang_map[0]
+
         fm = {'title':'sort', 'authors':'author_sort'}
 
         def sort_key_func(field):
@@ -1018,78 +1175,44 @@ def sort_key_func(field):
             idx = field + '_index'
             is_series = idx in self.fields
             try:
-                func = self.fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map)
+                func = self.fields[fm.get(field, field)].cached_sort_keys_for_books(get_metadata, get_lang_map)
             except KeyError:
                 if field == 'id':
                     return IDENTITY
                 else:
-                    return virtual_fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map)
+                    return virtual_fields[fm.get(field, field)].sort_keys_for_books(get_metadata, get_lang_map())
             if is_series:
-                idx_func = self.fields[idx].sort_keys_for_books(get_metadata, lang_map)
+                idx_func = self.fields[idx].cached_sort_keys_for_books(get_metadata, get_lang_map)
 
                 def skf(book_id):
                     return (func(book_id), idx_func(book_id))
                 return skf
             return func
 
-        # Sort only once on any given field
-        fields = uniq(fields, operator.itemgetter(0))
-
-        if len(fields) == 1:
-            keyfunc = sort_key_func(fields[0][0])
-            reverse = not fields[0][1]
+        def sort_on_field(book_ids, field, ascending):
+            keyfunc = sort_key_func(field)
+            reverse = not ascending
             try:
-                return sorted(ids_to_sort, key=keyfunc, reverse=reverse)
+                book_ids.sort(key=keyfunc, reverse=reverse)
             except Exception as err:
-                print('Failed to sort database on field:', fields[0][0], 'with error:', err, file=sys.stderr)
+                print('Failed to sort database on field:', field, 'with error:', err, file=sys.stderr)
                 try:
-                    return sorted(ids_to_sort, key=type_safe_sort_key_function(keyfunc), reverse=reverse)
+                    book_ids.sort(key=type_safe_sort_key_function(keyfunc), reverse=reverse)
                 except Exception as err:
-                    print('Failed to type-safe sort database on field:', fields[0][0], 'with error:', err, file=sys.stderr)
-                    return sorted(ids_to_sort, reverse=reverse)
-        sort_key_funcs = tuple(sort_key_func(field) for field, order in fields)
-        orders = tuple(1 if order else -1 for _, order in fields)
-        Lazy = object()  # Lazy load the sort keys for sub-sort fields
-
-        class SortKey(object):
-
-            __slots__ = 'book_id', 'sort_key'
-
-            def __init__(self, book_id):
-                self.book_id = book_id
-                # Calculate only the first sub-sort key since that will always be used
-                self.sort_key = [key(book_id) if i == 0 else Lazy for i, key in enumerate(sort_key_funcs)]
-
-            def compare_to_other(self, other):
-                for i, (order, self_key, other_key) in enumerate(zip(orders, self.sort_key, other.sort_key)):
-                    if self_key is Lazy:
-                        self_key = self.sort_key[i] = sort_key_funcs[i](self.book_id)
-                    if other_key is Lazy:
-                        other_key = other.sort_key[i] = sort_key_funcs[i](other.book_id)
-                    ans = cmp(self_key, other_key)
-                    if ans != 0:
-                        return ans * order
-                return 0
-
-            def __eq__(self, other):
-                return self.compare_to_other(other) == 0
-
-            def __ne__(self, other):
-                return self.compare_to_other(other) != 0
-
-            def __lt__(self, other):
-                return self.compare_to_other(other) < 0
+                    print('Failed to type-safe sort database on field:', field, 'with error:', err, file=sys.stderr)
+                    book_ids.sort(reverse=reverse)
 
-            def __le__(self, other):
-                return self.compare_to_other(other) <= 0
-
-            def __gt__(self, other):
-                return self.compare_to_other(other) > 0
-
-            def __ge__(self, other):
-                return self.compare_to_other(other) >= 0
+        # Sort only once on any given field
+        fields = uniq(fields, operator.itemgetter(0))
 
-        return sorted(ids_to_sort, key=SortKey)
+        # Python's sort is stable, so sorting on the least significant field
+        # first and the most significant field last gives the same result as
+        # sorting on a tuple of all the sort keys, without needing to compare
+        # the keys in python code.
+        ans = list(ids_to_sort)
+        for field, ascending in reversed(fields):
+            sort_on_field(ans, field, ascending)
+        return ans
 
     @read_api
     def search(self, query, restriction='', virtual_fields=None, book_ids=None):
@@ -1106,6 +1229,16 @@ def search(self, query, restriction='', virtual_fields=None, book_ids=None):
         '''
         return self._search_api(self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids)
 
+    @read_api
+    def explain_search(self, query, restriction='', virtual_fields=None):
+        '''
+        Same as :meth:`search` except that it returns a tuple of the set of
+        matched book ids and a description of how the search was performed:
+        the order in which its parts were evaluated, their estimated costs
+        and how long each of them took.
+        '''
+        return self._search_api.explain(self, query, restriction, virtual_fields=virtual_fields)
+
     @read_api
     def books_in_virtual_library(self, vl, search_restriction=None, virtual_fields=None):
         ' Return the set of books in the specified virtual library '
@@ -1140,22 +1273,23 @@ def get_categories(self, sort='name', book_ids=None, already_fixed=None,
                 raise
             with self.write_lock:
                 self.fields[bad_field].table.fix_link_table(self.backend)
+                self.category_data.invalidate()
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, changed_fields=None):
         if book_ids:
             if now is None:
                 now = nowf()
             f = self.fields['last_modified']
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
             if self.composites:
-                self._clear_composite_caches(book_ids)
-            self._clear_search_caches(book_ids)
+                self._clear_composite_caches(book_ids, changed_fields=changed_fields)
+            self._clear_search_caches(book_ids, changed_fields=changed_fields)
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, changed_fields=None):
+        self._update_last_modified(book_ids, changed_fields=changed_fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1229,7 +1363,7 @@ def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_up
         if dirtied and update_path and do_path_update:
             self._update_path(dirtied, mark_as_dirtied=False)
 
-        self._mark_as_dirty(dirtied)
+        self._mark_as_dirty(dirtied, changed_fields=(name,))
 
         return dirtied
 
@@ -1555,6 +1689,8 @@ def add_format(self, book_id, fmt, stream_or_path, replace=True, run_hooks=True,
             max_size = self.fields['formats'].table.update_fmt(book_id, fmt, fname, size, self.backend)
             self.fields['size'].table.update_sizes({book_id: max_size})
             self._update_last_modified((book_id,))
+            if self.backend.fts is not None:
+                self.backend.fts.dirty_formats(((book_id, fmt),))
 
         if run_hooks:
             # Run post import plugins, the write lock is released so the plugin
@@ -1599,6 +1735,8 @@ def remove_formats(self, formats_map, db_only=False):
         size_map = table.remove_formats(formats_map, self.backend)
         self.fields['size'].table.update_sizes(size_map)
         self._update_last_modified(tuple(formats_map))
+        if self.backend.fts is not None:
+            self.backend.fts.remove_formats((book_id, fmt) for book_id, fmts in iteritems(formats_map) for fmt in fmts)
 
     @read_api
     def get_next_series_num_for(self, series, field='series', current_indices=False):
@@ -1717,6 +1855,9 @@ def create_book_entry(self, mi, cover=None, add_duplicates=True, force_id=None,
             elif field == 'uuid':
                 self.fields[field].table.uuid_to_id_map[val] = book_id
             self.fields[field].table.book_col_map[book_id] = val
+        # The tables above were changed directly and the uuid table is used
+        # for the list of all books in snapshots
+        self._mark_snapshot_stale()
 
         return book_id
 
@@ -1772,6 +1913,9 @@ def remove_books(self, book_ids, permanent=False):
                 table.remove_books(book_ids, self.backend)
         self._search_api.discard_books(book_ids)
         self._clear_caches(book_ids=book_ids, template_cache=False, search_cache=False)
+        self._mark_snapshot_stale()
+        if self.backend.fts is not None:
+            self.backend.fts.remove_books(book_ids)
         for cc in self.cover_caches:
             cc.invalidate(book_ids)
 
@@ -1952,12 +2096,13 @@ def set_conversion_options(self, options, fmt='PIPE'):
     def refresh_format_cache(self):
         self.fields['formats'].table.read(self.backend)
         self.format_metadata_cache.clear()
+        self._mark_snapshot_stale(('formats',))
 
     @write_api
     def refresh_ondevice(self):
         self.fields['ondevice'].clear_caches()
         self.clear_search_caches()
-        self.clear_composite_caches()
+        self.clear_composite_caches(changed_fields=('ondevice',))
 
     @read_api
     def books_matching_device_book(self, lpath):
@@ -2062,6 +2207,7 @@ def set_custom_column_metadata(self, num, name=None, label=None, is_editable=Non
                                    display=None, update_last_modified=False):
         changed = self.backend.set_custom_column_metadata(num, name=name, label=label, is_editable=is_editable, display=display)
         if changed:
+            self.composite_dependencies = None
             if update_last_modified:
                 self._update_last_modified(self._all_book_ids())
             else:
@@ -2204,6 +2350,12 @@ def vacuum(self):
     @write_api
     def close(self):
         from calibre.customize.ui import available_library_closed_plugins
+        self._stop_fts_indexer()
+        if self.composites and tweaks['persist_composite_values']:
+            try:
+                self._save_composite_values()
+            except Exception:
+                traceback.print_exc()
         for plugin in available_library_closed_plugins():
             try:
                 plugin.run(self)
@@ -2453,6 +2605,102 @@ def search_annotations(
             ignore_removed
         ))
 
+    # Full text search {{{
+
+    @read_api
+    def is_fts_enabled(self):
+        return self.backend.fts is not None
+
+    @write_api
+    def enable_fts(self, enabled=True, start_indexer=True):
+        ''' Enable or disable the full text index of the book files in this
+        library. When enabling, all existing formats are queued for indexing.
+        If start_indexer is True the background indexer thread is started. '''
+        if self.backend.enable_fts(enabled):
+            fmap = self.fields['formats'].table.book_col_map
+            self.backend.fts.dirty_formats((book_id, fmt) for book_id, fmts in iteritems(fmap) for fmt in fmts)
+        if enabled:
+            if start_indexer:
+                self._start_fts_indexer()
+        else:
+            self._stop_fts_indexer()
+
+    @write_api
+    def start_fts_indexer(self, throttle=None):
+        ''' Start the thread that extracts text from book files and adds it to
+        the full text index. Does nothing if the full text index is not enabled.
+        The throttle is the time in seconds to wait between indexing book files. '''
+        if self.backend.fts is None:
+            return
+        if self.fts_indexer is None or not self.fts_indexer.is_alive():
+            from calibre.db.fts.pool import Indexer
+            self.fts_indexer = Indexer(self) if throttle is None else Indexer(self, throttle=throttle)
+            self.fts_indexer.start()
+        elif throttle is not None:
+            self.fts_indexer.throttle = throttle
+
+    @write_api
+    def stop_fts_indexer(self):
+        if self.fts_indexer is not None:
+            self.fts_indexer.stop()
+            self.fts_indexer = None
+
+    @api
+    def pause_fts_indexer(self, pause=True):
+        indexer = self.fts_indexer
+        if indexer is not None:
+            if pause:
+                indexer.pause()
+            else:
+                indexer.resume()
+
+    @api
+    def fts_indexing_progress(self):
+        ''' Return a 2-tuple (number of book files waiting to be indexed, number of book files indexed) '''
+        fts = self.backend.fts
+        if fts is None:
+            return 0, 0
+        return fts.indexing_progress()
+
+    @api
+    def fts_next_job(self):
+        ''' Used by the indexer thread, does not acquire any locks, as the
+        full text index is stored in its own database. '''
+        fts = self.backend.fts
+        if fts is not None:
+            return fts.get_next_job()
+
+    @api
+    def fts_commit_result(self, book_id, fmt, fmt_size, text, err_msg=''):
+        fts = self.backend.fts
+        if fts is not None:
+            return fts.commit_result(book_id, fmt, fmt_size, text, err_msg)
+        return False
+
+    @read_api
+    def fts_search(
+        self,
+        fts_engine_query,
+        use_stemming=True,
+        highlight_start=None,
+        highlight_end=None,
+        snippet_size=None,
+        restrict_to_book_ids=None,
+        return_text=True,
+    ):
+        ''' Search the full text of the books in this library, returning a
+        tuple of dicts with the keys: id, book_id, format and text, ordered by
+        relevance. If highlight_start and highlight_end are specified, text
+        contains the matching text, highlighted, or if snippet_size is also
+        specified, a snippet of the text around the match. '''
+        fts = self.backend.fts
+        if fts is None:
+            raise ValueError(_('Full text searching is not enabled for this library'))
+        return tuple(fts.search(
+            fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size,
+            restrict_to_book_ids, return_text))
+    # }}}
+
     @write_api
     def delete_annotations(self, annot_ids):
         self.backend.delete_annotations(annot_ids)
@@ -7,7 +7,9 @@
 __docformat__ = 'restructuredtext en'
 
 import copy
+from collections import OrderedDict, defaultdict
 from functools import partial
+from threading import Lock
 from polyglot.builtins import iteritems, unicode_type, map, native_string_type
 
 from calibre.ebooks.metadata import author_to_author_sort
@@ -65,6 +67,90 @@ def from_dict(cls, d):
         return ans
 
 
+class CategoryData(object):
+
+    '''
+    Caches the books and average rating of the items in the many valued
+    fields, used to create the categories. For all books, the data is kept up
+    to date incrementally, only the items associated with books that have
+    changed are re-computed. For subsets of books, such as virtual libraries,
+    the data is cached per subset until the field or the ratings change.
+    '''
+
+    SUBSET_CACHE_SIZE = 25
+
+    def __init__(self):
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        # Map of field name to map of item_id to (number of books, average rating)
+        self.all_books = {}
+        # Map of field name to ids of books changed since all_books was updated
+        self.dirtied = defaultdict(set)
+        # Map of field name to name of the field it takes ratings from
+        self.rating_fields = {}
+        self.subsets = OrderedDict()
+
+    def is_affected(self, name, changed_fields):
+        return changed_fields is None or name in changed_fields or self.rating_fields.get(name) in changed_fields
+
+    def invalidate(self, book_ids=None, changed_fields=None):
+        ''' Must be called whenever books are changed, changed_fields, if not
+        None, is the set of fields that were changed. '''
+        with self.lock:
+            if book_ids is None:
+                self.clear()
+                return
+            for name in self.all_books:
+                if self.is_affected(name, changed_fields):
+                    self.dirtied[name].update(book_ids)
+            for key in tuple(self.subsets):
+                if self.is_affected(key[0], changed_fields):
+                    del self.subsets[key]
+
+    def __call__(self, field, rating_field, book_rating_map, book_ids=None):
+        ''' Return the category item data for field, as returned by
+        :meth:`calibre.db.fields.Field.category_item_data` '''
+        with self.lock:
+            self.rating_fields[field.name] = rating_field
+            if book_ids is None:
+                return self.data_for_all_books(field, book_rating_map)
+            key = field.name, frozenset(book_ids)
+            ans = self.subsets.pop(key, None)
+            if ans is None:
+                ans = field.category_item_data(book_rating_map, book_ids)
+                if len(self.subsets) >= self.SUBSET_CACHE_SIZE:
+                    self.subsets.popitem(last=False)
+            self.subsets[key] = ans
+            return ans
+
+    def data_for_all_books(self, field, book_rating_map):
+        name = field.name
+        cbm = field.table.col_book_map
+        data = self.all_books.get(name)
+        changed = self.dirtied.pop(name, ())
+        if data is None:
+            data = self.all_books[name] = {item_id:(len(item_book_ids), avg) for item_id, (item_book_ids, avg) in iteritems(
+                field.category_item_data(book_rating_map))}
+        elif changed or len(data) != len(cbm):
+            item_ids = set()
+            for book_id in changed:
+                item_ids.update(field.ids_for_book(book_id))
+            # Items that have lost books, to books that have been
+            # deleted or changed, will have a different number of books
+            for item_id, item_book_ids in iteritems(cbm):
+                x = data.get(item_id)
+                if x is None or x[0] != len(item_book_ids):
+                    item_ids.add(item_id)
+            for item_id in tuple(data):
+                if item_id not in cbm or item_id in item_ids:
+                    del data[item_id]
+            for item_id, (item_book_ids, avg) in iteritems(field.category_item_data(book_rating_map, item_ids=item_ids)):
+                data[item_id] = len(item_book_ids), avg
+        return {item_id:(cbm[item_id], avg) for item_id, (count, avg) in iteritems(data)}
+
+
 def find_categories(field_metadata):
     for category, cat in field_metadata.iter_items():
         if (cat['is_category'] and cat['kind'] not in {'user', 'search'}):
@@ -159,15 +245,17 @@ def get_metadata(book_id):
             cats = dbcache.fields['tags'].get_news_category(tag_class, book_ids)
         else:
             cat = fm[category]
-            brm = book_rating_map
+            brm, rating_field = book_rating_map, 'rating'
             dt = cat['datatype']
             if dt == 'rating':
                 if category != 'rating':
-                    brm = dbcache.fields[category].book_value_map
+                    brm, rating_field = dbcache.fields[category].book_value_map, category
                 if sort_on == 'name':
                     sort_on, reverse = 'rating', True
-            cats = dbcache.fields[category].get_categories(
-                tag_class, brm, lang_map, book_ids)
+            field = dbcache.fields[category]
+            item_data = dbcache.category_data(field, rating_field, brm, book_ids) if field.is_many else None
+            cats = field.get_categories(
+                tag_class, brm, lang_map, book_ids, item_data=item_data)
             if (category != 'authors' and dt == 'text' and
                 cat['is_multiple'] and cat['display'].get('is_names', False)):
                 for item in cats:
@@ -180,7 +268,9 @@ def get_metadata(book_id):
     for r in categories['rating']:
         for x in tuple(categories['rating']):
             if r.name == x.name and r.id != x.id:
-                r.id_set |= x.id_set
+                # Do not modify the id_set in place, it is shared with the
+                # cached category data
+                r.id_set = r.id_set | x.id_set
                 r.count = len(r.id_set)
                 categories['rating'].remove(x)
                 break
@@ -6,12 +6,14 @@
 from calibre import prints
 
 readonly = True
-version = 0  # change this if you change signature of implementation()
+version = 1  # change this if you change signature of implementation()
 
 
-def implementation(db, notify_changes, query):
+def implementation(db, notify_changes, query, explain=False):
     from calibre.utils.search_query_parser import ParseException
     try:
+        if explain:
+            return db.explain_search(query)
         return db.search(query)
     except ParseException as err:
         e = ValueError(_('Failed to parse search query: ({0}) with error: {1}').format(query, err))
@@ -41,6 +43,14 @@ def option_parser(get_parser, args):
         type=int,
         help=_('The maximum number of results to return. Default is all results.')
     )
+    parser.add_option(
+        '--explain',
+        default=False,
+        action='store_true',
+        help=_('Print how the search was performed: the order in which the parts of the'
+               ' search expression were evaluated, with their estimated costs and the time'
+               ' each took, before the list of matching book ids.')
+    )
     return parser
 
 
@@ -49,11 +59,14 @@ def main(opts, args, dbctx):
         raise SystemExit(_('Error: You must specify the search expression'))
     q = ' '.join(args)
     try:
-        ids = dbctx.run('search', q)
+        ids = dbctx.run('search', q, opts.explain)
     except Exception as e:
         if getattr(e, 'suppress_traceback', False):
             raise SystemExit(str(e))
         raise
+    if opts.explain:
+        ids, plan = ids
+        prints(plan)
     if not ids:
         raise SystemExit(_('No books matching the search expression:') + ' ' + q)
     ids = sorted(ids)
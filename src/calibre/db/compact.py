@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Compact, array backed replacements for the dicts used to store per-book data in
+the in-memory tables. They implement the full mapping interface, so the Field
+classes and the writers do not need to know which storage is in use. Book ids
+are dense, small integers, so they are used directly as indices into
+lists/arrays, which avoids the overhead of a hash table entry and a separate
+int object per book per field.
+'''
+
+from array import array
+from collections.abc import MutableMapping
+from sys import intern
+
+from polyglot.builtins import unicode_type
+
+null = object()
+
+
+def intern_value(x):
+    return intern(x) if type(x) is unicode_type else x
+
+
+class DenseMap(MutableMapping):
+
+    '''
+    A mapping of book_id to value. If typecode is specified, values are stored
+    in an :class:`array.array` of that type, which is useful for item ids. The
+    value 0 is used to mark missing entries in that case, if a value that
+    cannot be stored in the array is ever set, the storage is transparently
+    switched to a list. Strings are interned, as many fields, such as sort
+    values, have a lot of duplicates.
+    '''
+
+    __slots__ = ('vals', 'count', 'missing')
+
+    def __init__(self, items=(), typecode=None):
+        if typecode is None:
+            self.vals, self.missing = [], null
+        else:
+            self.vals, self.missing = array(typecode), 0
+        self.count = 0
+        if hasattr(items, 'items'):
+            items = items.items()
+        for k, v in items:
+            self[k] = v
+
+    def _degrade(self):
+        missing = self.missing
+        self.vals = [null if x == missing else x for x in self.vals]
+        self.missing = null
+
+    def _is_missing(self, val):
+        missing = self.missing
+        return val is null if missing is null else val == missing
+
+    def __getitem__(self, book_id):
+        try:
+            if book_id < 0:
+                raise KeyError(book_id)
+            ans = self.vals[book_id]
+        except (IndexError, TypeError):
+            raise KeyError(book_id)
+        if self._is_missing(ans):
+            raise KeyError(book_id)
+        return ans
+
+    def get(self, book_id, default=None):
+        try:
+            return self[book_id]
+        except KeyError:
+            return default
+
+    def __contains__(self, book_id):
+        try:
+            self[book_id]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, book_id, val):
+        if book_id < 0:
+            raise KeyError(book_id)
+        if self.missing is not null and (type(val) is not int or val == self.missing):
+            self._degrade()
+        vals = self.vals
+        extra = book_id + 1 - len(vals)
+        if extra > 0:
+            vals.extend((self.missing,) * extra)
+        elif not self._is_missing(vals[book_id]):
+            self.count -= 1
+        if self.missing is null:
+            vals[book_id] = intern_value(val)
+        else:
+            try:
+                vals[book_id] = val
+            except OverflowError:
+                self._degrade()
+                self.vals[book_id] = val
+        self.count += 1
+
+    def __delitem__(self, book_id):
+        self[book_id]  # raise KeyError if not present
+        self.vals[book_id] = self.missing
+        self.count -= 1
+
+    def __iter__(self):
+        missing = self.missing
+        if missing is null:
+            for book_id, val in enumerate(self.vals):
+                if val is not null:
+                    yield book_id
+        else:
+            for book_id, val in enumerate(self.vals):
+                if val != missing:
+                    yield book_id
+
+    def items(self):
+        missing = self.missing
+        if missing is null:
+            return ((book_id, val) for book_id, val in enumerate(self.vals) if val is not null)
+        return ((book_id, val) for book_id, val in enumerate(self.vals) if val != missing)
+
+    def values(self):
+        return (val for book_id, val in self.items())
+
+    def __len__(self):
+        return self.count
+
+    def copy(self):
+        return dict(self.items())
+
+    def __reduce__(self):
+        # The null marker for missing entries cannot be pickled
+        return self.__class__, (tuple(self.items()), None if self.missing is null else self.vals.typecode)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.copy())
+
+
+class LinkMap(MutableMapping):
+
+    '''
+    A mapping of book_id to a tuple of item ids, stored in Compressed Sparse
+    Row form: the item ids for the book book_id are
+    ``ids[offsets[book_id]:offsets[book_id+1]]``. The CSR arrays are
+    immutable, changes are stored in a small overlay dict, that is merged back
+    into the arrays once it becomes large.
+    '''
+
+    __slots__ = ('offsets', 'ids', 'overlay', 'count')
+
+    MAX_OVERLAY_FRACTION = 8
+
+    def __init__(self, items=()):
+        if hasattr(items, 'items'):
+            items = items.items()
+        self._build(items)
+
+    def _build(self, items):
+        offsets, ids = array('l', (0,)), array('i')
+        overlay = {}
+        count = 0
+        for book_id, item_ids in sorted(items):
+            if book_id < 0:
+                raise KeyError(book_id)
+            count += 1
+            if not item_ids:
+                # Empty tuples cannot be represented in the CSR arrays
+                overlay[book_id] = ()
+                continue
+            end = offsets[-1]
+            extra = book_id + 1 - len(offsets)
+            if extra > 0:
+                offsets.extend((end,) * extra)
+            ids.extend(item_ids)
+            offsets.append(len(ids))
+        self.offsets, self.ids, self.overlay, self.count = offsets, ids, overlay, count
+
+    def _base(self, book_id):
+        if type(book_id) is int and 0 <= book_id < len(self.offsets) - 1:
+            start, end = self.offsets[book_id], self.offsets[book_id + 1]
+            if end > start:
+                return tuple(self.ids[start:end])
+        return null
+
+    def __getitem__(self, book_id):
+        try:
+            ans = self.overlay.get(book_id, self)
+        except TypeError:
+            raise KeyError(book_id)
+        if ans is self:
+            ans = self._base(book_id)
+        if ans is null:
+            raise KeyError(book_id)
+        return ans
+
+    def get(self, book_id, default=None):
+        try:
+            return self[book_id]
+        except KeyError:
+            return default
+
+    def __contains__(self, book_id):
+        try:
+            self[book_id]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, book_id, item_ids):
+        if book_id < 0:
+            raise KeyError(book_id)
+        if book_id not in self:
+            self.count += 1
+        self.overlay[book_id] = tuple(item_ids)
+        self._maybe_compact()
+
+    def __delitem__(self, book_id):
+        self[book_id]  # raise KeyError if not present
+        self.overlay[book_id] = null
+        self.count -= 1
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        if len(self.overlay) * self.MAX_OVERLAY_FRACTION > max(1024, self.count):
+            self.compact()
+
+    def compact(self):
+        ' Merge the overlay of changes back into the CSR arrays '
+        self._build(tuple(self.items()))
+
+    def items(self):
+        overlay = self.overlay
+        for book_id in range(len(self.offsets) - 1):
+            if book_id not in overlay:
+                val = self._base(book_id)
+                if val is not null:
+                    yield book_id, val
+        for book_id, val in tuple(overlay.items()):
+            if val is not null:
+                yield book_id, val
+
+    def __iter__(self):
+        return (book_id for book_id, val in self.items())
+
+    def values(self):
+        return (val for book_id, val in self.items())
+
+    def __len__(self):
+        return self.count
+
+    def copy(self):
+        return dict(self.items())
+
+    def __reduce__(self):
+        return self.__class__, (tuple(self.items()),)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.copy())
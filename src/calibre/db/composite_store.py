@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Persists the rendered values of composite columns, and their sort keys,
+across restarts. Every entry records the last modified time of its book and
+every column records a hash of everything its rendering depends on apart from
+the metadata of the book, so entries are only used if they are still
+valid. Entries are checked lazily, when they are first used.
+'''
+
+import hashlib
+import os
+
+from calibre.constants import cache_dir, numeric_version
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.serialize import pickle_dumps, pickle_loads
+from polyglot.builtins import iteritems
+
+VERSION = 1
+
+
+def default_store_path(library_id):
+    return os.path.join(cache_dir(), 'composite-values', library_id + '.pickle')
+
+
+def template_hash(field, salt):
+    m = field.metadata
+    h = hashlib.sha1(salt.encode('utf-8'))
+    h.update(repr((m['display'], m.get('is_multiple'))).encode('utf-8'))
+    return h.hexdigest()
+
+
+class CompositeStore(object):
+
+    def __init__(self, path, salt):
+        self.path = path
+        self.salt = '%r:%s' % (numeric_version, salt)
+
+    def load(self, composites, get_timestamp):
+        ''' Make the stored values available to the specified composite
+        fields. Returns the number of values loaded. '''
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle_loads(f.read())
+        except Exception:
+            # Missing or corrupted
+            return 0
+        if not isinstance(data, dict) or data.get('version') != VERSION:
+            return 0
+        count = 0
+        for name, (thash, values) in iteritems(data['columns']):
+            field = composites.get(name)
+            if field is not None and thash == template_hash(field, self.salt):
+                field.use_persisted_values(values, get_timestamp)
+                count += len(values)
+        return count
+
+    def save(self, composites, get_timestamp):
+        ' Store the values of the specified composite fields '
+        columns = {}
+        for name, field in iteritems(composites):
+            columns[name] = template_hash(field, self.salt), field.values_to_persist(get_timestamp)
+        raw = pickle_dumps({'version': VERSION, 'columns': columns})
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except EnvironmentError:
+            pass
+        tpath = self.path + '.tmp'
+        with open(tpath, 'wb') as f:
+            f.write(raw)
+        atomic_rename(tpath, self.path)
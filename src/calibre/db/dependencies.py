@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Tracks which fields the templates of composite columns read, so that when a
+field is changed, only the rendered values of the composite columns that
+depend on it, directly or via other composite columns, need to be cleared.
+'''
+
+from collections import defaultdict
+
+from calibre.ebooks.metadata.book import TOP_LEVEL_IDENTIFIERS
+from polyglot.builtins import iteritems
+
+# Names that can be used in templates that are not the names of fields
+TEMPLATE_NAME_MAP = {'title_sort': 'sort', 'id': 'id'}
+
+# Fields that are changed as a side effect of changing a field with
+# Cache.set_field()
+SIDE_EFFECTS = {'title': ('sort', 'path'), 'authors': ('author_sort', 'path')}
+
+
+def expand_changed_fields(fields, changed_fields):
+    ''' Return all fields that are changed when the specified fields are
+    changed with Cache.set_field(), including last_modified. '''
+    names = set(changed_fields) | {'last_modified'}
+    for name in changed_fields:
+        names.update(SIDE_EFFECTS.get(name, ()))
+        if name + '_index' in fields:
+            names.add(name + '_index')
+        elif name.endswith('_index') and name[:-len('_index')] in fields:
+            names.add(name[:-len('_index')])
+    return names
+
+
+class CompositeDependencies(object):
+
+    def __init__(self, fields, field_metadata, composites, formatter, template_functions):
+        self.fields = fields
+        self.field_metadata = field_metadata
+        # Map of composite name to the set of fields it reads or None if
+        # unknown, in which case it must be cleared on every change
+        self.dependencies = {}
+        for name, field in iteritems(composites):
+            names = formatter.fields_used(
+                field.metadata['display'].get('composite_template', ''), template_functions=template_functions)
+            self.dependencies[name] = None if names is None else self.field_keys(names)
+        # Map of field to composites that read it
+        self.readers = defaultdict(set)
+        self.always = set()
+        for name, deps in iteritems(self.dependencies):
+            if deps is None:
+                self.always.add(name)
+            else:
+                for dep in deps:
+                    self.readers[dep].add(name)
+        self.cycles = self.find_cycles()
+
+    def field_key(self, name):
+        key = name.strip().lower()
+        if key in self.fields:
+            return key
+        if key in TEMPLATE_NAME_MAP:
+            return TEMPLATE_NAME_MAP[key]
+        if key in TOP_LEVEL_IDENTIFIERS:
+            return 'identifiers'
+        try:
+            key = self.field_metadata.search_term_to_field_key(key)
+        except Exception:
+            return None
+        if key in self.fields:
+            return key
+
+    def field_keys(self, names):
+        ans = set()
+        for name in names:
+            key = self.field_key(name)
+            if key is None:
+                return None
+            ans.add(key)
+        return frozenset(ans)
+
+    def find_cycles(self):
+        ' Return the lists of composites that depend on each other '
+        cycles, state = [], {}
+
+        def visit(name, path):
+            state[name] = 1
+            path.append(name)
+            for dep in sorted(self.dependencies[name] or ()):
+                if dep not in self.dependencies:
+                    continue
+                s = state.get(dep)
+                if s == 1:
+                    cycles.append(path[path.index(dep):])
+                elif s is None:
+                    visit(dep, path)
+            path.pop()
+            state[name] = 2
+
+        for name in sorted(self.dependencies):
+            if name not in state:
+                visit(name, [])
+        return cycles
+
+    def transitive_readers(self, names):
+        ' The composites that read any of the specified fields, directly or via other composites '
+        ans, pending, seen = set(), set(names), set()
+        while pending:
+            name = pending.pop()
+            seen.add(name)
+            for reader in self.readers.get(name, ()):
+                ans.add(reader)
+                if reader not in seen:
+                    pending.add(reader)
+        return ans
+
+    def composites_to_clear(self, changed_fields):
+        ''' Return the composites whose values must be cleared when the
+        specified fields change. '''
+        names = expand_changed_fields(self.fields, changed_fields)
+        return self.transitive_readers(names | self.always) | self.always
+
+    def persistable(self):
+        ''' Return the composites whose values depend only on the metadata of
+        their book, and so can be stored across restarts. The ondevice field
+        depends on the connected device, not the book. '''
+        in_cycle = {name for cycle in self.cycles for name in cycle}
+        ans = {name for name, deps in iteritems(self.dependencies) if deps is not None and 'ondevice' not in deps and name not in in_cycle}
+        changed = True
+        while changed:
+            changed = False
+            for name in tuple(ans):
+                if any(dep in self.dependencies and dep not in ans for dep in self.dependencies[name]):
+                    ans.discard(name)
+                    changed = True
+        return ans
+
+    def as_dict(self):
+        return {
+            'dependencies': {k:(None if v is None else sorted(v)) for k, v in iteritems(self.dependencies)},
+            'dependents': {k:sorted(self.transitive_readers((k,))) for k in self.readers},
+            'always_cleared': sorted(self.always),
+            'cycles': [list(c) for c in self.cycles],
+        }
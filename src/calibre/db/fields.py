@@ -96,11 +96,22 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions):
         self.writer = Writer(self)
         self.series_field = None
         self.get_template_functions = get_template_functions
+        self._sort_key_cache = {}
 
     @property
     def metadata(self):
         return self.table.metadata
 
+    def clear_caches(self, book_ids=None):
+        self.clear_sort_key_cache(book_ids)
+
+    def clear_sort_key_cache(self, book_ids=None):
+        if book_ids is None:
+            self._sort_key_cache.clear()
+        else:
+            for book_id in book_ids:
+                self._sort_key_cache.pop(book_id, None)
+
     def for_book(self, book_id, default_value=None):
         '''
         Return the value of this field for the book identified by book_id.
@@ -141,6 +152,27 @@ def sort_keys_for_books(self, get_metadata, lang_map):
         '''
         raise NotImplementedError()
 
+    def cached_sort_keys_for_books(self, get_metadata, get_lang_map):
+        '''
+        Same as :meth:`sort_keys_for_books` except that the computed sort keys
+        are cached until they are invalidated by :meth:`clear_caches`. Note
+        that get_lang_map must be a callable that returns the lang_map, it is
+        only called if some sort keys actually need to be calculated.
+        '''
+        cache = self._sort_key_cache
+        keyfunc = None
+
+        def key(book_id):
+            nonlocal keyfunc
+            try:
+                return cache[book_id]
+            except KeyError:
+                if keyfunc is None:
+                    keyfunc = self.sort_keys_for_books(get_metadata, get_lang_map())
+                ans = cache[book_id] = keyfunc(book_id)
+                return ans
+        return key
+
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         '''
         Return a generator that yields items of the form (value, set of books
@@ -149,32 +181,59 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         '''
         raise NotImplementedError()
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def category_item_data(self, book_rating_map, book_ids=None, item_ids=None):
+        '''
+        Return a map of item id to (set of book ids, average rating) for all
+        items that are associated with at least one of the books in book_ids
+        (all books if None). If item_ids is specified only those items are
+        considered.
+        '''
+        cbm = self.table.col_book_map
+        if item_ids is not None:
+            items = ((item_id, cbm[item_id]) for item_id in item_ids if item_id in cbm)
+        elif book_ids is not None and len(book_ids) < len(cbm):
+            # Faster to go through the books than through the items
+            item_map = defaultdict(set)
+            for book_id in book_ids:
+                for item_id in self.ids_for_book(book_id):
+                    item_map[item_id].add(book_id)
+            items, book_ids = iteritems(item_map), None
+        else:
+            items = iteritems(cbm)
+        ans = {}
+        for item_id, item_book_ids in items:
+            if book_ids is not None:
+                item_book_ids = item_book_ids.intersection(book_ids)
+            if item_book_ids:
+                ratings = tuple(r for r in (book_rating_map.get(book_id, 0) for
+                                            book_id in item_book_ids) if r > 0)
+                ans[item_id] = item_book_ids, (sum(ratings)/len(ratings) if ratings else 0)
+        return ans
+
+    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None, item_data=None):
+        ''' Return the categories for this field, item_data, if specified,
+        must be the output of :meth:`category_item_data` for book_ids. '''
         ans = []
         if not self.is_many:
             return ans
 
+        if item_data is None:
+            item_data = self.category_item_data(book_rating_map, book_ids)
         id_map = self.table.id_map
         special_sort = hasattr(self, 'category_sort_value')
-        for item_id, item_book_ids in iteritems(self.table.col_book_map):
-            if book_ids is not None:
-                item_book_ids = item_book_ids.intersection(book_ids)
-            if item_book_ids:
-                ratings = tuple(r for r in (book_rating_map.get(book_id, 0) for
-                                            book_id in item_book_ids) if r > 0)
-                avg = sum(ratings)/len(ratings) if ratings else 0
-                try:
-                    name = self.category_formatter(id_map[item_id])
-                except KeyError:
-                    # db has entries in the link table without entries in the
-                    # id table, for example, see
-                    # https://bugs.launchpad.net/bugs/1218783
-                    raise InvalidLinkTable(self.name)
-                sval = (self.category_sort_value(item_id, item_book_ids, lang_map)
-                    if special_sort else name)
-                c = tag_class(name, id=item_id, sort=sval, avg=avg,
-                              id_set=item_book_ids, count=len(item_book_ids))
-                ans.append(c)
+        for item_id, (item_book_ids, avg) in iteritems(item_data):
+            try:
+                name = self.category_formatter(id_map[item_id])
+            except KeyError:
+                # db has entries in the link table without entries in the
+                # id table, for example, see
+                # https://bugs.launchpad.net/bugs/1218783
+                raise InvalidLinkTable(self.name)
+            sval = (self.category_sort_value(item_id, item_book_ids, lang_map)
+                if special_sort else name)
+            c = tag_class(name, id=item_id, sort=sval, avg=avg,
+                          id_set=item_book_ids, count=len(item_book_ids))
+            ans.append(c)
         return ans
 
 
@@ -222,6 +281,9 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions):
         OneToOneField.__init__(self, name, table, bools_are_tristate, get_template_functions)
 
         self._render_cache = {}
+        # Values loaded from the composite store, see use_persisted_values()
+        self._persisted = {}
+        self._get_timestamp = None
         self._lock = Lock()
         m = self.metadata
         self._composite_name = '#' + m['label']
@@ -292,6 +354,8 @@ def _render_composite_with_cache(self, book_id, mi, formatter, template_cache):
          themselves. '''
         with self._lock:
             ans = self._render_cache.get(book_id, None)
+        if ans is None and self._persisted:
+            ans = self._load_persisted(book_id)
         if ans is None:
             return self.__render_composite(book_id, mi, formatter, template_cache)
         return ans
@@ -300,18 +364,69 @@ def clear_caches(self, book_ids=None):
         with self._lock:
             if book_ids is None:
                 self._render_cache.clear()
+                self._persisted.clear()
             else:
                 for book_id in book_ids:
                     self._render_cache.pop(book_id, None)
+                    self._persisted.pop(book_id, None)
+        self.clear_sort_key_cache(book_ids)
 
     def get_value_with_cache(self, book_id, get_metadata):
         with self._lock:
             ans = self._render_cache.get(book_id, None)
+        if ans is None and self._persisted:
+            ans = self._load_persisted(book_id)
         if ans is None:
             mi = get_metadata(book_id)
             return self.__render_composite(book_id, mi, mi.formatter, mi.template_cache)
         return ans
 
+    def use_persisted_values(self, values, get_timestamp):
+        ''' Use the values loaded from the composite store, a map of book_id
+        to (last modified, value[, sort key]). They are used only if the last
+        modified time of the book is unchanged. '''
+        with self._lock:
+            self._persisted = values
+            self._get_timestamp = get_timestamp
+
+    def _load_persisted(self, book_id):
+        with self._lock:
+            entry = self._persisted.pop(book_id, None)
+        if entry is None or entry[0] != self._get_timestamp(book_id):
+            return None
+        ans = entry[1]
+        with self._lock:
+            ans = self._render_cache.setdefault(book_id, ans)
+        if len(entry) > 2:
+            self._sort_key_cache.setdefault(book_id, entry[2])
+        return ans
+
+    def values_to_persist(self, get_timestamp):
+        ''' Return the rendered values for storage in the composite store,
+        including stored values that have not been used yet. '''
+        with self._lock:
+            ans = dict(self._persisted)
+            render_cache = tuple(iteritems(self._render_cache))
+        sort_keys = self._sort_key_cache
+        for book_id, val in render_cache:
+            ts = get_timestamp(book_id)
+            if ts is not None:
+                sk = sort_keys.get(book_id, self)
+                ans[book_id] = (ts, val) if sk is self else (ts, val, sk)
+        return ans
+
+    def cached_sort_keys_for_books(self, get_metadata, get_lang_map):
+        key = OneToOneField.cached_sort_keys_for_books(self, get_metadata, get_lang_map)
+        if not self._persisted:
+            return key
+        cache, load = self._sort_key_cache, self._load_persisted
+
+        def k(book_id):
+            if book_id not in cache:
+                load(book_id)
+            return key(book_id)
+        return k
+
     def sort_keys_for_books(self, get_metadata, lang_map):
         gv = self.get_value_with_cache
         sk = self._sort_key
@@ -433,6 +548,13 @@ def __iter__(self):
     def sort_keys_for_books(self, get_metadata, lang_map):
         return self.for_book
 
+    def cached_sort_keys_for_books(self, get_metadata, get_lang_map):
+        # The on device status is already cached by book_on_device()
+        return self.for_book
+
+    def clear_sort_key_cache(self, book_ids=None):
+        pass
+
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         val_map = defaultdict(set)
         for book_id in candidates:
@@ -598,15 +720,14 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=()):
             if val:
                 yield val, {book_id}
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None, item_data=None):
         ans = []
 
-        for id_key, item_book_ids in iteritems(self.table.col_book_map):
-            if book_ids is not None:
-                item_book_ids = item_book_ids.intersection(book_ids)
-            if item_book_ids:
-                c = tag_class(id_key, id_set=item_book_ids, count=len(item_book_ids))
-                ans.append(c)
+        if item_data is None:
+            item_data = self.category_item_data(book_rating_map, book_ids)
+        for id_key, (item_book_ids, avg) in iteritems(item_data):
+            c = tag_class(id_key, id_set=item_book_ids, count=len(item_book_ids))
+            ans.append(c)
         return ans
 
 
@@ -652,15 +773,14 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         for val, book_ids in iteritems(val_map):
             yield val, book_ids
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None, item_data=None):
         ans = []
 
-        for fmt, item_book_ids in iteritems(self.table.col_book_map):
-            if book_ids is not None:
-                item_book_ids = item_book_ids.intersection(book_ids)
-            if item_book_ids:
-                c = tag_class(fmt, id_set=item_book_ids, count=len(item_book_ids))
-                ans.append(c)
+        if item_data is None:
+            item_data = self.category_item_data(book_rating_map, book_ids)
+        for fmt, (item_book_ids, avg) in iteritems(item_data):
+            c = tag_class(fmt, id_set=item_book_ids, count=len(item_book_ids))
+            ans.append(c)
         return ans
 
 
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+from threading import Lock
+from time import time
+
+import apsw
+
+FTS_DB_NAME = 'full-text-search.db'
+FTS_SCHEMA_VERSION = 1
+
+FTS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS books_text ( id INTEGER PRIMARY KEY,
+    book INTEGER NOT NULL,
+    format TEXT NOT NULL COLLATE NOCASE,
+    format_size INTEGER NOT NULL DEFAULT 0,
+    searchable_text TEXT NOT NULL DEFAULT '',
+    text_size INTEGER NOT NULL DEFAULT 0,
+    err_msg TEXT NOT NULL DEFAULT '',
+    timestamp REAL NOT NULL,
+    UNIQUE(book, format)
+);
+
+CREATE TABLE IF NOT EXISTS dirtied_formats ( id INTEGER PRIMARY KEY,
+    book INTEGER NOT NULL,
+    format TEXT NOT NULL COLLATE NOCASE,
+    in_progress INTEGER NOT NULL DEFAULT 0,
+    UNIQUE(book, format)
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(searchable_text,
+    content = 'books_text', content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2');
+CREATE VIRTUAL TABLE IF NOT EXISTS books_fts_stemmed USING fts5(searchable_text,
+    content = 'books_text', content_rowid = 'id', tokenize = 'porter unicode61 remove_diacritics 2');
+
+DROP TRIGGER IF EXISTS books_fts_insert_trg;
+CREATE TRIGGER books_fts_insert_trg AFTER INSERT ON books_text
+BEGIN
+    INSERT INTO books_fts(rowid, searchable_text) VALUES (NEW.id, NEW.searchable_text);
+    INSERT INTO books_fts_stemmed(rowid, searchable_text) VALUES (NEW.id, NEW.searchable_text);
+END;
+
+DROP TRIGGER IF EXISTS books_fts_delete_trg;
+CREATE TRIGGER books_fts_delete_trg AFTER DELETE ON books_text
+BEGIN
+    INSERT INTO books_fts(books_fts, rowid, searchable_text) VALUES('delete', OLD.id, OLD.searchable_text);
+    INSERT INTO books_fts_stemmed(books_fts_stemmed, rowid, searchable_text) VALUES('delete', OLD.id, OLD.searchable_text);
+END;
+
+DROP TRIGGER IF EXISTS books_fts_update_trg;
+CREATE TRIGGER books_fts_update_trg AFTER UPDATE ON books_text
+BEGIN
+    INSERT INTO books_fts(books_fts, rowid, searchable_text) VALUES('delete', OLD.id, OLD.searchable_text);
+    INSERT INTO books_fts(rowid, searchable_text) VALUES (NEW.id, NEW.searchable_text);
+    INSERT INTO books_fts_stemmed(books_fts_stemmed, rowid, searchable_text) VALUES('delete', OLD.id, OLD.searchable_text);
+    INSERT INTO books_fts_stemmed(rowid, searchable_text) VALUES (NEW.id, NEW.searchable_text);
+END;
+'''
+
+
+class FTS(object):
+
+    '''
+    The full text index of the book files in a library. It is kept in its own
+    SQLite database, next to metadata.db, so that the (potentially very large)
+    extracted text never bloats metadata.db and so that writes to the index
+    never contend with writes to metadata.db.
+
+    Formats that need to be (re-)indexed are recorded in the dirtied_formats
+    table, which makes indexing resumable across restarts. All methods are
+    thread safe.
+    '''
+
+    BUSY_TIMEOUT = 10000  # milliseconds
+
+    def __init__(self, library_path):
+        self.dbpath = os.path.join(library_path, FTS_DB_NAME)
+        self.lock = Lock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = apsw.Connection(self.dbpath)
+            self._conn.setbusytimeout(self.BUSY_TIMEOUT)
+            c = self._conn.cursor()
+            if next(c.execute('pragma user_version'))[0] < FTS_SCHEMA_VERSION:
+                with self._conn:
+                    c.execute(FTS_SCHEMA)
+                    c.execute('pragma user_version=%d' % FTS_SCHEMA_VERSION)
+            # Any jobs that were in progress when we were last closed were
+            # interrupted, so requeue them
+            c.execute('UPDATE dirtied_formats SET in_progress=0 WHERE in_progress=1')
+        return self._conn
+
+    def execute(self, sql, bindings=None):
+        return self.conn.cursor().execute(sql, bindings)
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def dirty_formats(self, book_fmt_pairs):
+        ''' Queue the specified (book_id, fmt) pairs for indexing. Formats that
+        are currently being indexed are re-queued, so that the stale result of
+        the in-progress job is discarded. '''
+        with self.lock:
+            conn = self.conn
+            with conn:
+                conn.cursor().executemany(
+                    'INSERT OR REPLACE INTO dirtied_formats (book,format,in_progress) VALUES (?,?,0)',
+                    tuple((book_id, fmt.upper()) for book_id, fmt in book_fmt_pairs))
+
+    def remove_formats(self, book_fmt_pairs):
+        pairs = tuple((book_id, fmt.upper()) for book_id, fmt in book_fmt_pairs)
+        with self.lock:
+            conn = self.conn
+            with conn:
+                c = conn.cursor()
+                c.executemany('DELETE FROM dirtied_formats WHERE book=? AND format=?', pairs)
+                c.executemany('DELETE FROM books_text WHERE book=? AND format=?', pairs)
+
+    def remove_books(self, book_ids):
+        book_ids = tuple((x,) for x in book_ids)
+        with self.lock:
+            conn = self.conn
+            with conn:
+                c = conn.cursor()
+                c.executemany('DELETE FROM dirtied_formats WHERE book=?', book_ids)
+                c.executemany('DELETE FROM books_text WHERE book=?', book_ids)
+
+    def get_next_job(self):
+        ''' Return the next (book_id, fmt) pair to be indexed, marking it as in
+        progress, or None if there is nothing left to index. '''
+        with self.lock:
+            conn = self.conn
+            with conn:
+                for book_id, fmt in conn.cursor().execute(
+                        'SELECT book, format FROM dirtied_formats WHERE in_progress=0 ORDER BY id LIMIT 1'):
+                    conn.cursor().execute(
+                        'UPDATE dirtied_formats SET in_progress=1 WHERE book=? AND format=?', (book_id, fmt))
+                    return book_id, fmt
+
+    def commit_result(self, book_id, fmt, fmt_size, text, err_msg=''):
+        ''' Store the text extracted for the specified format. Returns False if
+        the result was discarded because the format was changed or removed
+        while it was being indexed. '''
+        text = text or ''
+        with self.lock:
+            conn = self.conn
+            with conn:
+                c = conn.cursor()
+                c.execute('DELETE FROM dirtied_formats WHERE book=? AND format=? AND in_progress=1', (book_id, fmt))
+                if not conn.changes():
+                    return False
+                c.execute('DELETE FROM books_text WHERE book=? AND format=?', (book_id, fmt))
+                c.execute(
+                    'INSERT INTO books_text (book,format,format_size,searchable_text,text_size,err_msg,timestamp) VALUES (?,?,?,?,?,?,?)',
+                    (book_id, fmt, fmt_size or 0, text, len(text), err_msg or '', time()))
+        return True
+
+    def indexing_progress(self):
+        ''' Return a 2-tuple (number of formats waiting to be indexed, number of formats indexed) '''
+        with self.lock:
+            left = self.conn.cursor().execute('SELECT COUNT(id) FROM dirtied_formats').fetchone()[0]
+            done = self.conn.cursor().execute('SELECT COUNT(id) FROM books_text').fetchone()[0]
+        return left, done
+
+    def search(self,
+        fts_engine_query, use_stemming=True, highlight_start=None, highlight_end=None, snippet_size=None,
+        restrict_to_book_ids=None, return_text=True
+    ):
+        fts_table = 'books_fts_stemmed' if use_stemming else 'books_fts'
+        text = "''"
+        params = []
+        if return_text:
+            text = 'books_text.searchable_text'
+            if highlight_start is not None and highlight_end is not None:
+                params = [highlight_start, highlight_end]
+                if snippet_size is not None:
+                    text = 'snippet({fts_table}, 0, ?, ?, "…", {snippet_size})'.format(
+                            fts_table=fts_table, snippet_size=max(1, min(int(snippet_size), 64)))
+                else:
+                    text = 'highlight({}, 0, ?, ?)'.format(fts_table)
+        query = 'SELECT books_text.id, books_text.book, books_text.format, {0} FROM books_text '.format(text)
+        query += ' JOIN {fts_table} ON books_text.id = {fts_table}.rowid'.format(fts_table=fts_table)
+        query += ' WHERE {fts_table} MATCH ?'.format(fts_table=fts_table)
+        query += ' ORDER BY {}.rank '.format(fts_table)
+        with self.lock:
+            try:
+                results = tuple(self.execute(query, tuple(params) + (fts_engine_query,)))
+            except apsw.SQLError as e:
+                from calibre.db.backend import FTSQueryError
+                raise FTSQueryError(fts_engine_query, query, e)
+        for (rowid, book_id, fmt, text) in results:
+            if restrict_to_book_ids is not None and book_id not in restrict_to_book_ids:
+                continue
+            yield {
+                'id': rowid,
+                'book_id': book_id,
+                'format': fmt,
+                'text': text,
+            }
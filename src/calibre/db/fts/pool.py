@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import shutil
+import traceback
+import weakref
+from threading import Event, Thread
+
+from calibre import as_unicode, prints
+from calibre.ptempfile import TemporaryDirectory
+
+
+class Abort(Exception):
+    pass
+
+
+class Indexer(Thread):
+
+    '''
+    Continuously extract the text from dirtied book files and add it to the
+    full text index. This class runs in its own thread, the actual text
+    extraction happens in a worker process so that it does not compete with the
+    GUI/server for the GIL.
+
+    The metadata write lock is never taken by this thread and the read lock is
+    only held for as long as it takes to lookup the path to a book file, so
+    indexing never blocks writers for any significant amount of time. The
+    ``throttle`` is the time in seconds to wait between indexing consecutive
+    files.
+    '''
+
+    def __init__(self, db, throttle=1, idle_interval=5, timeout=600):
+        Thread.__init__(self, name='FTSIndexer')
+        self.daemon = True
+        self._db = weakref.ref(getattr(db, 'new_api', db))
+        self.stop_running = Event()
+        self.keep_going = Event()
+        self.keep_going.set()
+        self.throttle = throttle
+        self.idle_interval = idle_interval
+        self.timeout = timeout
+
+    @property
+    def db(self):
+        ans = self._db()
+        if ans is None or ans.is_closed:
+            raise Abort()
+        return ans
+
+    def stop(self):
+        self.stop_running.set()
+        self.keep_going.set()
+
+    def pause(self):
+        self.keep_going.clear()
+
+    def resume(self):
+        self.keep_going.set()
+
+    @property
+    def is_paused(self):
+        return not self.keep_going.is_set()
+
+    def wait(self, interval):
+        if self.stop_running.wait(interval):
+            raise Abort()
+        self.keep_going.wait()
+        if self.stop_running.is_set():
+            raise Abort()
+
+    def run(self):
+        while not self.stop_running.is_set():
+            try:
+                self.wait(self.throttle)
+                if not self.do_one():
+                    self.wait(self.idle_interval)
+            except Abort:
+                break
+            except Exception:
+                if self.stop_running.is_set():
+                    break
+                traceback.print_exc()
+                try:
+                    self.wait(self.idle_interval)
+                except Abort:
+                    break
+
+    def do_one(self):
+        ''' Index a single book file. Returns False if there was nothing to do. '''
+        job = self.db.fts_next_job()
+        if job is None:
+            return False
+        book_id, fmt = job
+        with TemporaryDirectory('_fts_index') as tdir:
+            path = os.path.join(tdir, 'book.' + fmt.lower())
+            try:
+                src = self.db.format_abspath(book_id, fmt)
+                if not src:
+                    raise EnvironmentError('No %s file found for book: %s' % (fmt, book_id))
+                shutil.copyfile(src, path)
+            except EnvironmentError as err:
+                self.db.fts_commit_result(book_id, fmt, 0, '', 'Failed to read book file with error: %s' % err)
+                return True
+            fmt_size = os.path.getsize(path)
+            self.wait(0)
+            text, err_msg = self.extract_text(path)
+        self.db.fts_commit_result(book_id, fmt, fmt_size, text, err_msg)
+        return True
+
+    def extract_text(self, path):
+        from calibre.utils.ipc.simple_worker import WorkerError, fork_job
+        try:
+            res = fork_job('calibre.db.fts.text', 'extract_text', args=(path,),
+                    timeout=self.timeout, priority='low', no_output=True, abort=self.stop_running)
+        except WorkerError as err:
+            prints('Failed to extract text from:', path, 'with error:', err.orig_tb or err)
+            return '', (err.orig_tb or as_unicode(err))
+        if self.stop_running.is_set():
+            raise Abort()
+        return res['result'] or '', ''
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import re
+
+from calibre.ptempfile import TemporaryDirectory
+from calibre.utils.logging import DevNull
+from polyglot.builtins import string_or_bytes
+
+# Tags whose text is never part of the readable text of a book
+SKIPPED_TAGS = frozenset(('script', 'style', 'title', 'head'))
+ws_pat = re.compile(r'\s+')
+
+
+def barename(tag):
+    return tag.rpartition('}')[-1]
+
+
+def html_to_text(root):
+    ' Extract the readable text from a parsed (X)HTML document '
+    pat = ws_pat
+
+    def process(elem):
+        if not isinstance(elem.tag, string_or_bytes) or barename(elem.tag).lower() in SKIPPED_TAGS:
+            return
+        if elem.text:
+            yield pat.sub(' ', elem.text)
+        for child in elem:
+            for x in process(child):
+                yield x
+            if child.tail:
+                yield pat.sub(' ', child.tail)
+
+    return ''.join(process(root)).strip()
+
+
+def extract_text(pathtoebook):
+    ''' Return the text of the e-book at the specified path. Meant to be run in
+    a worker process via fork_job, as the input plugins can use a lot of CPU and
+    memory. '''
+    from calibre.ebooks.conversion.plumber import Plumber
+    from calibre.ebooks.oeb.polish.container import Container
+    log = DevNull()
+    with TemporaryDirectory('_fts_text') as tdir:
+        tdir = os.path.abspath(os.path.realpath(tdir))
+        plumber = Plumber(pathtoebook, tdir, log)
+        plumber.setup_options()
+        if hasattr(plumber.opts, 'no_process'):
+            plumber.opts.no_process = True
+        plumber.input_plugin.for_viewer = True
+        with plumber.input_plugin, open(plumber.input, 'rb') as inf:
+            pathtoopf = plumber.input_plugin(inf, plumber.opts, plumber.input_fmt, log, {}, tdir)
+        if hasattr(pathtoopf, 'manifest'):
+            from calibre.ebooks.oeb.iterator.book import write_oebbook
+            pathtoopf = write_oebbook(pathtoopf, tdir)
+        container = Container(tdir, pathtoopf, log)
+        ans = []
+        for name, is_linear in container.spine_names:
+            try:
+                root = container.parsed(name)
+            except Exception:
+                continue
+            if hasattr(root, 'xpath'):
+                text = html_to_text(root)
+                if text:
+                    ans.append(text)
+        return '\n\n'.join(ans)
@@ -41,11 +41,12 @@ def cleanup_tags(tags):
 def create_backend(
         library_path, default_prefs=None, read_only=False,
         progress_callback=lambda x, y:True, restore_all_prefs=False,
-        load_user_formatter_functions=True):
+        load_user_formatter_functions=True, compact_tables=None, lazy_tables=None, use_table_store=None):
     return DB(library_path, default_prefs=default_prefs,
                      read_only=read_only, restore_all_prefs=restore_all_prefs,
                      progress_callback=progress_callback,
-                     load_user_formatter_functions=load_user_formatter_functions)
+                     load_user_formatter_functions=load_user_formatter_functions,
+                     compact_tables=compact_tables, lazy_tables=lazy_tables, use_table_store=use_table_store)
 
 
 def set_global_state(db):
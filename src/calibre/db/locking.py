@@ -227,12 +227,21 @@ class RWLockWrapper(object):
     def __init__(self, shlock, is_shared=True):
         self._shlock = shlock
         self._is_shared = is_shared
+        # If set, called with the lock held, just before an exclusive lock
+        # is fully released
+        self.before_release = None
 
     def acquire(self):
         self._shlock.acquire(shared=self._is_shared)
 
     def release(self, *args):
-        self._shlock.release()
+        if self.before_release is not None and self._shlock.is_exclusive == 1 and self.owns_exclusive_lock():
+            try:
+                self.before_release()
+            finally:
+                self._shlock.release()
+        else:
+            self._shlock.release()
 
     __enter__ = acquire
     __exit__ = release
@@ -240,6 +249,11 @@ def release(self, *args):
     def owns_lock(self):
         return self._shlock.owns_lock()
 
+    def owns_exclusive_lock(self):
+        # Does not need the internal lock, as only the owning thread can
+        # change the owner from or to itself
+        return self._shlock._exclusive_owner is current_thread()
+
 
 class DebugRWLockWrapper(RWLockWrapper):
 
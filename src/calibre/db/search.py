@@ -13,11 +13,12 @@
 
 from calibre.constants import preferred_encoding, DEBUG
 from calibre.db.utils import force_to_bool
-from calibre.utils.config_base import prefs
+from calibre.db.search_index import SearchIndex
+from calibre.utils.config_base import prefs, tweaks
 from calibre.utils.date import parse_date, UNDEFINED_DATE, now, dt_as_local
 from calibre.utils.icu import primary_contains, sort_key
 from calibre.utils.localization import lang_map, canonicalize_lang
-from calibre.utils.search_query_parser import SearchQueryParser, ParseException
+from calibre.utils.search_query_parser import SearchQueryParser, ParseException, format_explain_log
 from polyglot.builtins import iteritems, unicode_type, string_or_bytes
 
 CONTAINS_MATCH = 0
@@ -458,8 +459,18 @@ class Parser(SearchQueryParser):  # {{{
 
     def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
                  bool_search, keypair_search, limit_search_columns, limit_search_columns_to,
-                 locations, virtual_fields, lookup_saved_search, parse_cache):
+                 locations, virtual_fields, lookup_saved_search, parse_cache, search_index=None,
+                 search_cache=None, seen_sub_queries=None):
         self.dbcache, self.all_book_ids = dbcache, all_book_ids
+        self.search_index = search_index
+        # The cache of search results, used to cache the results of expensive
+        # sub-queries as well. Results are only stored if
+        # cache_sub_queries is True, i.e. all_book_ids is the full library.
+        self.search_cache = search_cache
+        # Expensive sub-queries that have been evaluated before, but whose
+        # results are not cached
+        self.seen_sub_queries = seen_sub_queries
+        self.cache_sub_queries = self.is_compound_query = False
         self.all_search_locations = frozenset(locations)
         self.grouped_search_terms = gst
         self.date_search, self.num_search = date_search, num_search
@@ -491,9 +502,132 @@ def iter_searchable_values(self, *args, **kwargs):
         for x in ():
             yield x, set()
 
-    def parse(self, *args, **kwargs):
+    def parse(self, query, *args, **kwargs):
         self.virtual_field_used = False
-        return SearchQueryParser.parse(self, *args, **kwargs)
+        # The results of queries consisting of a single token are already
+        # cached as a whole, so only cache sub-queries of compound queries
+        self.is_compound_query = self.search_cache is not None and self._get_tree(query)[0] != 'token'
+        return SearchQueryParser.parse(self, query, *args, **kwargs)
+
+    # Query planning {{{
+
+    EXPENSIVE_COST = 20
+
+    def estimate_token_cost(self, location, query):
+        if self.search_cache is not None and self.sub_query_key(location, query) in self.search_cache:
+            return 0.01, 0.5
+        location = icu_lower(location.strip())
+        lq = icu_lower(query.strip())
+        if location == 'template':
+            return 100, 0.5
+        if location == 'fts':
+            return 10, 0.1
+        if location in ('vl', 'search'):
+            return 10, 0.5
+        if location.startswith('@') and location[1:] not in self.grouped_search_terms:
+            return 10, 0.3
+        if location == 'marked':
+            return 0.5, 0.1
+        if location in self.virtual_fields:
+            return 20, 0.5
+        if lq in ('true', 'false'):
+            return 1, (0.7 if lq == 'true' else 0.3)
+        selectivity = 0.05 if lq.startswith('=') else 0.2
+        is_regexp = lq.startswith('~')
+        location = self.field_metadata.search_term_to_field_key(location.lstrip('@'))
+        if isinstance(location, list):
+            cost = 4 * len(location)
+        elif location == 'all':
+            cost = 30
+        elif location == 'id':
+            return 0.1, selectivity
+        elif location in self.field_metadata:
+            fm = self.field_metadata[location]
+            dt = fm['datatype']
+            if dt == 'composite':
+                cost = 50
+            elif dt in ('datetime', 'rating', 'int', 'float', 'bool') or fm.get('is_csp', False):
+                return 2, 0.5
+            else:
+                cost = 4
+                if not is_regexp and self.search_index is not None and self.search_index.is_indexable(self.dbcache.fields.get(location)):
+                    cost = 1
+        else:
+            return 1, 0.5
+        if is_regexp:
+            cost *= 10
+        return cost, selectivity
+
+    def sub_query_key(self, location, query):
+        ''' A query that is equivalent to the specified sub-query, suitable for
+        use as a key in the search cache. '''
+        return '%s:"%s"' % (location, query.replace('\\', '\\\\').replace('"', '\\"'))
+
+    def cacheable_sub_query(self, location, query):
+        ''' Return the key for caching the results of the specified sub-query
+        or None if its results should not be cached. '''
+        if not self.is_compound_query or self.estimate_token_cost(location, query)[0] < self.EXPENSIVE_COST:
+            return None
+        loc = icu_lower(location.strip())
+        if loc in ('fts', 'vl', 'search', 'marked') or loc.startswith('@') or loc in self.virtual_fields:
+            return None
+        if loc == 'template':
+            if '#@#:d:' in query:
+                return None
+        else:
+            key = self.field_metadata.search_term_to_field_key(loc)
+            keys = key if isinstance(key, list) else [key]
+            for key in keys:
+                if key in self.virtual_fields:
+                    return None
+                if key in self.field_metadata:
+                    fm = self.field_metadata[key]
+                    if fm['datatype'] == 'datetime' or fm.get('display', {}).get('composite_sort', '') == 'date':
+                        return None
+        key = self.sub_query_key(location, query)
+        try:
+            tree = self.sqp_parse_cache.get(key) if self.sqp_parse_cache is not None else None
+            if tree is None:
+                tree = self.parser.parse(key, self.locations)
+        except Exception:
+            return None
+        if tree != ['token', location, query]:
+            return None
+        return key
+
+    def evaluate_token(self, argument, candidates):
+        location, query = argument[0], argument[1]
+        key = self.cacheable_sub_query(location, query)
+        if key is None:
+            return SearchQueryParser.evaluate_token(self, argument, candidates)
+        if key in self.search_cache:
+            cached = self.search_cache.get(key)
+            if self.current_explain_entry is not None:
+                self.current_explain_entry['cached'] = True
+            return cached.intersection(candidates)
+        # Re-ordering means that expensive sub-queries are usually evaluated
+        # on only a few candidates, the results of which cannot be cached. So
+        # the first time a sub-query is seen it is evaluated only on the
+        # candidates, if it is seen again, it is evaluated on all books and
+        # cached.
+        full = len(candidates) == len(self.all_book_ids)
+        if self.cache_sub_queries and not full and candidates and self.seen_sub_queries is not None and key in self.seen_sub_queries:
+            self.seen_sub_queries.pop(key)
+            full, candidates, restrict_to = True, self.all_book_ids, candidates
+        else:
+            restrict_to = None
+        virtual_field_used, self.virtual_field_used = self.virtual_field_used, False
+        ans = SearchQueryParser.evaluate_token(self, argument, candidates)
+        if self.cache_sub_queries and not self.virtual_field_used:
+            if full:
+                self.search_cache.add(key, set(ans))
+            elif candidates and self.seen_sub_queries is not None:
+                self.seen_sub_queries.add(key, True)
+        self.virtual_field_used |= virtual_field_used
+        if restrict_to is not None:
+            ans = ans.intersection(restrict_to)
+        return ans
+    # }}}
 
     def get_matches(self, location, query, candidates=None,
                     allow_recursion=True):
@@ -518,6 +652,15 @@ def get_matches(self, location, query, candidates=None,
             except RuntimeError:
                 raise ParseException(_('Virtual library search is recursive: {}').format(query))
 
+        if location == 'fts':
+            if not self.dbcache._is_fts_enabled():
+                raise ParseException(_('Full text searching is not enabled for this library'))
+            try:
+                results = self.dbcache._fts_search(query, restrict_to_book_ids=candidates, return_text=False)
+            except ValueError as err:
+                raise ParseException(_('Invalid full text search query: {}').format(err))
+            return {x['book_id'] for x in results}
+
         if (len(location) > 2 and location.startswith('@') and
                     location[1:] in self.grouped_search_terms):
             location = location[1:]
@@ -752,7 +895,13 @@ def fi(default_value=None):
                 continue
 
             if location in text_fields:
-                for val, book_ids in self.field_iter(location, current_candidates):
+                field_iter = None
+                if self.search_index is not None and matchkind != REGEXP_MATCH and not q.startswith('.'):
+                    field_iter = self.search_index.matching_values(
+                        self.dbcache.fields.get(location), q, matchkind == EQUALS_MATCH, current_candidates)
+                if field_iter is None:
+                    field_iter = self.field_iter(location, current_candidates)
+                for val, book_ids in field_iter:
                     if val is not None:
                         if isinstance(val, string_or_bytes):
                             val = (val,)
@@ -863,7 +1012,9 @@ def __init__(self, db, opt_name, all_search_locations=()):
         self.keypair_search = KeyPairSearch()
         self.saved_searches = SavedSearchQueries(db, opt_name)
         self.cache = LRUCache()
+        self.seen_sub_queries = LRUCache(limit=100)
         self.parse_cache = LRUCache(limit=100)
+        self.search_index = SearchIndex() if tweaks['use_search_index'] else None
 
     def get_saved_searches(self):
         return self.saved_searches
@@ -875,6 +1026,8 @@ def change_locations(self, newlocs):
         self.all_search_locations = newlocs
 
     def update_or_clear(self, dbcache, book_ids=None):
+        if self.search_index is not None:
+            self.search_index.books_changed(book_ids)
         if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
             self.update_caches(dbcache, book_ids)
         else:
@@ -911,33 +1064,62 @@ def _update_caches(self, sqp, book_ids):
         for query in remove:
             self.cache.pop(query)
 
-    def create_parser(self, dbcache, virtual_fields=None):
+    def create_parser(self, dbcache, virtual_fields=None, search_cache=None, use_index=True):
         return Parser(
             dbcache, set(), dbcache._pref('grouped_search_terms'),
             self.date_search, self.num_search, self.bool_search,
             self.keypair_search,
             prefs['limit_search_columns'],
             prefs['limit_search_columns_to'], self.all_search_locations,
-            virtual_fields, self.saved_searches.lookup, self.parse_cache)
+            virtual_fields, self.saved_searches.lookup, self.parse_cache,
+            search_index=self.search_index if use_index else None, search_cache=search_cache,
+            seen_sub_queries=None if search_cache is None else self.seen_sub_queries)
 
-    def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None):
+    def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None, search_cache=None, use_index=True):
         '''
         Return the set of ids of all records that match the specified
-        query and restriction
+        query and restriction. dbcache can also be a snapshot of the cache, in
+        which case search_cache must be the cache of results for that
+        snapshot and use_index must be False, as the index is for the live
+        tables.
         '''
         # We construct a new parser instance per search as the parse is not
         # thread safe.
-        sqp = self.create_parser(dbcache, virtual_fields)
+        sqp = self.create_parser(
+            dbcache, virtual_fields, search_cache=self.cache if search_cache is None else search_cache, use_index=use_index)
         try:
             return self._do_search(sqp, query, search_restriction, dbcache, book_ids=book_ids)
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
+    def explain(self, dbcache, query, search_restriction, virtual_fields=None):
+        '''
+        Return the set of ids of all records that match the specified query
+        and restriction and a description of the plan used to find them.
+        '''
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+        sqp = self.create_parser(dbcache, virtual_fields, search_cache=self.cache)
+        sqp.explain_log = []
+        try:
+            all_book_ids = dbcache._all_book_ids(type=set)
+            sqp.all_book_ids = all_book_ids
+            if search_restriction and search_restriction.strip():
+                sqp.all_book_ids = sqp.parse(search_restriction.strip())
+            query = query.strip()
+            result = sqp.parse(query) if query else sqp.all_book_ids
+            return result, format_explain_log(sqp.explain_log)
+        finally:
+            sqp.dbcache = sqp.lookup_saved_search = None
+
     def query_is_cacheable(self, sqp, dbcache, query):
         if query:
             for name, value in sqp.get_queried_fields(query):
                 if name == 'template' and '#@#:d:' in value:
                     return False
+                elif name == 'fts':
+                    # The full text index changes as books are indexed
+                    return False
                 elif name in dbcache.field_metadata.all_field_keys():
                     fm = dbcache.field_metadata[name]
                     if fm['datatype'] == 'datetime':
@@ -957,9 +1139,10 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
 
         query = query.strip()
         use_cache = self.query_is_cacheable(sqp, dbcache, query)
+        cache = sqp.search_cache
 
         if use_cache and book_ids is None and query and not search_restriction:
-            cached = self.cache.get(query)
+            cached = cache.get(query)
             if cached is not None:
                 return cached
 
@@ -967,12 +1150,13 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         if search_restriction and search_restriction.strip():
             sr = search_restriction.strip()
             sqp.all_book_ids = all_book_ids if book_ids is None else book_ids
+            sqp.cache_sub_queries = sqp.all_book_ids is all_book_ids
             if self.query_is_cacheable(sqp, dbcache, sr):
-                cached = self.cache.get(sr)
+                cached = cache.get(sr)
                 if cached is None:
                     restricted_ids = sqp.parse(sr)
                     if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-                        self.cache.add(sr, restricted_ids)
+                        cache.add(sr, restricted_ids)
                 else:
                     restricted_ids = cached
                     if book_ids is not None:
@@ -986,14 +1170,15 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
             return restricted_ids
 
         if use_cache and restricted_ids is all_book_ids:
-            cached = self.cache.get(query)
+            cached = cache.get(query)
             if cached is not None:
                 return cached
 
         sqp.all_book_ids = restricted_ids
+        sqp.cache_sub_queries = restricted_ids is all_book_ids
         result = sqp.parse(query)
 
         if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-            self.cache.add(query, result)
+            cache.add(query, result)
 
         return result
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+An in-memory inverted index mapping the words in the values of text like fields
+to the values containing them. It is used to quickly find the small set of
+values that could possibly match a contains or equals search, those values
+are then matched exactly, as before. So the index must only ever return too
+many values, never too few.
+'''
+
+import unicodedata
+from array import array
+from threading import Lock
+
+import regex
+
+from polyglot.builtins import iteritems, itervalues, unicode_type
+
+INDEXED_FIELDS = frozenset(('title', 'authors', 'tags', 'series', 'publisher', 'comments'))
+INDEXED_CUSTOM_DATATYPES = frozenset(('text', 'comments', 'series', 'enumeration'))
+# Combining marks are removed so that accented characters match their base
+# characters, control and format characters are ignored by the ICU collator,
+# so they are removed as well
+ignored_chars = regex.compile(r'[\p{M}\p{Cc}\p{Cf}]+', flags=regex.UNICODE)
+word_pat = regex.compile(r'\w+', flags=regex.UNICODE)
+# Letters that have no canonical or compatibility decomposition, but that the
+# ICU collator considers equal to their base letters at primary strength. The
+# dotless i is folded as icu_lower() produces it for I in the Turkish locale.
+primary_equivalents = {ord(k): v for k, v in iteritems({
+    '\u0131': 'i', 'ø': 'o', 'ł': 'l', 'đ': 'd', 'ð': 'd', 'ħ': 'h', 'ŧ': 't',
+    'ƀ': 'b', 'ƶ': 'z', 'æ': 'ae', 'œ': 'oe', 'ß': 'ss', 'ĳ': 'ij',
+})}
+# Katakana are equal to the corresponding hiragana at primary strength
+primary_equivalents.update({k: k - 0x60 for k in range(0x30a1, 0x30f7)})
+primary_equivalents.update({0x30fd: 0x309d, 0x30fe: 0x309e})
+# Decimal digits of all scripts are equal at primary strength, the full width
+# digits are already replaced by NFKD
+non_ascii_digit_pat = regex.compile(r'[^\P{Nd}0-9]', flags=regex.UNICODE)
+
+
+def ascii_digit(match):
+    return unicode_type(unicodedata.decimal(match.group()))
+
+
+def fold(text):
+    ''' Case, accent, kana and digit fold text, approximating ICU primary
+    strength comparison. Every character is folded on its own, so the folding
+    of a substring is always a substring of the folding of the full string. '''
+    ans = ignored_chars.sub('', unicodedata.normalize('NFKD', text)).casefold().translate(primary_equivalents)
+    return non_ascii_digit_pat.sub(ascii_digit, ans)
+
+
+def words(text):
+    return set(word_pat.findall(fold(text)))
+
+
+class FieldIndex(object):
+
+    '''
+    The index for a single field. The keys are book ids for one-one fields and
+    item ids for all other fields. Changes are added to the index, but stale
+    entries are never removed, instead, the index is rebuilt when there are
+    too many of them.
+    '''
+
+    __slots__ = ('field', 'vocab', 'unindexed', 'pending', 'num_keys', 'num_updates')
+
+    def __init__(self, field):
+        self.field = field
+        self.vocab = {}
+        self.unindexed = set()
+        self.pending = set()
+        self.num_updates = 0
+        tm = self.table_map
+        self.num_keys = len(tm)
+        self.add(iteritems(tm))
+
+    @property
+    def table_map(self):
+        t = self.field.table
+        return t.id_map if self.field.is_many else t.book_col_map
+
+    def add(self, items):
+        vocab = self.vocab
+        for key, val in items:
+            if val is None:
+                continue
+            if not isinstance(val, unicode_type):
+                self.unindexed.add(key)
+                continue
+            for word in words(val):
+                keys = vocab.get(word)
+                if keys is None:
+                    keys = vocab[word] = array('i')
+                keys.append(key)
+
+    @property
+    def is_stale(self):
+        return self.num_updates > max(1000, self.num_keys // 4)
+
+    def apply_pending_changes(self):
+        book_ids, self.pending = self.pending, set()
+        if self.field.is_many:
+            keys = set()
+            ids_for_book = self.field.ids_for_book
+            for book_id in book_ids:
+                keys.update(ids_for_book(book_id))
+        else:
+            keys = book_ids
+        tm = self.table_map
+        self.num_updates += len(keys)
+        self.add((k, tm[k]) for k in keys if k in tm)
+
+    def keys_for_words(self, query_words, exact):
+        vocab = self.vocab
+        ans = None
+        for qw in sorted(query_words, key=len, reverse=True):
+            if exact:
+                keys = set(vocab.get(qw, ()))
+            else:
+                keys = set()
+                for word, wkeys in iteritems(vocab):
+                    if qw in word:
+                        keys.update(wkeys)
+            ans = keys if ans is None else (ans & keys)
+            if not ans:
+                break
+        ans |= self.unindexed
+        return ans
+
+
+class SearchIndex(object):
+
+    # Searching over a small number of candidates is faster without the index
+    MIN_CANDIDATES = 500
+
+    def __init__(self):
+        self.lock = Lock()
+        self.indices = {}
+
+    @staticmethod
+    def is_indexable(field):
+        if field is None or field.is_composite or not hasattr(field, 'table'):
+            return False
+        if field.name in INDEXED_FIELDS:
+            return True
+        return field.metadata.get('is_custom', False) and field.metadata['datatype'] in INDEXED_CUSTOM_DATATYPES
+
+    def books_changed(self, book_ids=None):
+        ' Must be called whenever any field of the specified books changes, with None meaning all books. '
+        with self.lock:
+            if book_ids is None:
+                self.indices.clear()
+            else:
+                for idx in itervalues(self.indices):
+                    idx.pending.update(book_ids)
+
+    def index_for(self, field):
+        idx = self.indices.get(field.name)
+        if idx is not None:
+            if idx.pending:
+                idx.apply_pending_changes()
+            if idx.is_stale:
+                idx = None
+        if idx is None:
+            idx = self.indices[field.name] = FieldIndex(field)
+        return idx
+
+    def matching_values(self, field, query, exact, candidates):
+        '''
+        Return a list of (value, book_ids) pairs for the values of the
+        specified field, restricted to candidates, that could match query.
+        These must still be matched against query. Returns None if the index
+        cannot be used for this search.
+        '''
+        if len(candidates) < self.MIN_CANDIDATES or not self.is_indexable(field):
+            return None
+        query_words = words(query)
+        if not exact:
+            # Very short words are contained in almost all words, so they
+            # do not narrow down the results
+            query_words = {w for w in query_words if len(w) > 1}
+        if not query_words:
+            return None
+        with self.lock:
+            keys = self.index_for(field).keys_for_words(query_words, exact)
+        table = field.table
+        if field.is_many:
+            ans = []
+            id_map, cbm = table.id_map, table.col_book_map
+            for item_id in keys:
+                val = id_map.get(item_id)
+                if val is not None:
+                    book_ids = cbm.get(item_id, set()).intersection(candidates)
+                    if book_ids:
+                        ans.append((val, book_ids))
+            return ans
+        bcm = table.book_col_map
+        return [(bcm.get(book_id), {book_id}) for book_id in keys.intersection(candidates)]
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Immutable, versioned snapshots of the in-memory tables, used to answer some
+read API calls without acquiring the read lock. Writers publish a new snapshot
+when they release the write lock, copying only the tables of the fields that
+were changed, the tables of all other fields are shared with the previous
+snapshot. Readers simply use the most recently published snapshot, so they
+never wait for writers, though they may see the state of the library from
+just before a write in progress.
+'''
+
+import copy
+from collections.abc import Mapping
+
+from calibre.db.search import LRUCache
+from polyglot.builtins import iteritems
+
+# Fields used by the Field objects of other fields
+LINKED_FIELD_ATTRIBUTES = ('series_field', 'index_field', 'author_sort_field', 'title_sort_field')
+
+
+class SnapshotUnavailable(Exception):
+    ''' Raised when a read cannot be answered from a snapshot, for instance
+    because it needs the values of composite columns, the caller must then
+    fall back to the locked read. '''
+    pass
+
+
+class UnavailableField(object):
+
+    ''' Stands in for fields whose values are not stored in a table, such as
+    composite columns and ondevice, as reading them needs the live cache '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        raise SnapshotUnavailable(self.name)
+
+
+def copy_map(m):
+    ans = m.copy()
+    if not isinstance(ans, dict):
+        ans = dict(ans)
+    for k, v in iteritems(ans):
+        # Values such as the sets of book ids in col_book_map are changed in
+        # place by the writers
+        if isinstance(v, (set, dict)):
+            ans[k] = v.copy()
+    return ans
+
+
+def copy_table(table):
+    table.read_deferred()
+    ans = copy.copy(table)
+    for name, val in iteritems(vars(table)):
+        if name != 'metadata' and isinstance(val, Mapping):
+            setattr(ans, name, copy_map(val))
+    return ans
+
+
+class Snapshot(object):
+
+    def __init__(self, version, fields, tables, cache):
+        self.version = version
+        self.tables = tables
+        self.fields = fields
+        self.field_metadata = cache.field_metadata
+        self.search_api = cache._search_api
+        self.prefs = cache.backend.prefs
+        # Search results are cached per snapshot, as they are only valid for
+        # the snapshot they were computed from
+        self.search_cache = LRUCache()
+
+    @classmethod
+    def create(cls, cache, previous=None, stale_fields=None):
+        ''' Create a snapshot of the tables of cache, re-using the tables from
+        previous for all fields not in stale_fields. If stale_fields is None,
+        all tables are copied. '''
+        fields, tables = {}, {}
+        for name, field in iteritems(cache.fields):
+            if field.is_composite or not hasattr(field, 'table') or name == 'ondevice':
+                fields[name] = UnavailableField(name)
+                continue
+            table = None
+            if previous is not None and stale_fields is not None and name not in stale_fields:
+                table = previous.tables.get(name)
+            if table is None:
+                table = copy_table(field.table)
+            tables[name] = table
+            f = fields[name] = copy.copy(field)
+            f.table = table
+            f._sort_key_cache = {}
+        for f in fields.values():
+            for attr in LINKED_FIELD_ATTRIBUTES:
+                linked = getattr(f, attr, None) if f.__class__ is not UnavailableField else None
+                if linked is not None:
+                    setattr(f, attr, fields[linked.name])
+        return cls(0 if previous is None else previous.version + 1, fields, tables, cache)
+
+    # The read API {{{
+
+    def all_book_ids(self, type=frozenset):
+        return type(self.fields['uuid'].table.book_col_map)
+    _all_book_ids = all_book_ids
+
+    def field_for(self, name, book_id, default_value=None):
+        try:
+            field = self.fields[name]
+        except KeyError:
+            return default_value
+        if field.is_multiple:
+            default_value = field.default_value
+        try:
+            return field.for_book(book_id, default_value=default_value)
+        except (KeyError, IndexError):
+            return default_value
+
+    def field_ids_for(self, name, book_id):
+        try:
+            return self.fields[name].ids_for_book(book_id)
+        except (KeyError, IndexError):
+            return ()
+
+    def books_for_field(self, name, item_id):
+        try:
+            return self.fields[name].books_for(item_id)
+        except (KeyError, IndexError):
+            return set()
+
+    def get_id_map(self, field):
+        try:
+            return self.fields[field].table.id_map.copy()
+        except AttributeError:
+            if field == 'title':
+                return self.fields[field].table.book_col_map.copy()
+            raise ValueError('%s is not a many-one or many-many field' % field)
+
+    def search(self, query, restriction='', virtual_fields=None, book_ids=None):
+        return self.search_api(
+            self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids, search_cache=self.search_cache, use_index=False)
+    # }}}
+
+    # Used by the search code {{{
+
+    def _pref(self, name, default=None):
+        return self.prefs.get(name, default)
+
+    def _unavailable(self, *args, **kwargs):
+        raise SnapshotUnavailable()
+    _get_proxy_metadata = get_proxy_metadata = books_in_virtual_library = _is_fts_enabled = _fts_search = _unavailable
+    # }}}
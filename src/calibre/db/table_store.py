@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Stores the data of the in-memory tables when a library is closed, so that the
+next time it is opened, the tables can be loaded in one go, instead of being
+read from metadata.db row by row. The store is only used if metadata.db has
+not changed since the store was written, which is checked using the file
+change counter from the header of metadata.db, that SQLite increments
+for every transaction that changes the database, and the size and
+modification time of the file.
+'''
+
+import os
+import struct
+
+from calibre.constants import cache_dir, numeric_version
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.serialize import pickle_dumps, pickle_loads
+from polyglot.builtins import iteritems
+
+VERSION = 1
+
+
+def default_store_path(library_id):
+    return os.path.join(cache_dir(), 'tables', library_id + '.pickle')
+
+
+def db_state(dbpath):
+    ' Identifies the state of the database file at dbpath '
+    with open(dbpath, 'rb') as f:
+        f.seek(24)
+        counter = struct.unpack(b'>I', f.read(4))[0]
+        st = os.fstat(f.fileno())
+    return counter, st.st_size, st.st_mtime_ns
+
+
+def tables_key(tables):
+    ' Identifies the set of tables and the type of storage they use '
+    return repr((numeric_version, sorted(
+        (name, t.__class__.__name__, t.compact, repr(sorted(iteritems(t.metadata)))) for name, t in iteritems(tables))))
+
+
+class TableStore(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, tables, dbpath):
+        ''' Load the data of the tables from the store, returns False if the
+        store is missing or out of date, in which case no table is changed. '''
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle_loads(f.read())
+        except Exception:
+            # Missing or corrupted
+            return False
+        if not isinstance(data, dict) or data.get('version') != VERSION or data.get('key') != tables_key(tables):
+            return False
+        if data.get('state') != db_state(dbpath) or set(data['tables']) != set(tables):
+            return False
+        for name, table_data in iteritems(data['tables']):
+            tables[name].restore_data(table_data)
+        return True
+
+    def dump(self, tables, state):
+        ''' Return the data of the tables, to be saved with :meth:`save` once
+        the database has been closed. state is the :func:`db_state` of the
+        database, captured before the data of the tables was read from it. '''
+        return {
+            'version': VERSION, 'key': tables_key(tables), 'state': state,
+            'tables': {name:t.dump_data() for name, t in iteritems(tables)}}
+
+    def save(self, data):
+        raw = pickle_dumps(data)
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except EnvironmentError:
+            pass
+        tpath = self.path + '.tmp'
+        with open(tpath, 'wb') as f:
+            f.write(raw)
+        atomic_rename(tpath, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except EnvironmentError:
+            pass
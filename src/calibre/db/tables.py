@@ -9,7 +9,9 @@
 import numbers
 from datetime import datetime, timedelta
 from collections import defaultdict
+from threading import RLock, current_thread
 
+from calibre.db.compact import DenseMap, LinkMap
 from calibre.utils.date import parse_date, UNDEFINED_DATE, utc_tz
 from calibre.ebooks.metadata import author_to_author_sort
 from polyglot.builtins import iteritems, itervalues, range
@@ -45,10 +47,16 @@ def c_parse(val):
 ONE_ONE, MANY_ONE, MANY_MANY = range(3)
 
 null = object()
+# The attributes of tables that are not data read from the db
+NON_DATA_ATTRIBUTES = frozenset(('name', 'metadata', 'sort_alpha', 'unserialize', 'link_table', 'table_type', 'compact', 'deferred_read'))
 
 
 class Table(object):
 
+    # If True, per-book data is stored in the array backed mappings from
+    # calibre.db.compact instead of dicts, trading some speed for memory
+    compact = False
+
     def __init__(self, name, metadata, link_table=None):
         self.name, self.metadata = name, metadata
         self.sort_alpha = metadata.get('is_multiple', False) and metadata.get('display', {}).get('sort_alpha', False)
@@ -65,6 +73,58 @@ def __init__(self, name, metadata, link_table=None):
         self.link_table = (link_table if link_table else
                 'books_%s_link'%self.metadata['table'])
 
+    def make_book_col_map(self, items=(), typecode=None):
+        return DenseMap(items, typecode=typecode) if self.compact else dict(items)
+
+    def dump_data(self):
+        ''' Return the data read from the db by :meth:`read`, for storage in
+        the table store '''
+        self.read_deferred()
+        return {k:v for k, v in iteritems(vars(self)) if k not in NON_DATA_ATTRIBUTES}
+
+    def restore_data(self, data):
+        ''' Use data returned by :meth:`dump_data` instead of reading from
+        the db '''
+        self.__dict__.pop('deferred_read', None)
+        self.__dict__.update(data)
+
+    def defer_read(self, db):
+        ''' Read the data of this table from db only when it is first
+        accessed, or when :meth:`read_deferred` is called, whichever happens
+        first. '''
+        self.deferred_read = db, RLock(), []
+
+    def read_deferred(self):
+        ''' Read the data of this table if reading it was deferred and it has
+        not been read yet. Safe to call from multiple threads, only one of them
+        reads the data, the others wait for it. Returns True if the data was
+        read by this call. '''
+        d = self.__dict__.get('deferred_read')
+        if d is None:
+            return False
+        db, lock, reader = d
+        if reader and reader[0] is current_thread():
+            # Called while reading, the attribute does not exist yet
+            return False
+        with lock:
+            if self.__dict__.get('deferred_read') is not d:
+                return False
+            reader.append(current_thread())
+            try:
+                self.read(db)
+            finally:
+                del reader[:]
+            del self.deferred_read
+        return True
+
+    def __getattr__(self, name):
+        # Only called for attributes that do not exist, such as the data of a
+        # table whose reading was deferred
+        if name.startswith('__') or 'deferred_read' not in self.__dict__:
+            raise AttributeError(name)
+        self.read_deferred()
+        return object.__getattribute__(self, name)
+
     def remove_books(self, book_ids, db):
         return set()
 
@@ -107,16 +167,16 @@ def read(self, db):
             self.metadata['column'], self.metadata['table']))
         if self.unserialize is None:
             try:
-                self.book_col_map = dict(query)
+                self.book_col_map = self.make_book_col_map(query)
             except UnicodeDecodeError:
                 # The db is damaged, try to work around it by ignoring
                 # failures to decode utf-8
                 query = db.execute('SELECT {0}, cast({1} as blob) FROM {2}'.format(idcol,
                     self.metadata['column'], self.metadata['table']))
-                self.book_col_map = {k:bytes(val).decode('utf-8', 'replace') for k, val in query}
+                self.book_col_map = self.make_book_col_map((k, bytes(val).decode('utf-8', 'replace')) for k, val in query)
         else:
             us = self.unserialize
-            self.book_col_map = {book_id:us(val) for book_id, val in query}
+            self.book_col_map = self.make_book_col_map((book_id, us(val)) for book_id, val in query)
 
     def remove_books(self, book_ids, db):
         clean = set()
@@ -141,7 +201,7 @@ def read(self, db):
         query = db.execute(
             'SELECT books.id, (SELECT MAX(uncompressed_size) FROM data '
             'WHERE data.book=books.id) FROM books')
-        self.book_col_map = dict(query)
+        self.book_col_map = self.make_book_col_map(query)
 
     def update_sizes(self, size_map):
         self.book_col_map.update(size_map)
@@ -200,7 +260,7 @@ class ManyToOneTable(Table):
     def read(self, db):
         self.id_map = {}
         self.col_book_map = defaultdict(set)
-        self.book_col_map = {}
+        self.book_col_map = self.make_book_col_map(typecode='i')
         self.read_id_maps(db)
         self.read_maps(db)
 
@@ -379,7 +439,10 @@ def read_maps(self, db):
             cbm[item_id].add(book)
             bcm[book].append(item_id)
 
-        self.book_col_map = {k:tuple(v) for k, v in iteritems(bcm)}
+        if self.compact:
+            self.book_col_map = LinkMap(bcm)
+        else:
+            self.book_col_map = {k:tuple(v) for k, v in iteritems(bcm)}
 
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_ids in itervalues(self.book_col_map) for item_id in item_ids}
@@ -619,10 +682,13 @@ def remove_formats(self, formats_map, db):
             for m in (self.fname_map, self.size_map):
                 m[book_id] = {k:v for k, v in iteritems(m[book_id]) if k not in fmts}
             for fmt in fmts:
-                try:
-                    self.col_book_map[fmt].discard(book_id)
-                except KeyError:
-                    pass
+                # Formats without books are removed, like the items of other
+                # fields, the cached category data relies on it
+                item_book_ids = self.col_book_map.get(fmt)
+                if item_book_ids is not None:
+                    item_book_ids.discard(book_id)
+                    if not item_book_ids:
+                        del self.col_book_map[fmt]
         db.executemany('DELETE FROM data WHERE book=? AND format=?',
             [(book_id, fmt) for book_id, fmts in iteritems(formats_map) for fmt in fmts])
 
@@ -351,3 +351,73 @@ def compare_field(field, func=self.assertEqual):
         self.assertEqual(dest_db.format(rdata['new_book_id'], 'FMT1'), b'second-round')
 
     # }}}
+
+    def test_full_text_index(self):  # {{{
+        'Test maintenance of the full text index when adding/removing formats'
+        from calibre.db.search import ParseException
+        cache = self.init_cache()
+        self.assertFalse(cache.is_fts_enabled())
+        self.assertRaises(ParseException, cache.search, 'fts:something')
+        cache.enable_fts(start_indexer=False)
+        self.assertTrue(cache.is_fts_enabled())
+        fts = cache.backend.fts
+        # All existing formats are queued for indexing
+        self.assertEqual(cache.fts_indexing_progress(), (3, 0))
+
+        def index_all(text_map):
+            while True:
+                job = cache.fts_next_job()
+                if job is None:
+                    break
+                book_id, fmt = job
+                self.assertTrue(cache.fts_commit_result(book_id, fmt, 10, text_map.get(job, '')))
+
+        index_all({(1, 'FMT1'): 'the quick brown fox jumped', (2, 'FMT1'): 'over the lazy dogs'})
+        self.assertEqual(cache.fts_indexing_progress(), (0, 3))
+        self.assertEqual(cache.search('fts:fox'), {1})
+        self.assertEqual(cache.search('fts:dog'), {2})
+        self.assertEqual(cache.search('fts:dog', book_ids={1}), set())
+        self.assertEqual(cache.search('fts:the and not fts:fox'), {2})
+        res = cache.fts_search('jumping', highlight_start='[', highlight_end=']', snippet_size=3)
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0]['book_id'], 1)
+        self.assertIn('[jumped]', res[0]['text'])
+        res = cache.fts_search('jumping', highlight_start='<b class="x">', highlight_end='"</b>')
+        self.assertIn('<b class="x">jumped"</b>', res[0]['text'])
+        self.assertEqual(len(cache.fts_search('jumping', use_stemming=False)), 0)
+        self.assertRaises(ParseException, cache.search, 'fts:"unterminated')
+
+        # A format that is replaced while being indexed has its stale result discarded
+        job = cache.fts_next_job()
+        self.assertIsNone(job)
+        cache.add_format(1, 'FMT1', BytesIO(b'changed'), run_hooks=False)
+        job = cache.fts_next_job()
+        self.assertEqual(job, (1, 'FMT1'))
+        cache.add_format(1, 'FMT1', BytesIO(b'changed again'), run_hooks=False)
+        self.assertFalse(cache.fts_commit_result(1, 'FMT1', 10, 'stale'))
+        index_all({(1, 'FMT1'): 'a slow red fox'})
+        self.assertEqual(cache.search('fts:quick'), set())
+        self.assertEqual(cache.search('fts:slow'), {1})
+
+        # Indexing is resumable
+        cache.add_format(2, 'FMT2', BytesIO(b'new format'), run_hooks=False)
+        self.assertEqual(cache.fts_next_job(), (2, 'FMT2'))
+        cache.close()
+        cache = self.init_cache()
+        self.assertTrue(cache.is_fts_enabled())
+        self.assertEqual(cache.fts_next_job(), (2, 'FMT2'))
+        self.assertTrue(cache.fts_commit_result(2, 'FMT2', 10, 'lazy cats'))
+        self.assertEqual(cache.search('fts:lazy'), {2})
+
+        # Removal of formats and books
+        cache.remove_formats({2:('FMT1',)})
+        self.assertEqual(cache.search('fts:dogs'), set())
+        self.assertEqual(cache.search('fts:cats'), {2})
+        cache.remove_books((2,))
+        self.assertEqual(cache.search('fts:cats'), set())
+        self.assertEqual(cache.fts_indexing_progress(), (0, 2))
+        cache.enable_fts(False)
+        self.assertFalse(cache.is_fts_enabled())
+        self.assertIsNone(cache.backend.fts)
+        del fts
+    # }}}
@@ -40,5 +40,182 @@ def main():
     print('Stats saved to', stats)
 
 
+class SyntheticDB(object):
+
+    ''' Generates rows for the queries run by the tables, simulating a large
+    library without needing one on disk. '''
+
+    def __init__(self, num_books):
+        self.num_books = num_books
+
+    def execute(self, sql):
+        import random
+        r = random.Random(sql)
+        n = self.num_books
+        if 'FROM books_tags_link' in sql:
+            return ((book_id, r.randint(1, 5000)) for book_id in range(1, n + 1) for i in range(r.randint(0, 5)))
+        if 'FROM books_series_link' in sql:
+            return ((book_id, r.randint(1, 20000)) for book_id in range(1, n + 1) if r.random() < 0.3)
+        if 'FROM tags' in sql:
+            return ((i, 'tag%d' % i) for i in range(1, 5001))
+        if 'FROM series' in sql:
+            return ((i, 'series%d' % i) for i in range(1, 20001))
+        if 'timestamp' in sql:
+            return ((book_id, '2020-%02d-%02d 10:11:12+00:00' % (r.randint(1, 12), r.randint(1, 28))) for book_id in range(1, n + 1))
+        return ((book_id, 'Some book title number %d' % r.randint(1, n)) for book_id in range(1, n + 1))
+
+
+def table_memory(num_books=500000):
+    ''' Compare the memory used by the in-memory tables with and without
+    compact storage '''
+    import tracemalloc, gc
+    from calibre.db.tables import OneToOneTable, ManyToOneTable, ManyToManyTable
+    db = SyntheticDB(num_books)
+
+    def create_tables():
+        return [
+            OneToOneTable('title', {'datatype':'text', 'table':'books', 'column':'title'}),
+            OneToOneTable('sort', {'datatype':'text', 'table':'books', 'column':'sort'}),
+            OneToOneTable('timestamp', {'datatype':'datetime', 'table':'books', 'column':'timestamp'}),
+            ManyToOneTable('series', {'datatype':'series', 'table':'series', 'column':'name', 'link_column':'series'}),
+            ManyToManyTable('tags', {'datatype':'text', 'table':'tags', 'column':'name', 'link_column':'tag', 'is_multiple':{}}),
+        ]
+
+    for compact in (False, True):
+        gc.collect()
+        tracemalloc.start()
+        tables = create_tables()
+        for table in tables:
+            table.compact = compact
+            table.read(db)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('compact=%s: %.1f MB for %d books' % (compact, used / 1024**2, num_books))
+        del tables
+
+
+def multisort_benchmark(path='~/test library', repeat=5):
+    ''' Time a three field sort, both with an empty sort key cache and with
+    the cache populated by a previous sort '''
+    from time import monotonic
+    initdb(path)
+    cache = db.new_api
+    fields = [('series', True), ('authors', True), ('title', False)]
+    all_ids = cache.all_book_ids()
+    for label, clear in (('cold', True), ('warm', False)):
+        times = []
+        for i in range(repeat):
+            if clear:
+                cache.clear_caches(template_cache=False, search_cache=False)
+            st = monotonic()
+            cache.multisort(fields, ids_to_sort=all_ids)
+            times.append(monotonic() - st)
+        print('%s sort of %d books: best: %.3fs average: %.3fs' % (
+            label, len(all_ids), min(times), sum(times) / len(times)))
+
+
+def template_benchmark(path='~/test library', repeat=3):
+    ''' Time a program calling each builtin template function over all books,
+    both interpreted and compiled, checking that the results are the same '''
+    from time import monotonic
+    from calibre.utils.formatter_functions import formatter_functions
+    initdb(path)
+    cache = db.new_api
+    all_ids = cache.all_book_ids()
+    mis = [cache.get_proxy_metadata(book_id) for book_id in all_ids]
+    templates = []
+    for name, func in sorted(formatter_functions().get_builtins().items()):
+        if name == 'print':
+            continue
+        nargs = 2 if func.arg_count < 0 else func.arg_count
+        args = ', '.join(['x'] * nargs)
+        templates.append((name, 'program: x = field(\'title\'); if x then %s(%s) else \'\' fi' % (name, args)))
+    totals = {}
+    for name, template in templates:
+        results = {}
+        for compiled in (False, True):
+            template_cache, times = {}, []
+            for i in range(repeat):
+                st = monotonic()
+                ans = []
+                for mi in mis:
+                    mi.formatter.compile_templates = compiled
+                    ans.append(mi.formatter.safe_format(
+                        template, mi, 'TEMPLATE ERROR', mi, column_name='benchmark', template_cache=template_cache))
+                times.append(monotonic() - st)
+            results[compiled] = ans
+            totals[compiled] = totals.get(compiled, 0) + min(times)
+            print('%-25s compiled=%-5s %.3fs' % (name, compiled, min(times)))
+        if results[False] != results[True]:
+            print('Results for %s differ between the interpreter and the compiler' % name)
+    print('Total: interpreted: %.3fs compiled: %.3fs' % (totals[False], totals[True]))
+
+
+def contention_benchmark(path='~/test library', num_readers=8, num_writers=2, duration=10):
+    ''' Run searches and field reads from many threads while other threads
+    change tags, with and without lock free reads, and report the read
+    latencies. Works on a copy of the library, as it changes metadata. '''
+    import random, shutil, tempfile
+    from threading import Event, Thread
+    from time import monotonic
+    from calibre.db.cache import Cache
+    from calibre.db.backend import DB
+    from calibre.utils.config_base import Tweak
+    tdir = tempfile.mkdtemp()
+    try:
+        lpath = os.path.join(tdir, 'library')
+        shutil.copytree(os.path.expanduser(path), lpath)
+        for lock_free in (False, True):
+            with Tweak('lock_free_reads', lock_free):
+                cache = Cache(DB(lpath))
+                cache.init()
+            all_ids = tuple(cache.all_book_ids())
+            tags = tuple(cache.get_id_map('tags').values()) or ('tag',)
+            queries = ['tags:"=%s"' % t for t in random.sample(tags, min(20, len(tags)))] + ['title:the', 'not authors:a']
+            stop, latencies, writes = Event(), [], [0]
+
+            def reader():
+                r = random.Random()
+                while not stop.is_set():
+                    st = monotonic()
+                    if r.random() < 0.5:
+                        cache.search(r.choice(queries))
+                    else:
+                        cache.field_for('tags', r.choice(all_ids))
+                    latencies.append(monotonic() - st)
+
+            def writer():
+                r = random.Random()
+                while not stop.is_set():
+                    cache.set_field('tags', {r.choice(all_ids): r.sample(tags, min(3, len(tags)))})
+                    writes[0] += 1
+
+            threads = [Thread(target=reader) for i in range(num_readers)] + [Thread(target=writer) for i in range(num_writers)]
+            for t in threads:
+                t.start()
+            stop.wait(duration)
+            stop.set()
+            for t in threads:
+                t.join()
+            cache.close()
+            latencies.sort()
+            n = len(latencies)
+            print('lock_free_reads=%-5s reads: %d writes: %d median: %.2fms p99: %.2fms max: %.2fms' % (
+                lock_free, n, writes[0], 1000 * latencies[n // 2], 1000 * latencies[int(n * 0.99)], 1000 * latencies[-1]))
+    finally:
+        shutil.rmtree(tdir)
+
+
 if __name__ == '__main__':
-    main()
+    import sys
+    if sys.argv[-1] == 'memory':
+        table_memory()
+    elif sys.argv[-1] == 'sort':
+        multisort_benchmark()
+    elif sys.argv[-1] == 'template':
+        template_benchmark()
+    elif sys.argv[-1] == 'contention':
+        contention_benchmark()
+    else:
+        main()
@@ -7,6 +7,7 @@
 __docformat__ = 'restructuredtext en'
 
 import datetime
+import os
 from io import BytesIO
 from time import time
 
@@ -219,6 +220,16 @@ def test_sorting(self):  # {{{
         ae(list(range(1, 11)), cache.multisort([('#one', True), ('#two', True)], ids_to_sort=sorted(cache.all_book_ids())))
         ae([4, 5, 1, 2, 3, 7,8, 9, 10, 6], cache.multisort([('#one', True), ('#two', False)], ids_to_sort=sorted(cache.all_book_ids())))
         ae([5, 4, 3, 2, 1, 10, 9, 8, 7, 6], cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())))
+
+        # Test that sort keys are cached and that the cache is invalidated on changes
+        f = cache.fields['#three']
+        ae(10, len(f._sort_key_cache))
+        cache.set_field('#three', {5: 0})
+        self.assertNotIn(5, f._sort_key_cache)
+        ae(9, len(f._sort_key_cache))
+        ae([4, 5, 3, 2, 1, 10, 9, 8, 7, 6], cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())))
+        cache.clear_caches()
+        ae(0, len(f._sort_key_cache))
     # }}}
 
     def test_get_metadata(self):  # {{{
@@ -595,6 +606,113 @@ def test(hit, result, *args, **kw):
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
     # }}}
 
+    def test_search_planner(self):  # {{{
+        ' Test that re-ordering and caching sub-queries does not change results '
+        cache = self.init_cache()
+        all_ids = cache.all_book_ids(type=set)
+        tokens = (
+            'template:"{title}#@#:t:one"', 'tags:one', 'title:title', 'Unknown',
+            '#tags:=one', 'rating:>2', 'id:1', 'id:>1', 'authors:"=Author One"', 'title:~t.*o',
+        )
+        results = {t:cache.search(t) for t in tokens}
+        for a in tokens:
+            for b in tokens:
+                ra, rb = results[a], results[b]
+                self.assertEqual(cache.search('%s and %s' % (a, b)), ra & rb)
+                self.assertEqual(cache.search('%s or %s' % (a, b)), ra | rb)
+                self.assertEqual(cache.search('%s and not %s' % (a, b)), ra - rb)
+                self.assertEqual(cache.search('not (%s or %s) and %s' % (a, b, a)), set())
+                self.assertEqual(cache.search('(%s or not %s) and id:>1' % (a, b)), (ra | (all_ids - rb)) & results['id:>1'])
+
+        # Invalid operands raise even when the result is known without them
+        from calibre.utils.search_query_parser import ParseException
+        for q in ('title:xyzzy and rating:>abc', 'rating:>abc and title:xyzzy', 'id:>0 or rating:>abc',
+                  'title:xyzzy and (id:1 or search:"no such search")', 'not id:>0 and pubdate:>notadate'):
+            self.assertRaises(ParseException, cache.search, q)
+
+        # Expensive sub-queries are cached once they are seen a second time
+        cache = self.init_cache()
+        sc = cache._search_api.cache
+        key = 'template:"{title}#@#:t:one"'
+        self.assertEqual(cache.search(key + ' and tags:one'), results[key] & results['tags:one'])
+        self.assertNotIn(key, sc)
+        self.assertEqual(cache.search(key + ' and title:title'), results[key] & results['title:title'])
+        self.assertIn(key, sc)
+        self.assertNotIn('tags:"one"', sc)
+        self.assertEqual(sc.get(key), results[key])
+        self.assertEqual(cache.search(key + ' or title:two'), results[key] | cache.search('title:two'))
+        cache.set_field('title', {1: 'changed one', 2: 'Title Two'})
+        self.assertEqual(sc.get(key), cache.search('template:"{title}#@#:t:one"'))
+        # Not cached when only part of the library is searched
+        cache = self.init_cache()
+        sc = cache._search_api.cache
+        for i in range(3):
+            cache.search(key + ' and tags:one', 'id:1')
+        self.assertNotIn(key, sc)
+
+        # Explain
+        cache = self.init_cache()
+        q = key + ' and tags:one'
+        ids, plan = cache.explain_search(q)
+        self.assertEqual(ids, cache.search(q))
+        node = 'template:{title}#@#:t:one'
+        self.assertIn('tags:one', plan)
+        self.assertIn(node, plan)
+        self.assertLess(plan.index('tags:one'), plan.index(node))
+        self.assertNotIn('(cached)', plan)
+        cache.search(key + ' or tags:two')
+        ids, plan = cache.explain_search(q)
+        self.assertIn('(cached)', plan)
+    # }}}
+
+    def test_search_index(self):  # {{{
+        'Test that searching using the in-memory search index gives the same results'
+        from calibre.utils.config_base import Tweak
+        cache = self.init_cache()
+        with Tweak('use_search_index', True):
+            icache = self.init_cache()
+        si = icache._search_api.search_index
+        si.MIN_CANDIDATES = 0
+        queries = (
+            'title:="Title One"', 'title:title', 'title:"itle tw"', 'title:=title',
+            '#enum:=one', '#enum:tw', 'series:one', 'series:=series one', 'tags:one',
+            'tags:=one', 'one', 'two', '"publisher one"', '"my comments one"',
+            'comments:comments', 'authors:"author one"', 'authors:=unknown',
+            '#tags:=one', '#authors:two', '#series:seri', 'title:xyzzy',
+        )
+
+        def check():
+            for query in queries:
+                cache._search_api.clear_caches(), icache._search_api.clear_caches()
+                self.assertEqual(cache.search(query), icache.search(query), 'Search index result differs for: %s' % query)
+
+        check()
+        self.assertIn('title', si.indices)
+        for c in (cache, icache):
+            c.set_field('title', {1: 'Dérivé xyzzy'})
+            c.set_field('tags', {2: ('new tag', 'xyzzy')})
+            c.set_field('comments', {3: None})
+            c.rename_items('series', {c.get_item_id('series', 'Series One'): 'Renamed xyzzy'})
+        for q in ('title:derive', 'title:=dérivé xyzzy', 'tags:xyzz', 'tags:=new tag', 'series:renamed', 'xyzzy'):
+            self.assertEqual(cache.search(q), icache.search(q), 'Search index result differs for: %s' % q)
+        self.assertEqual({1}, icache.search('title:derive'))
+        # Letters that do not decompose but are equal to their base letters at
+        # ICU primary strength
+        for c in (cache, icache):
+            c.set_field('title', {1: 'Łódź Øresund Straße Encyclopædia'})
+        for q in ('title:lodz', 'title:oresund', 'title:strasse', 'title:encyclopaedia', 'title:"łódź"', 'title:=łódź øresund straße encyclopædia'):
+            self.assertEqual(cache.search(q), icache.search(q), 'Search index result differs for: %s' % q)
+        self.assertEqual({1}, icache.search('title:lodz'))
+        # Hiragana and katakana, and the digits of different scripts are equal
+        # at ICU primary strength
+        for c in (cache, icache):
+            c.set_field('title', {1: 'カタカナ ひらがな \u0661\u0662\u0663 \uff14\uff15'})
+        for q in ('title:かたかな', 'title:ヒラガナ', 'title:123', 'title:45', 'title:"\u0664\u0665"', 'title:"ナ \u0661"', 'title:カタカナ'):
+            self.assertEqual({1}, cache.search(q), 'Linear search does not match: %s' % q)
+            self.assertEqual(cache.search(q), icache.search(q), 'Search index result differs for: %s' % q)
+        check()
+    # }}}
+
     def test_proxy_metadata(self):  # {{{
         ' Test the ProxyMetadata object used for composite columns '
         from calibre.ebooks.metadata.book.base import STANDARD_METADATA_FIELDS
@@ -700,6 +818,43 @@ def test_composites(self):  # {{{
         self.assertEqual('FMT2', cache.field_for('#ccf', 1))
     # }}}
 
+    def test_compiled_templates(self):  # {{{
+        ' Test that compiled template programs give the same results as the interpreter '
+        cache = self.init_cache()
+        templates = (
+            'program: x = field("title"); y = strlen(x) + 2; y * 3',
+            'program: if field("series") then raw_field("series_index") else "none" fi',
+            'program: r = ""; for t in field("tags"): if t == "Tag One" then continue fi; r = strcat(r, t); r rof',
+            'program: for t in "a,b,c": if t == "b" then break fi; t rof',
+            'program: first_non_empty(field("#enum"), field("publisher"), "x")',
+            'program: contains(field("authors"), "one", "yes", "no")',
+            'program: "Title" in field("title") && !(1 ==# 2) || ""',
+            'program: raw_field("tags")',
+            'program: character("newline")',
+            'program: return field("title"); "not returned"',
+            'program: unknown_var',
+            'program: 1 + "a"',
+            'program: x = 4; x / 0',
+            'program: contains("abc", "(", "y", "n")',
+            'program: for t in "a": return 1 rof',
+            'program: globals(a="z"); set_globals(b=a); b',
+            'program:\n x = 1;\n\n character("nothing")',
+        )
+        for book_id in cache.all_book_ids():
+            mi = cache.get_proxy_metadata(book_id)
+            for i, template in enumerate(templates):
+                results = []
+                for compiled in (False, True):
+                    mi.formatter.compile_templates = compiled
+                    template_cache = {}
+                    for x in range(2):
+                        results.append(mi.formatter.safe_format(
+                            template, mi, 'ERROR', mi, column_name='t%d' % i, template_cache=template_cache,
+                            global_vars={}))
+                self.assertEqual(results[:2], results[2:], 'Different results for template: %s' % template)
+                self.assertIsNotNone(template_cache['t%d' % i][1])
+    # }}}
+
     def test_find_identical_books(self):  # {{{
         ' Test find_identical_books '
         from calibre.ebooks.metadata.book.base import Metadata
@@ -744,3 +899,148 @@ def test_storing_conversion_options(self):  # {{{
                 val = val.encode('utf-8')
             self.assertEqual(got, val)
     # }}}
+
+    def test_compact_tables(self):  # {{{
+        'Test that compact in-memory tables give the same results as dicts'
+        from calibre.db.backend import DB
+        from calibre.db.cache import Cache
+        from calibre.db.compact import DenseMap, LinkMap
+        cache = self.init_cache(self.library_path)
+        ccache = Cache(DB(self.library_path, compact_tables=True))
+        ccache.init()
+        self.assertIsInstance(ccache.fields['title'].table.book_col_map, DenseMap)
+        self.assertIsInstance(ccache.fields['tags'].table.book_col_map, LinkMap)
+        all_ids = cache.all_book_ids()
+        self.assertEqual(all_ids, ccache.all_book_ids())
+        for field in cache.fields:
+            if field in ('ondevice', 'marked'):
+                continue
+            for book_id in all_ids:
+                self.assertEqual(cache.field_for(field, book_id), ccache.field_for(field, book_id), 'Field %s differs for book %d' % (field, book_id))
+        for sort in ('title', 'authors', 'series', 'tags', 'rating', 'timestamp'):
+            self.assertEqual(cache.multisort([(sort, True)]), ccache.multisort([(sort, True)]))
+        for query in ('tags:=News', 'series:true', 'authors:"=Author One"', 'rating:>2'):
+            self.assertEqual(cache.search(query), ccache.search(query))
+
+        # Test that writing works
+        ccache.set_field('tags', {1: ('a', 'b'), 2: ()})
+        ccache.set_field('series', {1: 'A new series', 3: None})
+        ccache.set_field('title', {1: 'A new title'})
+        self.assertEqual(ccache.field_for('tags', 1), ('a', 'b'))
+        self.assertEqual(ccache.field_for('tags', 2), ())
+        self.assertEqual(ccache.field_for('series', 1), 'A new series')
+        self.assertIsNone(ccache.field_for('series', 3))
+        self.assertEqual(ccache.field_for('title', 1), 'A new title')
+        ccache.remove_books((2,))
+        self.assertEqual(ccache.all_book_ids(), all_ids - {2})
+        self.assertIsNone(ccache.fields['tags'].table.book_col_map.get(2))
+        ccache.close()
+    # }}}
+
+    def test_lazy_tables(self):  # {{{
+        'Test that reading tables lazily gives the same results'
+        from calibre.db.backend import DB
+        from calibre.db.cache import Cache
+        cache = self.init_cache(self.library_path)
+        backend = DB(self.library_path, lazy_tables=True)
+        lcache = Cache(backend)
+        lcache.init()
+        all_ids = cache.all_book_ids()
+        self.assertEqual(all_ids, lcache.all_book_ids())
+        for field in cache.fields:
+            if field in ('ondevice', 'marked'):
+                continue
+            for book_id in all_ids:
+                self.assertEqual(cache.field_for(field, book_id), lcache.field_for(field, book_id), 'Field %s differs for book %d' % (field, book_id))
+        for query in ('tags:=News', 'series:true', 'authors:"=Author One"', 'rating:>2'):
+            self.assertEqual(cache.search(query), lcache.search(query))
+        backend.table_loader.wait()
+        for table in backend.tables.values():
+            self.assertNotIn('deferred_read', vars(table))
+
+        lcache.set_field('tags', {1: ('a', 'b')})
+        self.assertEqual(lcache.field_for('tags', 1), ('a', 'b'))
+        lcache.close()
+
+        # A table is read on first access
+        backend = DB(self.library_path)
+        table = backend.tables['tags']
+        table.defer_read(backend)
+        self.assertNotIn('id_map', vars(table))
+        self.assertEqual(table.id_map, cache.fields['tags'].table.id_map)
+        self.assertNotIn('deferred_read', vars(table))
+        self.assertFalse(table.read_deferred())
+        self.assertRaises(AttributeError, getattr, table, 'no_such_attribute')
+        backend.close()
+    # }}}
+
+    def test_table_store(self):  # {{{
+        'Test re-using the in-memory tables stored when the library is closed'
+        from calibre.db.backend import DB
+        from calibre.db.cache import Cache
+        store_path = os.path.join(self.library_path, 'tables.pickle')
+
+        def open_cache(expect_store):
+            backend = DB(self.library_path, use_table_store=True)
+            backend.table_store_path = store_path
+            if expect_store:
+                def fail(*args):
+                    raise AssertionError('Table read from the database instead of the store')
+                for table in backend.tables.values():
+                    table.read = fail
+            cache = Cache(backend)
+            cache.init()
+            for table in backend.tables.values():
+                table.__dict__.pop('read', None)
+            return cache
+
+        def check(cache, ref):
+            all_ids = ref.all_book_ids()
+            self.assertEqual(all_ids, cache.all_book_ids())
+            for field in ref.fields:
+                if field in ('ondevice', 'marked'):
+                    continue
+                for book_id in all_ids:
+                    self.assertEqual(ref.field_for(field, book_id), cache.field_for(field, book_id), 'Field %s differs for book %d' % (field, book_id))
+            for query in ('tags:=News', 'series:true', 'authors:"=Author One"', 'rating:>2'):
+                self.assertEqual(ref.search(query), cache.search(query))
+
+        cache = open_cache(False)
+        cache.close()
+        self.assertTrue(os.path.exists(store_path))
+        cache = open_cache(True)
+        check(cache, self.init_cache(self.library_path))
+        cache.set_field('tags', {1: ('store1', 'store2')})
+        cache.close()
+        cache = open_cache(True)
+        self.assertEqual(cache.field_for('tags', 1), ('store1', 'store2'))
+        check(cache, self.init_cache(self.library_path))
+        cache.close()
+
+        # Changes made while the library is closed make the store stale
+        other = self.init_cache(self.library_path)
+        other.set_field('title', {1: 'changed elsewhere'})
+        other.close()
+        cache = open_cache(False)
+        self.assertEqual(cache.field_for('title', 1), 'changed elsewhere')
+
+        # Changes made by another connection while the library is open
+        # prevent the tables from being stored
+        os.remove(store_path)
+        other = self.init_cache(self.library_path)
+        other.set_field('title', {1: 'changed again'})
+        other.close()
+        cache.close()
+        self.assertFalse(os.path.exists(store_path))
+
+        # A change made by another connection after the tables were dumped
+        # makes the stored data stale
+        cache = open_cache(False)
+        data = cache.backend.dump_tables()
+        other = self.init_cache(self.library_path)
+        other.set_field('title', {1: 'changed after dump'})
+        other.close()
+        cache.backend.table_store.save(data)
+        cache = open_cache(False)
+        self.assertEqual(cache.field_for('title', 1), 'changed after dump')
+    # }}}
@@ -6,6 +6,7 @@
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import os
 from collections import namedtuple
 from functools import partial
 from io import BytesIO
@@ -652,6 +653,230 @@ def test_invalidate():
         test_invalidate()
     # }}}
 
+    def test_composite_dependencies(self):  # {{{
+        ' Test that only the composite columns that depend on a changed field are invalidated '
+        cache = self.init_cache()
+        for label, template in (
+            ('ta', '{title}'),
+            ('tb', "program: strcat(field('#ta'), $tags)"),
+            ('tc', '{series_index}'),
+            ('unk', "program: field(strcat('ti', 'tle'))"),
+            ('cya', '{#cyb}'), ('cyb', "{#cya:'uppercase($)'}"),
+            ('fp', 'program: formats_paths()'),
+            ('fora', "program: for t in 'tags': t rof"),
+            ('forb', "program: for t in strcat('ta', 'gs'): t rof"),
+        ):
+            cache.create_custom_column(label, label, 'composite', False, display={'composite_template':template})
+        cache = self.init_cache()
+        g = cache.composite_dependency_graph()
+        self.assertEqual(g['dependencies']['#ta'], ['title'])
+        self.assertEqual(g['dependencies']['#tb'], ['#ta', 'tags'])
+        self.assertIsNone(g['dependencies']['#unk'])
+        self.assertEqual(g['dependencies']['#fp'], ['formats', 'path'])
+        self.assertEqual(g['dependencies']['#fora'], ['tags'])
+        self.assertIsNone(g['dependencies']['#forb'])
+        self.assertEqual(g['always_cleared'], ['#forb', '#unk'])
+        self.assertEqual(g['dependents']['title'], ['#ta', '#tb'])
+        self.assertEqual(g['cycles'], [['#cya', '#cyb']])
+
+        def rendered(name, book_id):
+            return book_id in cache.fields[name]._render_cache
+
+        def render_all():
+            for name in ('#ta', '#tb', '#tc', '#unk'):
+                for book_id in cache.all_book_ids():
+                    cache.field_for(name, book_id)
+
+        def check():
+            c = self.init_cache()
+            for name in ('#ta', '#tb', '#tc', '#unk'):
+                for book_id in cache.all_book_ids():
+                    self.assertEqual(cache.field_for(name, book_id), c.field_for(name, book_id))
+
+        render_all()
+        cache.set_field('tags', {1:'newtag'})
+        self.assertTrue(rendered('#ta', 1))
+        self.assertTrue(rendered('#tc', 1))
+        self.assertFalse(rendered('#tb', 1))
+        self.assertFalse(rendered('#unk', 1))
+        self.assertTrue(rendered('#tb', 2))
+        check()
+        render_all()
+        cache.set_field('title', {2:'changed'})
+        self.assertFalse(rendered('#ta', 2))
+        self.assertFalse(rendered('#tb', 2))
+        self.assertTrue(rendered('#tc', 2))
+        check()
+        render_all()
+        cache.set_field('series', {1:'new series [3]'})
+        self.assertFalse(rendered('#tc', 1))
+        self.assertTrue(rendered('#ta', 1))
+        check()
+    # }}}
+
+    def test_composite_store(self):  # {{{
+        ' Test storing the values of composite columns across restarts '
+        cache = self.init_cache()
+        for label, template in (
+            ('ta', '{title}'),
+            ('tb', '{#ta} {series_index}'),
+            ('dev', 'program: ondevice()'),
+            ('day', 'program: today()'),
+        ):
+            cache.create_custom_column(label, label, 'composite', False, display={'composite_template':template})
+        cache = self.init_cache()
+        book_ids = cache.all_book_ids()
+        for name in ('#ta', '#tb', '#dev', '#day'):
+            for book_id in book_ids:
+                cache.field_for(name, book_id)
+        expected_order = cache.multisort([('#tb', False)])
+        path = os.path.join(self.library_path, 'composites.pickle')
+        cache.save_composite_values(path)
+
+        c = self.init_cache()
+        self.assertEqual(c.load_composite_values(path), 2 * len(book_ids))
+        self.assertFalse(c.fields['#dev']._persisted)
+        self.assertFalse(c.fields['#day']._persisted)
+        self.assertEqual(c.multisort([('#tb', False)]), expected_order)
+        self.assertFalse(c.fields['#tb']._persisted)
+        for book_id in book_ids:
+            self.assertIn(book_id, c.fields['#ta']._persisted)
+            self.assertEqual(c.field_for('#ta', book_id), cache.field_for('#ta', book_id))
+            self.assertNotIn(book_id, c.fields['#ta']._persisted)
+            self.assertIn(book_id, c.fields['#ta']._render_cache)
+
+        # Changed books and templates must not use the stored values
+        c.set_field('title', {1:'changed'})
+        c.save_composite_values(path)
+        c = self.init_cache()
+        c.set_field('tags', {2:'newtag'})
+        c = self.init_cache()
+        c.load_composite_values(path)
+        self.assertIsNone(c.fields['#ta']._load_persisted(2))
+        self.assertEqual(c.field_for('#ta', 1), 'changed')
+        c.set_custom_column_metadata(c.field_metadata['#ta']['colnum'], display={'composite_template':'{title}:'})
+        c = self.init_cache()
+        self.assertEqual(c.load_composite_values(path), 0)
+    # }}}
+
+    def test_lock_free_reads(self):  # {{{
+        ' Test answering reads from snapshots of the tables, without locking '
+        from threading import Event, Thread
+        from calibre.db.snapshot import SnapshotUnavailable
+        from calibre.utils.config_base import Tweak
+        with Tweak('lock_free_reads', True):
+            cache = self.init_cache()
+        snap = cache.snapshot
+        self.assertIsNotNone(snap)
+        for name in ('title', 'authors', 'tags', 'series', 'identifiers', 'formats', '#tags', '#yesno'):
+            for book_id in cache.all_book_ids():
+                self.assertEqual(cache.field_for(name, book_id), cache._field_for(name, book_id))
+        self.assertRaises(SnapshotUnavailable, snap.field_for, 'ondevice', 1)
+        self.assertEqual(cache.field_for('ondevice', 1), cache._field_for('ondevice', 1))
+
+        # Only the tables of changed fields are copied
+        old_tags = cache.field_for('tags', 1)
+        cache.set_field('tags', {1:'newtag'})
+        self.assertGreater(cache.snapshot.version, snap.version)
+        self.assertIs(cache.snapshot.tables['title'], snap.tables['title'])
+        self.assertIsNot(cache.snapshot.tables['tags'], snap.tables['tags'])
+        self.assertEqual(cache.field_for('tags', 1), ('newtag',))
+        self.assertEqual(snap.field_for('tags', 1), old_tags)
+        self.assertEqual(cache.search('tags:=newtag'), {1})
+
+        # The thread holding the write lock sees its own changes
+        with cache.write_lock:
+            cache._set_field('title', {2:'inside'})
+            self.assertEqual(cache.field_for('title', 2), 'inside')
+        self.assertEqual(cache.snapshot.field_for('title', 2), 'inside')
+
+        # Reads do not wait for writers
+        held, done = Event(), Event()
+
+        def hold():
+            with cache.write_lock:
+                held.set()
+                done.wait(5)
+        t = Thread(target=hold)
+        t.start()
+        held.wait(5)
+        try:
+            self.assertEqual(cache.field_for('title', 2), 'inside')
+            self.assertEqual(cache.search('title:inside'), {2})
+        finally:
+            done.set()
+            t.join()
+
+        # Removed books are not seen by lock-free reads
+        cache.remove_books((2,))
+        self.assertNotIn(2, cache.all_book_ids())
+        self.assertIsNone(cache.field_for('title', 2))
+        self.assertEqual(cache.field_for('authors', 2), ())
+        self.assertEqual(cache.search('title:inside'), set())
+        self.assertEqual(cache.search(''), cache._search(''))
+
+        # Books added without formats are seen by lock-free reads
+        book_id = cache.create_book_entry(Metadata('lock free empty', ['lfa']))
+        self.assertIn(book_id, cache.all_book_ids())
+        for name in ('title', 'authors', 'size', 'sort', 'series_index', 'author_sort', 'uuid', 'cover', 'path'):
+            self.assertEqual(cache.field_for(name, book_id), cache._field_for(name, book_id), name)
+        self.assertEqual(cache.search('title:"lock free empty"'), {book_id})
+        ids, duplicates = cache.add_books([(Metadata('another empty', ['lfa']), {})])
+        self.assertEqual(cache.all_book_ids(), cache._all_book_ids())
+        self.assertEqual(cache.search('authors:=lfa'), {book_id} | set(ids))
+    # }}}
+
+    def test_category_data(self):  # {{{
+        ' Test that the cached category data is updated when books change '
+        cache = self.init_cache()
+
+        def as_dict(categories):
+            return {category:sorted((t.name, t.count, tuple(sorted(t.id_set)), t.avg_rating) for t in tags)
+                    for category, tags in iteritems(categories)}
+
+        def check(book_ids=None):
+            ans = as_dict(cache.get_categories(book_ids=book_ids))
+            cache.category_data.clear()
+            self.assertEqual(ans, as_dict(cache.get_categories(book_ids=book_ids)))
+
+        for book_ids in (None, {1, 2}, {3}):
+            check(book_ids)
+        cache.get_categories(), cache.get_categories(book_ids={1, 2})
+        cache.set_field('tags', {1:'newtag', 2:('Tag One', 'newtag')})
+        check(), check({1, 2})
+        cache.get_categories(), cache.get_categories(book_ids={1, 2})
+        cache.set_field('rating', {1:6, 3:2})
+        check(), check({1, 2})
+        cache.get_categories()
+        cache.set_field('series', {1:'A Series One', 2:None})
+        check()
+        cache.get_categories()
+        cache.rename_items('tags', {cache.get_item_id('tags', 'newtag'):'News'})
+        check()
+        cache.get_categories(), cache.get_categories(book_ids={1, 2})
+        cache.remove_books((2,))
+        check(), check({1, 2})
+        cache.get_categories()
+        cache.set_field('title', {1:'changed'})
+        self.assertFalse(cache.category_data.dirtied.get('tags'))
+        cache.add_books([(cache.get_metadata(1), {})])
+        check()
+        # Formats without books do not cause the data to be computed again
+        cache.get_categories()
+        cache.remove_formats({book_id: cache.formats(book_id) for book_id in cache.all_book_ids()})
+        self.assertFalse([fmt for fmt, book_ids in iteritems(cache.fields['formats'].table.col_book_map) if not book_ids])
+        check()
+        cache.get_categories()
+        field, calls = cache.fields['formats'], []
+        orig = field.category_item_data
+        field.category_item_data = lambda *a, **kw: calls.append(kw) or orig(*a, **kw)
+        try:
+            cache.get_categories()
+        finally:
+            del field.category_item_data
+        self.assertEqual(calls, [])
+    # }}}
+
     def test_dump_and_restore(self):  # {{{
         ' Test roundtripping the db through SQL '
         cache = self.init_cache()
@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Run many conversions in a pool of long lived worker processes, so that the
+cost of starting the interpreter, loading the plugins and scanning the fonts is
+paid once per worker rather than once per conversion.
+
+The conversion server listens on a local socket. Clients send it jobs as JSON
+objects with the keys: id, cwd, args (the command line arguments for
+ebook-convert, starting with the input and output files) and, optionally, log
+(a file to write the output of the conversion to). The server replies to every
+job with a JSON object with the keys: id, ok, exit_code, duration and, for
+failed jobs, error or log (the end of the output of the conversion).
+'''
+
+import os
+import sys
+import time
+from collections import deque
+from itertools import count
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from threading import Lock, Thread
+
+from calibre import detect_ncpus, prints
+from calibre.constants import cache_dir, iswindows
+from calibre.utils.config import OptionParser
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.ipc import socket_address
+from calibre.utils.ipc.pool import Failure, Pool
+from calibre.utils.serialize import json_dumps, json_loads
+from polyglot.builtins import iteritems
+from polyglot.queue import Empty, Queue
+
+JOBS_PER_WORKER = 50
+# Jobs that were running in a worker pool that failed because some other job
+# crashed its worker are run again, up to this many times in total
+MAX_ATTEMPTS = 2
+LOG_TAIL_SIZE = 8 * 1024
+
+
+def server_address():
+    return socket_address('Convert' if iswindows else 'convert')
+
+
+def authkey_path():
+    return os.path.join(cache_dir(), 'conversion-server-key')
+
+
+def create_authkey(path):
+    key = os.urandom(32)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except EnvironmentError:
+        pass
+    tpath = path + '.tmp'
+    try:
+        os.remove(tpath)
+    except EnvironmentError:
+        pass
+    fd = os.open(tpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    atomic_rename(tpath, path)
+    return key
+
+
+def read_authkey(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# Worker {{{
+def warm_up():
+    ' Run in the worker processes, to load everything conversions need '
+    import css_parser  # noqa
+    from lxml import html  # noqa
+    import calibre.customize.ui  # noqa (loads the plugins)
+    import calibre.ebooks.conversion.plumber  # noqa
+    from calibre.ebooks.oeb.stylizer import html_css_stylesheet
+    html_css_stylesheet()
+    from calibre.utils.fonts.scanner import font_scanner
+    font_scanner.find_font_families()
+
+
+def convert(cwd, args, log=None):
+    ''' Run in the worker processes. Run ebook-convert with the command line
+    arguments args, returning its exit code and, if it failed, the end of its
+    output. '''
+    import tempfile
+    from calibre.ebooks.conversion.cli import main
+    os.chdir(cwd)
+    with (open(log, 'w+b') if log else tempfile.TemporaryFile()) as f:
+        sys.stdout.flush(), sys.stderr.flush()
+        saved = os.dup(1), os.dup(2)
+        os.dup2(f.fileno(), 1), os.dup2(f.fileno(), 2)
+        try:
+            try:
+                exit_code = main(['ebook-convert'] + list(args))
+            except SystemExit as err:
+                exit_code = err.code
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                exit_code = 1
+        finally:
+            sys.stdout.flush(), sys.stderr.flush()
+            os.dup2(saved[0], 1), os.dup2(saved[1], 2)
+            os.close(saved[0]), os.close(saved[1])
+        if not isinstance(exit_code, int):
+            exit_code = 0 if exit_code is None else 1
+        output = None
+        if exit_code != 0:
+            f.seek(max(0, f.seek(0, os.SEEK_END) - LOG_TAIL_SIZE))
+            output = f.read().decode('utf-8', 'replace')
+    return {'exit_code': exit_code, 'log': output}
+# }}}
+
+
+# Server {{{
+class ClientConnection(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = Lock()
+        self.closed = False
+
+    def send(self, msg):
+        with self.lock:
+            if not self.closed:
+                try:
+                    self.conn.send_bytes(json_dumps(msg))
+                except Exception:
+                    self.closed = True
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.conn.close()
+
+
+class ConversionJob(object):
+
+    __slots__ = ('client', 'client_id', 'cwd', 'args', 'log', 'attempts', 'started')
+
+    def __init__(self, client, msg):
+        self.client, self.client_id = client, msg['id']
+        self.cwd, self.args, self.log = msg['cwd'], msg['args'], msg.get('log')
+        self.attempts = 0
+        self.started = time.monotonic()
+
+
+class ConversionServer(object):
+
+    # The module whose convert() function runs the jobs in the workers and the
+    # (module, func) pair called in every worker when it starts
+    job_module = __name__
+    worker_warm_up = (__name__, 'warm_up')
+
+    def __init__(self, num_workers=0, jobs_per_worker=JOBS_PER_WORKER):
+        self.num_workers = num_workers or detect_ncpus()
+        self.jobs_per_worker = jobs_per_worker
+        self.lock = Lock()
+        self.results = Queue()
+        self.job_ids = count()
+        self.outstanding = {}
+        # Replies are sent without holding the lock, so that a slow client
+        # cannot block the server
+        self.replies = []
+        self.shutting_down = False
+        self.pool = self.create_pool()
+        self.dispatcher = Thread(target=self.dispatch_results, name='ConversionServerResults')
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def create_pool(self):
+        pool = Pool(max_workers=self.num_workers, name='ConversionServer',
+                    max_jobs_per_worker=self.jobs_per_worker, warm_up=self.worker_warm_up)
+        # All pools put their results in the same queue, so that results are
+        # not lost when a pool is replaced after a worker crash
+        pool.results = self.results
+        return pool
+
+    def serve(self, listener):
+        while not self.shutting_down:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError):
+                continue
+            except EnvironmentError:
+                if self.shutting_down:
+                    break
+                raise
+            t = Thread(target=self.handle_client, args=(conn,), name='ConversionServerClient')
+            t.daemon = True
+            t.start()
+
+    def handle_client(self, conn):
+        client = ClientConnection(conn)
+        while True:
+            try:
+                msg = json_loads(conn.recv_bytes())
+            except Exception:
+                break
+            try:
+                job = ConversionJob(client, msg)
+            except Exception as err:
+                client.send({'id': msg.get('id') if isinstance(msg, dict) else None, 'ok': False, 'error': 'Invalid job: %s' % err})
+                continue
+            with self.lock:
+                job_id = next(self.job_ids)
+                self.outstanding[job_id] = job
+                self.run_job(job_id, job)
+        client.close()
+
+    def run_job(self, job_id, job):
+        if self.pool is None:
+            self.pool = self.create_pool()
+        job.attempts += 1
+        try:
+            self.pool(job_id, self.job_module, 'convert', job.cwd, job.args, job.log)
+        except Failure:
+            pass  # The job is run again by recover()
+
+    def dispatch_results(self):
+        while not self.shutting_down:
+            try:
+                wr = self.results.get(timeout=0.2)
+            except Empty:
+                wr = None
+            with self.lock:
+                if wr is not None and not wr.is_terminal_failure:
+                    self.job_finished(wr.id, wr.result)
+                if self.pool is not None and self.pool.failed and not self.shutting_down:
+                    self.recover()
+                replies, self.replies = self.replies, []
+            for client, msg in replies:
+                client.send(msg)
+
+    def recover(self):
+        ' A worker crashed, taking down its pool, start a new pool and run the jobs again '
+        failure = self.pool.terminal_failure
+        while True:
+            try:
+                wr = self.results.get_nowait()
+            except Empty:
+                break
+            if not wr.is_terminal_failure:
+                self.job_finished(wr.id, wr.result)
+        self.pool = None
+        for job_id, job in tuple(iteritems(self.outstanding)):
+            if job_id == failure.job_id or job.attempts >= MAX_ATTEMPTS:
+                self.job_finished(job_id, error='%s\n%s' % (failure.message, failure.tb or ''))
+            else:
+                self.run_job(job_id, job)
+
+    def job_finished(self, job_id, result=None, error=None):
+        job = self.outstanding.pop(job_id, None)
+        if job is None:
+            return
+        msg = {'id': job.client_id, 'ok': False, 'duration': time.monotonic() - job.started}
+        if result is not None:
+            if result.err is None:
+                msg['exit_code'] = result.value['exit_code']
+                msg['ok'] = msg['exit_code'] == 0
+                msg['log'] = result.value['log']
+            else:
+                error = '%s\n%s' % (result.err, result.traceback)
+        if error is not None:
+            msg['error'] = error
+        self.replies.append((job.client, msg))
+
+    def shutdown(self):
+        with self.lock:
+            self.shutting_down = True
+            if self.pool is not None:
+                self.pool.shutdown()
+# }}}
+
+
+# Command line interface {{{
+def option_parser():
+    parser = OptionParser(usage=_('''\
+%prog --batch manifest.jsonl [options]
+%prog --batch-server [options]
+
+Convert many e-books, using a pool of worker processes that are re-used for
+many conversions, which avoids the startup cost of a separate ebook-convert
+process per conversion.
+
+Every line of manifest.jsonl must be a JSON object with the keys input and
+output, the input and output files, and, optionally, options, a list of
+command line options for ebook-convert, and log, a file to write the output of
+the conversion to. Relative paths are relative to the current folder.
+
+If a conversion server started with --batch-server is running, the conversions
+are run by it, otherwise a pool of worker processes is started just for this
+batch.'''))
+    parser.add_option('--batch', default=None, help=_(
+        'Convert the e-books listed in the specified manifest file.'))
+    parser.add_option('--batch-server', default=False, action='store_true', help=_(
+        'Run a conversion server that runs the conversions of --batch clients until interrupted.'))
+    parser.add_option('--batch-workers', default=0, type='int', help=_(
+        'The number of worker processes of the server, and the number of'
+        ' conversions a --batch client runs at a time. Defaults to the number of CPUs.'))
+    parser.add_option('--batch-jobs-per-worker', default=JOBS_PER_WORKER, type='int', help=_(
+        'The number of conversions after which a worker process is replaced by a'
+        ' new one, to release any memory it has accumulated. Zero means never. Default: %default'))
+    return parser
+
+
+def connect_to_server():
+    try:
+        return Client(server_address(), authkey=read_authkey(authkey_path()))
+    except Exception:
+        return None
+
+
+def run_server(num_workers, jobs_per_worker):
+    conn = connect_to_server()
+    if conn is not None:
+        conn.close()
+        prints('A conversion server is already running', file=sys.stderr)
+        return 1
+    address = server_address()
+    if address[0] not in '\0\\' and os.path.exists(address):
+        os.remove(address)  # left behind by a server that did not shutdown cleanly
+    keypath = authkey_path()
+    listener = Listener(address, authkey=create_authkey(keypath))
+    server = ConversionServer(num_workers, jobs_per_worker)
+    prints('Conversion server running with %d workers, press Ctrl+C to stop it' % server.num_workers)
+    try:
+        server.serve(listener)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        listener.close()
+        try:
+            os.remove(keypath)
+        except EnvironmentError:
+            pass
+    return 0
+
+
+def read_manifest(path):
+    with open(path, 'rb') as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if line:
+                job = json_loads(line)
+                if not isinstance(job, dict) or not job.get('input') or not job.get('output'):
+                    raise ValueError('Line %d of %s does not specify an input and output file' % (i + 1, path))
+                yield job
+
+
+def run_batch(manifest, concurrency, jobs_per_worker):
+    jobs = list(read_manifest(manifest))
+    concurrency = concurrency or detect_ncpus()
+    server = listener = None
+    conn = connect_to_server()
+    if conn is None:
+        server = ConversionServer(concurrency, jobs_per_worker)
+        address, authkey = socket_address('convert-%d' % os.getpid()), os.urandom(32)
+        listener = Listener(address, authkey=authkey)
+        t = Thread(target=server.serve, args=(listener,), name='ConversionServer')
+        t.daemon = True
+        t.start()
+        conn = Client(address, authkey=authkey)
+    cwd = os.getcwd()
+    pending, in_flight, num_done, failed = deque(enumerate(jobs)), set(), 0, 0
+    st = time.monotonic()
+
+    def report(result):
+        nonlocal num_done, failed
+        num_done += 1
+        job = jobs[result['id']]
+        if result['ok']:
+            prints('[%d/%d] Converted %s to %s in %.1f seconds' % (
+                num_done, len(jobs), job['input'], job['output'], result['duration']))
+        else:
+            failed += 1
+            prints('[%d/%d] Failed to convert %s to %s' % (num_done, len(jobs), job['input'], job['output']), file=sys.stderr)
+            details = result.get('error') or result.get('log')
+            if details:
+                prints(details, file=sys.stderr)
+
+    try:
+        while pending or in_flight:
+            try:
+                while pending and len(in_flight) < concurrency:
+                    i, job = pending[0]
+                    conn.send_bytes(json_dumps({
+                        'id': i, 'cwd': cwd, 'args': [job['input'], job['output']] + list(job.get('options') or ()), 'log': job.get('log')}))
+                    pending.popleft()
+                    in_flight.add(i)
+                result = json_loads(conn.recv_bytes())
+            except (EOFError, EnvironmentError):
+                # The server went away, for instance, because it was stopped
+                error = 'The connection to the conversion server was lost'
+                for i in sorted(in_flight) + [i for i, job in pending]:
+                    report({'id': i, 'ok': False, 'error': error})
+                break
+            in_flight.discard(result['id'])
+            report(result)
+    finally:
+        conn.close()
+        if server is not None:
+            server.shutdown()
+            listener.close()
+    prints('Converted %d of %d books in %.1f seconds' % (len(jobs) - failed, len(jobs), time.monotonic() - st))
+    return 1 if failed else 0
+
+
+def main(args=sys.argv):
+    parser = option_parser()
+    opts, leftover_args = parser.parse_args(args)
+    if len(leftover_args) > 1:
+        prints('Extra arguments not understood:', ', '.join(leftover_args[1:]), file=sys.stderr)
+        return 1
+    if opts.batch_server:
+        return run_server(opts.batch_workers, opts.batch_jobs_per_worker)
+    if not opts.batch:
+        parser.print_help()
+        return 1
+    return run_batch(opts.batch, opts.batch_workers, opts.batch_jobs_per_worker)
+# }}}
+
+
+# Tests {{{
+TEST_JOBS = '''
+import os, time
+
+def convert(cwd, args, log=None):
+    action, output = args
+    with open(os.path.join(cwd, output), 'a') as f:
+        f.write('ran\\n')
+    if action == 'crash':
+        # Wait for another job to start, so that it is running when this
+        # worker crashes
+        for i in range(100):
+            if len(os.listdir(cwd)) > 1:
+                break
+            time.sleep(0.1)
+        os._exit(1)
+    time.sleep(0.5)
+    if action == 'fail':
+        return {'exit_code': 1, 'log': 'Conversion failed'}
+    return {'exit_code': 0, 'log': None}
+'''
+
+
+def test():
+    import shutil
+    import tempfile
+
+    class TestServer(ConversionServer):
+        job_module, worker_warm_up = TEST_JOBS, None
+
+    def runs(output):
+        with open(os.path.join(tdir, output)) as f:
+            return len(f.read().splitlines())
+
+    tdir = tempfile.mkdtemp()
+    server = TestServer(num_workers=2)
+    address, authkey = socket_address('convert-test-%d' % os.getpid()), os.urandom(32)
+    listener = Listener(address, authkey=authkey)
+    t = Thread(target=server.serve, args=(listener,), name='ConversionServer')
+    t.daemon = True
+    t.start()
+    conn = Client(address, authkey=authkey)
+    try:
+        # The crashing job is sent first, so that other jobs are running or
+        # queued when it takes down its worker
+        actions = ['crash'] + ['good'] * 6 + ['fail']
+        for i, action in enumerate(actions):
+            conn.send_bytes(json_dumps({'id': i, 'cwd': tdir, 'args': [action, '%d.txt' % i]}))
+        conn.send_bytes(json_dumps({'id': 'invalid'}))
+        replies = {}
+        while len(replies) < len(actions) + 1:
+            if not conn.poll(60):
+                raise SystemExit('Timed out waiting for replies, got: %r' % replies)
+            reply = json_loads(conn.recv_bytes())
+            replies[reply['id']] = reply
+
+        reply = replies['invalid']
+        if reply['ok'] or 'Invalid job' not in reply.get('error', ''):
+            raise SystemExit('Invalid job not rejected: %r' % reply)
+        reply = replies[0]
+        if reply['ok'] or 'crashed' not in reply.get('error', ''):
+            raise SystemExit('Crashing job did not fail: %r' % reply)
+        if runs('0.txt') != 1:
+            raise SystemExit('Crashing job was run again')
+        for i, action in enumerate(actions):
+            if action == 'crash':
+                continue
+            reply = replies[i]
+            if reply['ok'] != (action == 'good') or reply.get('exit_code') != (0 if action == 'good' else 1):
+                raise SystemExit('Unexpected reply for job %d (%s): %r' % (i, action, reply))
+            if not 1 <= runs('%d.txt' % i) <= MAX_ATTEMPTS:
+                raise SystemExit('Job %d was run %d times' % (i, runs('%d.txt' % i)))
+        if not any(runs('%d.txt' % i) > 1 for i in range(1, len(actions))):
+            raise SystemExit('No job was run again after the worker crash')
+    finally:
+        conn.close()
+        server.shutdown()
+        listener.close()
+        shutil.rmtree(tdir, ignore_errors=True)
+
+    print('Tests all passed!')
+# }}}
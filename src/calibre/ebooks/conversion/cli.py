@@ -43,6 +43,9 @@
 To get help on them specify the input and output file and then use the -h \
 option.
 
+To convert many e-books in one go, reusing the conversion worker processes, \
+see: %prog --batch -h
+
 For full documentation of the conversion system see
 ''') + localize_user_manual_link('https://manual.calibre-ebook.com/conversion.html')
 
@@ -185,6 +188,8 @@ def add_pipeline_options(parser, plumber):
                     [
                      'input_profile',
                      'output_profile',
+                     'parallel_transforms',
+                     'memory_limit',
                      ]
                     )),
               (_('LOOK AND FEEL') , (
@@ -289,6 +294,9 @@ def __call__(self, frac, msg=''):
 
 
 def create_option_parser(args, log):
+    if len(args) > 1 and args[1].startswith('--batch'):
+        from calibre.ebooks.conversion.batch import main
+        raise SystemExit(main(args))
     if '--version' in args:
         from calibre.constants import __appname__, __version__, __author__
         log(os.path.basename(args[0]), '('+__appname__, __version__+')')
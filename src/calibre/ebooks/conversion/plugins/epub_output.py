@@ -496,6 +496,7 @@ def workaround_ade_quirks(self):  # {{{
             if stylesheet is not None:
                 # ADE doesn't render lists correctly if they have left margins
                 from css_parser.css import CSSRule
+                from calibre.ebooks.oeb.stylizer import stylesheet_changed
                 for lb in XPath('//h:ul[@class]|//h:ol[@class]')(root):
                     sel = '.'+lb.get('class')
                     for rule in stylesheet.data.cssRules.rulesOfType(CSSRule.STYLE_RULE):
@@ -510,6 +511,7 @@ def workaround_ade_quirks(self):  # {{{
                     ws = style.getPropertyValue('white-space')
                     if ws == 'pre':
                         style.setProperty('white-space', 'pre-wrap')
+                stylesheet_changed(stylesheet.data)
 
     # }}}
 
@@ -127,6 +127,27 @@ def __init__(self, input, output, log, report_progress=DummyReporter(),
                    'of the conversion process a bug is occurring.')
         ),
 
+OptionRecommendation(name='parallel_transforms',
+            recommended_value=0, level=OptionRecommendation.LOW,
+            help=_('The number of worker processes used to run the transforms '
+                   'that process every HTML file in the book on its own, such '
+                   'as linearizing tables. Zero, the default, runs them in the '
+                   'conversion process. Using several processes can speed up the '
+                   'conversion of very large books. The output is the same '
+                   'either way.')
+        ),
+
+OptionRecommendation(name='memory_limit',
+            recommended_value=0, level=OptionRecommendation.LOW,
+            help=_('The approximate amount of memory, in MB, that the contents '
+                   'of the files in the book are allowed to use during the '
+                   'conversion. When it is exceeded, the least recently used '
+                   'files are moved out of memory into temporary files and '
+                   'read back when needed. Useful when converting very large '
+                   'books, such as comics, on machines with little memory. '
+                   'Zero, the default, means no limit.')
+        ),
+
 OptionRecommendation(name='input_profile',
             recommended_value='default', level=OptionRecommendation.LOW,
             choices=[x.short_name for x in input_profiles()],
@@ -1119,6 +1140,8 @@ def run(self):
             if self.for_regex_wizard:
                 return
             self.input_plugin.postprocess_book(self.oeb, self.opts, self.log)
+            if self.opts.memory_limit > 0:
+                self.oeb.set_memory_budget(self.opts.memory_limit * 1024 * 1024)
             self.opts.is_image_collection = self.input_plugin.is_image_collection
             pr = CompositeProgressReporter(0.34, 0.67, self.ui_reporter)
             self.flush()
@@ -1138,6 +1161,7 @@ def run(self):
         from calibre.ebooks.oeb.transforms.guide import Clean
         Clean()(self.oeb, self.opts)
         pr(0.1)
+        self.oeb.enforce_memory_budget()
         self.flush()
 
         self.opts.source = self.opts.input_profile
@@ -1149,11 +1173,13 @@ def run(self):
         MergeMetadata()(self.oeb, self.user_metadata, self.opts,
                 override_input_metadata=self.override_input_metadata)
         pr(0.2)
+        self.oeb.enforce_memory_budget()
         self.flush()
 
         from calibre.ebooks.oeb.transforms.structure import DetectStructure
         DetectStructure()(self.oeb, self.opts)
         pr(0.35)
+        self.oeb.enforce_memory_budget()
         self.flush()
 
         if self.output_plugin.file_type not in ('epub', 'kepub'):
@@ -1180,6 +1206,7 @@ def run(self):
         from calibre.ebooks.oeb.transforms.jacket import Jacket
         Jacket()(self.oeb, self.opts, self.user_metadata)
         pr(0.4)
+        self.oeb.enforce_memory_budget()
         self.flush()
 
         if self.opts.debug_pipeline is not None:
@@ -1227,6 +1254,8 @@ def run(self):
                 specializer=partial(self.output_plugin.specialize_css_for_output,
                     self.log, self.opts))
         flattener(self.oeb, self.opts)
+        # The stylizers of the flattener reference the elements of every file
+        del flattener
         self.opts._final_base_font_size = fbase
 
         self.opts.insert_blank_line = oibl
@@ -1246,6 +1275,7 @@ def run(self):
             SubsetFonts()(self.oeb, self.log, self.opts)
 
         pr(0.9)
+        self.oeb.enforce_memory_budget()
         self.flush()
 
         from calibre.ebooks.oeb.transforms.trimmanifest import ManifestTrimmer
@@ -1256,6 +1286,7 @@ def run(self):
 
         self.oeb.toc.rationalize_play_orders()
         pr(1.)
+        self.oeb.enforce_memory_budget()
         self.flush()
 
         if self.opts.debug_pipeline is not None:
@@ -1270,6 +1301,8 @@ def run(self):
         with self.output_plugin:
             self.output_plugin.convert(self.oeb, self.output, self.input_plugin,
                 self.opts, self.log)
+        if self.oeb.memory_budget is not None:
+            self.oeb.memory_budget.report()
         self.oeb.clean_temp_files()
         self.ui_reporter(1.)
         run_plugins_on_postprocess(self.output, self.output_fmt)
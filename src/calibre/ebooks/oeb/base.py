@@ -1021,7 +1021,8 @@ def data(self):
               object with no special parsing.
             """
             data = self._data
-            if data is None:
+            loaded = data is None
+            if loaded:
                 if self._loader is None:
                     return None
                 data = self._loader(getattr(self, 'html_input_href',
@@ -1044,15 +1045,21 @@ def data(self):
                 data = self._parse_txt(data)
                 self.media_type = XHTML_MIME
             self._data = data
+            if self.oeb.memory_budget is not None:
+                self.oeb.memory_budget.touch(self, loaded)
             return data
 
         @data.setter
         def data(self, value):
             self._data = value
+            if self.oeb.memory_budget is not None:
+                self.oeb.memory_budget.forget(self)
 
         @data.deleter
         def data(self):
             self._data = None
+            if self.oeb.memory_budget is not None:
+                self.oeb.memory_budget.forget(self)
 
         def unload_data_from_memory(self, memory=None):
             if isinstance(self._data, bytes):
@@ -1068,6 +1075,8 @@ def loader(*args):
                             ans = f.read()
                         os.remove(pt.name)
                         return ans
+                    # The data cannot be read again, see MemoryBudget.touch()
+                    loader.one_shot = True
                     self._loader = loader
                 else:
                     def loader2(*args):
@@ -1076,6 +1085,8 @@ def loader2(*args):
                         return ans
                     self._loader = loader2
                 self._data = None
+                if self.oeb.memory_budget is not None:
+                    self.oeb.memory_budget.forget(self)
 
         @property
         def unicode_representation(self):
@@ -1178,6 +1189,8 @@ def remove(self, item):
         self.items.remove(item)
         if item in self.oeb.spine:
             self.oeb.spine.remove(item)
+        if self.oeb.memory_budget is not None:
+            self.oeb.memory_budget.forget(item)
 
     def remove_duplicate_item(self, item):
         if item in self.ids:
@@ -1805,6 +1818,25 @@ def __init__(self, logger,
         self.pages = PageList()
         self.auto_generated_toc = True
         self._temp_files = []
+        self.memory_budget = None
+        # The pool of worker processes used by transforms, see
+        # calibre.ebooks.oeb.transforms.parallel
+        self.transform_pool = None
+
+    def set_memory_budget(self, max_size):
+        """Limit the memory used by the data of the manifest items to roughly
+        :param:`max_size` bytes, by dropping the data of the least recently
+        used items and reading it back when needed. Parsed XML trees are only
+        dropped by calls to :meth:`enforce_memory_budget`."""
+        from calibre.ebooks.oeb.memory_budget import MemoryBudget
+        self.memory_budget = MemoryBudget(self, max_size)
+
+    def enforce_memory_budget(self):
+        """Drop data, including parsed XML trees, until the memory budget, if
+        any, is met. Must only be called when no references to the elements of
+        the XML trees are held, for instance, between transforms."""
+        if self.memory_budget is not None:
+            self.memory_budget.enforce(spill_trees=True)
 
     def clean_temp_files(self):
         for path in self._temp_files:
@@ -1812,6 +1844,11 @@ def clean_temp_files(self):
                 os.remove(path)
             except:
                 pass
+        if self.memory_budget is not None:
+            self.memory_budget.cleanup()
+        if self.transform_pool is not None:
+            self.transform_pool.shutdown()
+            self.transform_pool = None
 
     @classmethod
     def generate(cls, opts):
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Keep the data of the manifest items of an OEBBook within a memory budget.
+When the budget is exceeded, the data of the least recently used items is
+dropped from memory. Data that is still the same as what the item loader
+returns, such as images that have not been modified since they were read from
+the input container, is simply read again when needed. Other data is written
+to a temporary file and read back from it when needed.
+
+Raw data can be dropped whenever the budget is exceeded. Parsed XML trees are
+only dropped at checkpoints, between the stages of the conversion, as the
+transforms hold references to their elements while they run.
+'''
+
+import os
+import shutil
+from collections import OrderedDict
+
+from lxml import etree
+
+from calibre.ptempfile import PersistentTemporaryDirectory
+from calibre.utils.xml_parse import safe_xml_fromstring
+from polyglot.builtins import unicode_type
+
+# Approximate memory used by a parsed element or CSS rule, excluding its text
+ELEMENT_SIZE = 200
+CSS_RULE_SIZE = 1000
+
+
+def estimated_size(data):
+    if isinstance(data, bytes):
+        return len(data)
+    if isinstance(data, unicode_type):
+        return 4 * len(data)
+    if isinstance(data, etree._Element):
+        return sum(ELEMENT_SIZE + len(e.text or '') + len(e.tail or '') for e in data.iter())
+    rules = getattr(data, 'cssRules', None)
+    if rules is not None:
+        return CSS_RULE_SIZE * len(rules)
+    return 0
+
+
+def serialize_tree(root):
+    # The whole tree is serialized, so that the doctype and any comments or
+    # processing instructions outside the root element are preserved
+    return etree.tostring(root.getroottree(), encoding='utf-8')
+
+
+class MemoryBudget(object):
+
+    def __init__(self, oeb, max_size):
+        self.oeb, self.max_size = oeb, max_size
+        # item -> estimated size of its data, least recently used first
+        self.resident = OrderedDict()
+        # item -> id of its data, when that data is what its loader returns
+        self.clean = {}
+        self.size = self.peak_size = 0
+        self.spill_dir = None
+        self.spill_paths = {}
+        self.num_spilled = self.num_dropped = self.num_reloaded = self.bytes_written = 0
+
+    def touch(self, item, loaded=False):
+        ''' Must be called whenever the data of item is accessed. loaded is
+        True if the data was just created by the item loader. Such data can
+        be dropped and read again, unless the loader can only be called once,
+        as is the case for the loaders installed by
+        Manifest.Item.unload_data_from_memory(). '''
+        size = self.resident.get(item)
+        if size is None:
+            data = item._data
+            size = self.resident[item] = estimated_size(data)
+            if loaded and isinstance(data, bytes) and not getattr(item._loader, 'one_shot', False):
+                self.clean[item] = id(data)
+            self.size += size
+            if self.size > self.peak_size:
+                self.peak_size = self.size
+            if self.size > self.max_size:
+                self.enforce(exclude=item)
+        else:
+            self.resident.move_to_end(item)
+
+    def forget(self, item):
+        ' Must be called when the data of item is changed or removed '
+        size = self.resident.pop(item, None)
+        if size is not None:
+            self.size -= size
+        self.clean.pop(item, None)
+
+    def enforce(self, spill_trees=False, exclude=None):
+        ''' Drop the data of the least recently used items until the budget is
+        met. Parsed XML trees are dropped only when spill_trees is True. '''
+        if spill_trees:
+            # The trees may have been modified since their size was estimated
+            for item, size in tuple(self.resident.items()):
+                if isinstance(item._data, etree._Element):
+                    new_size = estimated_size(item._data)
+                    self.resident[item] = new_size
+                    self.size += new_size - size
+            self.peak_size = max(self.peak_size, self.size)
+        for item in tuple(self.resident):
+            if self.size <= self.max_size:
+                break
+            data = item._data
+            if data is None:
+                self.forget(item)
+            elif item is not exclude and (isinstance(data, bytes) or (spill_trees and isinstance(data, etree._Element))):
+                self.drop(item)
+
+    def drop(self, item):
+        data = item._data
+        if self.clean.get(item) == id(data):
+            self.num_dropped += 1
+        elif isinstance(data, bytes):
+            item._loader = self.spill(item, data, None)
+        else:
+            item._loader = self.spill(item, serialize_tree(data), safe_xml_fromstring)
+        self.forget(item)
+        item._data = None
+
+    def spill(self, item, raw, parse):
+        path = self.spill_paths.get(item)
+        if path is None:
+            if self.spill_dir is None:
+                self.spill_dir = PersistentTemporaryDirectory('_oeb_spill')
+            path = self.spill_paths[item] = os.path.join(self.spill_dir, '%d' % len(self.spill_paths))
+        with open(path, 'wb') as f:
+            f.write(raw)
+        self.num_spilled += 1
+        self.bytes_written += len(raw)
+
+        def loader(*args):
+            with open(path, 'rb') as f:
+                raw = f.read()
+            self.num_reloaded += 1
+            return raw if parse is None else parse(raw)
+        return loader
+
+    def report(self):
+        mb = 1024 * 1024
+        self.oeb.log('Memory budget: %.1f MB, peak estimated usage: %.1f MB' % (self.max_size / mb, self.peak_size / mb))
+        self.oeb.log('Memory budget: %d items written to disk (%.1f MB), %d unchanged items dropped, %d items read back from disk' % (
+            self.num_spilled, self.bytes_written / mb, self.num_dropped, self.num_reloaded))
+
+    def cleanup(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+
+def find_tests():
+    import unittest
+    from calibre.ebooks.oeb.base import OEBBook, XHTML_MIME
+    from calibre.utils.logging import DevNull
+
+    class Test(unittest.TestCase):
+
+        def test_memory_budget(self):
+            oeb = OEBBook(DevNull(), None)
+            expected = {}
+            try:
+                # Images whose data was set, whose data is read by a loader
+                # that can be called repeatedly, and whose data was unloaded
+                # by unload_data_from_memory() with a loader that can only be
+                # called once
+                for i in range(4):
+                    expected['set%d.png' % i] = os.urandom(1000)
+                    oeb.manifest.add('set%d' % i, 'set%d.png' % i, 'image/png', data=expected['set%d.png' % i])
+                    expected['loaded%d.png' % i] = os.urandom(1000)
+                    oeb.manifest.add('loaded%d' % i, 'loaded%d.png' % i, 'image/png', loader=expected.__getitem__)
+                expected['unloaded.png'] = os.urandom(1000)
+                oeb.manifest.add('unloaded', 'unloaded.png', 'image/png', data=expected['unloaded.png']).unload_data_from_memory()
+                trees = []
+                for i in range(4):
+                    html = ('<!DOCTYPE html>\n<html xmlns="http://www.w3.org/1999/xhtml"><head><title>{0}</title></head>'
+                            '<body>{1}</body></html>').format(i, '<p>paragraph</p>' * 20)
+                    trees.append(oeb.manifest.add('c%d' % i, 'chapter%d.html' % i, XHTML_MIME, data=safe_xml_fromstring(html)))
+                    expected[trees[-1].href] = serialize_tree(trees[-1].data)
+                oeb.set_memory_budget(2500)
+                budget = oeb.memory_budget
+
+                def check():
+                    for item in sorted(oeb.manifest.items, key=lambda item: item.href):
+                        data = item.data
+                        if isinstance(data, bytes):
+                            self.assertEqual(data, expected[item.href], item.href)
+                        else:
+                            self.assertEqual(serialize_tree(data), expected[item.href], item.href)
+
+                for i in range(3):
+                    check()
+                    # Trees are only dropped at checkpoints
+                    for item in trees:
+                        self.assertIsNotNone(item._data)
+                self.assertGreater(budget.num_spilled, 0)
+                self.assertGreater(budget.num_dropped, 0)
+                for i in range(3):
+                    oeb.enforce_memory_budget()
+                    self.assertLessEqual(budget.size, budget.max_size)
+                    self.assertTrue([item for item in trees if item._data is None])
+                    check()
+                self.assertGreater(budget.num_reloaded, 0)
+            finally:
+                oeb.clean_temp_files()
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(Test)
@@ -9,6 +9,8 @@
 __copyright__ = '2008, Marshall T. Vandegrift <llasram@gmail.com>'
 
 import os, re, logging, copy, unicodedata, numbers
+from collections import OrderedDict, defaultdict
+from itertools import chain
 from operator import itemgetter
 from weakref import WeakKeyDictionary
 from xml.dom import SyntaxErr as CSSSyntaxError
@@ -21,6 +23,8 @@
 from calibre.ebooks.oeb.base import XHTML, XHTML_NS, CSS_MIME, OEB_STYLES, xpath, urlnormalize
 from calibre.ebooks.oeb.normalize_css import DEFAULTS, normalizers
 from css_selectors import Select, SelectorError, INAPPROPRIATE_PSEUDO_CLASSES
+from css_selectors.parser import (
+    CombinedSelector, Class, Element, Hash, ascii_lower, parse)
 from polyglot.builtins import iteritems, unicode_type, filter
 from tinycss.media3 import CSSMedia3Parser
 
@@ -97,48 +101,158 @@ def test_media_ok():
     assert not media_ok('screen and (device-width:10px)')
 
 
+# Number of flattened stylesheets kept for use by the Stylizers of other
+# documents in the same book
+SHEET_CACHE_SIZE = 64
+
+
+def index_key(parsed_selector):
+    ''' Return the id, class or tag name that an element must have to match
+    parsed_selector, as a (kind, name) pair, or None if there is no such
+    requirement. Like in browsers, only the rightmost compound selector is
+    considered. '''
+    node = parsed_selector.parsed_tree
+    while isinstance(node, CombinedSelector):
+        node = node.subselector
+    key = None
+    while node is not None:
+        if isinstance(node, Hash):
+            return 'id', ascii_lower(node.id)
+        if isinstance(node, Class):
+            key = 'class', ascii_lower(node.class_name)
+        elif isinstance(node, Element):
+            if key is None and node.element and node.element != '*':
+                key = 'tag', ascii_lower(node.element)
+            break
+        # Negation, Attrib, Pseudo and Function all refine node.selector
+        node = getattr(node, 'selector', None)
+    return key
+
+
+# The number of times each stylesheet has been changed in place
+stylesheet_versions = WeakKeyDictionary()
+
+
+def stylesheet_changed(stylesheet):
+    ''' Must be called after the rules of stylesheet are changed in place, for
+    instance with removeProperty(), or rules are added to or removed from its
+    @media rules, so that the flattened rules from before the change are not
+    used again. Adding and removing top level rules is detected without it. '''
+    stylesheet_versions[stylesheet] = stylesheet_versions.get(stylesheet, 0) + 1
+
+
+def stylesheet_signature(stylesheet):
+    ''' Changes whenever top level rules are added to or removed from
+    stylesheet, or stylesheet_changed() is called for it. It is computed for
+    every document, so it must not serialize the rules. '''
+    return stylesheet_versions.get(stylesheet, 0), tuple(stylesheet.cssRules)
+
+
+class FlattenedStylesheet(object):
+
+    __slots__ = ('stylesheet', 'signature', 'rules', 'page_rule', 'font_face_rules', 'num_rules')
+
+    def __init__(self, stylesheet, signature):
+        self.stylesheet, self.signature = stylesheet, signature
+        self.rules = []
+        self.page_rule = {}
+        self.font_face_rules = []
+        self.num_rules = 0
+
+
 class StylizerRules(object):
 
-    def __init__(self, opts, profile, stylesheets):
+    def __init__(self, opts, profile, stylesheets, sheet_cache=None, signatures=None):
         self.opts, self.profile, self.stylesheets = opts, profile, stylesheets
+        if signatures is None:
+            signatures = list(map(stylesheet_signature, stylesheets))
+        self.signatures = signatures
+        # Stylesheets used by many documents, such as the ones in the
+        # manifest, are flattened and have their selectors parsed only once
+        self.sheet_cache = OrderedDict() if sheet_cache is None else sheet_cache
 
         index = 0
-        self.rules = []
+        rules = []
         self.page_rule = {}
         self.font_face_rules = []
         for sheet_index, stylesheet in enumerate(stylesheets):
+            flat = self.flatten_stylesheet(stylesheet, signatures[sheet_index])
+            sheet_specificity = (0 if sheet_index == 0 else 1,)
             href = stylesheet.href
+            for offset, specificity, selector, style, text, parsed in flat.rules:
+                rules.append((sheet_specificity + specificity + (index + offset,), selector, style, text, href, parsed))
+            self.page_rule.update(flat.page_rule)
+            self.font_face_rules.extend(flat.font_face_rules)
+            index += flat.num_rules
+        rules.sort(key=itemgetter(0))  # sort by specificity
+        self.rules = [r[:5] for r in rules]
+        self.parsed_selectors = [r[5] for r in rules]
+        self.build_index()
+
+    def flatten_stylesheet(self, stylesheet, signature):
+        key = id(stylesheet)
+        ans = self.sheet_cache.pop(key, None)
+        if ans is None or ans.stylesheet is not stylesheet or ans.signature != signature:
+            ans = FlattenedStylesheet(stylesheet, signature)
             for rule in stylesheet.cssRules:
                 if rule.type == rule.MEDIA_RULE:
                     if media_ok(rule.media.mediaText):
                         for subrule in rule.cssRules:
-                            self.rules.extend(self.flatten_rule(subrule, href, index, is_user_agent_sheet=sheet_index==0))
-                            index += 1
+                            self.flatten_rule(subrule, ans)
                 else:
-                    self.rules.extend(self.flatten_rule(rule, href, index, is_user_agent_sheet=sheet_index==0))
-                    index = index + 1
-        self.rules.sort(key=itemgetter(0))  # sort by specificity
+                    self.flatten_rule(rule, ans)
+        self.sheet_cache[key] = ans
+        while len(self.sheet_cache) > SHEET_CACHE_SIZE:
+            self.sheet_cache.popitem(last=False)
+        return ans
 
-    def flatten_rule(self, rule, href, index, is_user_agent_sheet=False):
-        results = []
-        sheet_index = 0 if is_user_agent_sheet else 1
+    def flatten_rule(self, rule, flat):
+        offset = flat.num_rules
+        flat.num_rules += 1
         if isinstance(rule, CSSStyleRule):
             style = self.flatten_style(rule.style)
             for selector in rule.selectorList:
-                specificity = (sheet_index,) + selector.specificity + (index,)
                 text = selector.selectorText
-                selector = list(selector.seq)
-                results.append((specificity, selector, style, text, href))
+                try:
+                    parsed = parse(text)
+                except SelectorError as err:
+                    parsed = err
+                flat.rules.append((offset, selector.specificity, list(selector.seq), style, text, parsed))
         elif isinstance(rule, CSSPageRule):
             style = self.flatten_style(rule.style)
-            self.page_rule.update(style)
+            flat.page_rule.update(style)
         elif isinstance(rule, CSSFontFaceRule):
             if rule.style.length > 1:
                 # Ignore the meaningless font face rules generated by the
                 # benighted MS Word that contain only a font-family declaration
                 # and nothing else
-                self.font_face_rules.append(rule)
-        return results
+                flat.font_face_rules.append(rule)
+
+    def build_index(self):
+        ''' Bucket the rules by the id, class or tag name that elements must
+        have to match them, so that only the rules that can match something
+        in a document are run on it. '''
+        self.index = {'id': defaultdict(list), 'class': defaultdict(list), 'tag': defaultdict(list)}
+        self.unindexed_rules = []
+        for i, parsed in enumerate(self.parsed_selectors):
+            keys = () if isinstance(parsed, SelectorError) else tuple(map(index_key, parsed))
+            if not keys or None in keys:
+                self.unindexed_rules.append(i)
+            else:
+                for kind, name in keys:
+                    self.index[kind][name].append(i)
+
+    def candidate_rules(self, select):
+        ''' The indices into self.rules of the rules that can match elements
+        in the tree of select, in order of specificity '''
+        ans = set(self.unindexed_rules)
+        for kind, names in (('id', select.id_map), ('class', select.class_map), ('tag', select.element_map)):
+            index = self.index[kind]
+            if len(index) < len(names):
+                ans.update(chain.from_iterable(rules for name, rules in iteritems(index) if name in names))
+            else:
+                ans.update(chain.from_iterable(index[name] for name in names if name in index))
+        return sorted(ans)
 
     def flatten_style(self, cssstyle):
         style = {}
@@ -169,7 +283,7 @@ def _apply_text_align(self, text):
             text = self.opts.change_justification
         return text
 
-    def same_rules(self, opts, profile, stylesheets):
+    def same_rules(self, opts, profile, stylesheets, signatures):
         if self.opts != opts:
             # it's unlikely to happen, but better safe than sorry
             return False
@@ -180,7 +294,8 @@ def same_rules(self, opts, profile, stylesheets):
         for index, stylesheet in enumerate(self.stylesheets):
             if stylesheet != stylesheets[index]:
                 return False
-        return True
+        # The stylesheets may have been changed in place
+        return self.signatures == signatures
 
 
 class Stylizer(object):
@@ -289,23 +404,35 @@ def __init__(self, tree, path, oeb, opts, profile=None,
 
         # using oeb to store the rules, page rule and font face rules
         # and generating them again if opts, profile or stylesheets are different
-        if (not hasattr(self.oeb, 'stylizer_rules')) \
-            or not self.oeb.stylizer_rules.same_rules(self.opts, self.profile, stylesheets):
-            self.oeb.stylizer_rules = StylizerRules(self.opts, self.profile, stylesheets)
-        self.rules = self.oeb.stylizer_rules.rules
-        self.page_rule = self.oeb.stylizer_rules.page_rule
-        self.font_face_rules = self.oeb.stylizer_rules.font_face_rules
-        self.flatten_style = self.oeb.stylizer_rules.flatten_style
+        # the flattened stylesheets are shared with the rules of other
+        # documents that have the same opts and profile
+        stylizer_rules = getattr(self.oeb, 'stylizer_rules', None)
+        signatures = list(map(stylesheet_signature, stylesheets))
+        if stylizer_rules is None or not stylizer_rules.same_rules(self.opts, self.profile, stylesheets, signatures):
+            sheet_cache = None
+            if stylizer_rules is not None and stylizer_rules.opts == self.opts and stylizer_rules.profile == self.profile:
+                sheet_cache = stylizer_rules.sheet_cache
+            self.oeb.stylizer_rules = stylizer_rules = StylizerRules(self.opts, self.profile, stylesheets, sheet_cache, signatures)
+        self.rules = stylizer_rules.rules
+        self.page_rule = stylizer_rules.page_rule
+        self.font_face_rules = stylizer_rules.font_face_rules
+        self.flatten_style = stylizer_rules.flatten_style
 
         self._styles = {}
         pseudo_pat = re.compile(':{1,2}(%s)' % ('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
         select = Select(tree, ignore_inappropriate_pseudo_classes=True)
 
-        for _, _, cssdict, text, _ in self.rules:
+        for i in stylizer_rules.candidate_rules(select):
+            _, _, cssdict, text, _ = self.rules[i]
             fl = pseudo_pat.search(text)
-            try:
-                matches = tuple(select(text))
-            except SelectorError as err:
+            parsed = err = stylizer_rules.parsed_selectors[i]
+            if not isinstance(err, SelectorError):
+                err = None
+                try:
+                    matches = tuple(select.select_parsed(parsed))
+                except SelectorError as e:
+                    err = e
+            if err is not None:
                 self.logger.error('Ignoring CSS rule with invalid selector: %r (%s)' % (text, as_unicode(err)))
                 continue
 
@@ -806,3 +933,126 @@ def pseudo_classes(self, filter_css):
     @property
     def is_hidden(self):
         return self._style.get('display') == 'none' or self._style.get('visibility') == 'hidden'
+
+
+def benchmark(num_chapters=500, num_classes=2000):
+    ''' Time the styling of a synthetic book with many chapters that share a
+    large stylesheet. Run with:
+    calibre-debug -c "from calibre.ebooks.oeb.stylizer import benchmark; benchmark()" '''
+    import time
+    from calibre.customize.ui import output_profiles
+    from calibre.ebooks.oeb.base import OEBBook, XHTML_MIME
+    from calibre.utils.logging import default_log
+    from calibre.utils.xml_parse import safe_xml_fromstring
+    from polyglot.builtins import range
+
+    class Options(object):
+        change_justification = 'original'
+        output_profile = [x for x in output_profiles() if x.short_name == 'default'][0]
+
+    oeb = OEBBook(default_log, None)
+    css = '\n'.join(
+        'p.c%d { margin-left: %dpt }\ndiv#s%d > span.c%d em { font-weight: bold }\n.c%d:first-child { text-indent: 1em }' % (
+            i, i % 20, i, i, i) for i in range(num_classes))
+    oeb.manifest.add('css', 'styles.css', CSS_MIME, data=parseString(css, validate=False))
+    items = []
+    for c in range(num_chapters):
+        body = ''.join(
+            '<div id="s{0}"><p class="c{0}">Paragraph <span class="c{0}"><em>{1}</em></span></p></div>'.format(
+                (c * 10 + i) % num_classes, i) for i in range(50))
+        html = ('<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Chapter {0}</title>'
+                '<link rel="stylesheet" type="text/css" href="styles.css"/></head><body>{1}</body></html>').format(c, body)
+        items.append(oeb.manifest.add('c%d' % c, 'chapter%d.html' % c, XHTML_MIME, data=safe_xml_fromstring(html)))
+    opts = Options()
+    st = time.monotonic()
+    for item in items:
+        Stylizer(item.data, item.href, oeb, opts)
+    elapsed = time.monotonic() - st
+    print('Styled {} chapters with {} rules in {:.2f} seconds ({:.1f} ms per chapter)'.format(
+        num_chapters, len(oeb.stylizer_rules.rules), elapsed, 1000 * elapsed / num_chapters))
+
+
+def find_tests():
+    import unittest
+    from calibre.customize.ui import output_profiles
+    from calibre.ebooks.oeb.base import OEBBook, XHTML_MIME
+    from calibre.utils.logging import DevNull
+    from calibre.utils.xml_parse import safe_xml_fromstring
+
+    class Options(object):
+        change_justification = 'original'
+        output_profile = [x for x in output_profiles() if x.short_name == 'default'][0]
+
+    css = '''
+    * { line-height: 1.2 }
+    p { margin-top: 1pt }
+    .a { color: red }
+    p.a, #x { font-weight: bold }
+    div > p.b:first-child { text-indent: 2em }
+    [lang] { font-style: italic }
+    span.a em, div#y { text-decoration: underline }
+    p:nth-child(2n) { color: blue }
+    p:first-letter { font-size: 2em }
+    P.B { margin-left: 3pt }
+    @media screen { .b { font-size: 20pt } }
+    @media print { .b { font-size: 5pt } }
+    '''
+    docs = (
+        '<div id="y"><p class="a" id="x">one <span class="a"><em>em</em></span></p><p class="b" lang="en">two</p></div>',
+        '<style>.c { color: purple } h1 + p { margin: 0 } .b { color: green }</style>'
+        '<h1 class="c">Title</h1><p>after</p><div><p class="b a">b</p><p style="color: black">s</p></div>',
+        '<p>no classes</p><table><tr><td class="b">cell</td></tr></table>',
+    )
+
+    def create_book():
+        oeb = OEBBook(DevNull(), None)
+        oeb.manifest.add('css', 'styles.css', CSS_MIME, data=parseString(css, validate=False))
+        for i, body in enumerate(docs):
+            html = ('<html xmlns="http://www.w3.org/1999/xhtml"><head><title>{0}</title>'
+                    '<link rel="stylesheet" type="text/css" href="styles.css"/></head><body>{1}</body></html>').format(i, body)
+            oeb.manifest.add('c%d' % i, 'chapter%d.html' % i, XHTML_MIME, data=safe_xml_fromstring(html))
+        return oeb
+
+    def computed_styles(oeb):
+        ans = []
+        for item in sorted(oeb.manifest.items, key=lambda item: item.href):
+            if item.media_type == XHTML_MIME:
+                stylizer = Stylizer(item.data, item.href, oeb, Options())
+                for elem in item.data.iter('*'):
+                    style = stylizer.style(elem)
+                    ans.append((item.href, elem.tag, dict(elem.attrib), style._style, style._pseudo_classes))
+        return ans
+
+    class Test(unittest.TestCase):
+
+        def test_rule_index(self):
+            oeb = create_book()
+            indexed = computed_styles(oeb)
+            orig = StylizerRules.candidate_rules
+            StylizerRules.candidate_rules = lambda self, select: range(len(self.rules))
+            try:
+                unindexed = computed_styles(create_book())
+            finally:
+                StylizerRules.candidate_rules = orig
+            self.assertEqual(indexed, unindexed)
+            self.assertIn(('color', 'red'), [x for s in indexed for x in iteritems(s[3])])
+
+        def test_stylesheet_changed_in_place(self):
+            oeb = create_book()
+            before = computed_styles(oeb)
+            sheet = oeb.manifest.hrefs['styles.css'].data
+            rule = [r for r in sheet.cssRules if r.type == r.STYLE_RULE and r.selectorText == '.a'][0]
+            rule.style.removeProperty('color')
+            stylesheet_changed(sheet)
+            after = computed_styles(oeb)
+            self.assertNotEqual(before, after)
+            oeb.stylizer_rules = None
+            self.assertEqual(after, computed_styles(oeb))
+            # Added top level rules are detected without stylesheet_changed()
+            sheet.insertRule('.a { color: orange }', len(sheet.cssRules))
+            added = computed_styles(oeb)
+            self.assertIn(('color', 'orange'), [x for s in added for x in iteritems(s[3])])
+            oeb.stylizer_rules = None
+            self.assertEqual(added, computed_styles(oeb))
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(Test)
@@ -6,11 +6,14 @@
 __copyright__ = '2009, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-from calibre.ebooks.oeb.base import OEB_DOCS, XPath, XHTML
+from calibre.ebooks.oeb.base import XPath, XHTML
+from calibre.ebooks.oeb.transforms.parallel import run_per_item
 
 
 class LinearizeTables(object):
 
+    per_item = True
+
     def linearize(self, root):
         for x in XPath('//h:table|//h:td|//h:tr|//h:th|//h:caption|'
                 '//h:tbody|//h:tfoot|//h:thead|//h:colgroup|//h:col')(root):
@@ -23,7 +26,7 @@ def linearize(self, root):
                 if attr in x.attrib:
                     del x.attrib[attr]
 
+    transform_item = linearize
+
     def __call__(self, oeb, context):
-        for x in oeb.manifest.items:
-            if x.media_type in OEB_DOCS:
-                self.linearize(x.data)
+        run_per_item(self, oeb, context)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Run transforms that process every HTML document in the book on its own, in a
+pool of worker processes. Such transforms have a true per_item attribute and a
+transform_item(root) method that changes a single document in place. They must
+be constructible with no arguments, as they are created again in the workers.
+All other transforms work on the whole book and are run in the conversion
+process. Documents are sent to the workers serialized and the transformed
+documents are parsed back, so the result is the same as that of transforming
+them in the conversion process.
+'''
+
+from lxml import etree
+
+from calibre.ebooks.oeb.base import OEB_DOCS
+from calibre.utils.xml_parse import safe_xml_fromstring
+
+# Books with fewer documents than this are not worth starting worker processes for
+MIN_ITEMS = 8
+
+
+def serialize(root):
+    # The whole tree is serialized, so that the doctype and any comments or
+    # processing instructions outside the root element are preserved
+    return etree.tostring(root.getroottree(), encoding='utf-8')
+
+
+def transform_in_worker(module, name, raw):
+    ' Run in the worker processes '
+    from importlib import import_module
+    transform = getattr(import_module(module), name)()
+    root = safe_xml_fromstring(raw)
+    transform.transform_item(root)
+    return serialize(root)
+
+
+def transform_pool(oeb, num_workers):
+    ''' The pool of worker processes shared by all transforms run during the
+    conversion of oeb, it is shutdown by :meth:`OEBBook.clean_temp_files` '''
+    if oeb.transform_pool is None:
+        from calibre.utils.ipc.pool import Pool
+        oeb.transform_pool = Pool(max_workers=num_workers, name='ParallelTransforms')
+    return oeb.transform_pool
+
+
+def run_per_item(transform, oeb, opts):
+    ''' Run transform on every HTML document in oeb, using as many worker
+    processes as specified by the parallel_transforms conversion option '''
+    items = [item for item in oeb.manifest.items if item.media_type in OEB_DOCS]
+    num_workers = min(getattr(opts, 'parallel_transforms', 0) or 0, len(items))
+    results = {}
+    if num_workers > 1 and len(items) >= MIN_ITEMS:
+        results = run_in_workers(transform, items, transform_pool(oeb, num_workers), oeb.log)
+    for i, item in enumerate(items):
+        raw = results.get(i)
+        if raw is None:
+            transform.transform_item(item.data)
+        else:
+            item.data = safe_xml_fromstring(raw)
+
+
+def run_in_workers(transform, items, pool, log):
+    from calibre.utils.ipc.pool import Failure
+    cls = transform.__class__
+    results = {}
+    if pool.failed:
+        # The pool was shutdown after a worker crashed in a previous transform
+        return results
+    try:
+        for i, item in enumerate(items):
+            pool(i, __name__, 'transform_in_worker', cls.__module__, cls.__name__, serialize(item.data))
+        pool.wait_for_tasks()
+    except Failure as err:
+        # Documents that were not transformed are transformed in this process
+        log.warn('Running %s in worker processes failed with error: %s\n%s' % (cls.__name__, err.failure_message, err.details))
+    finally:
+        while not pool.results.empty():
+            r = pool.results.get()
+            if not r.is_terminal_failure and r.result.err is None:
+                results[r.id] = r.result.value
+    return results
+
+
+def create_book(num_items, num_paragraphs=10):
+    ''' Create a book with documents that the per item transforms change,
+    for testing and benchmarking '''
+    from calibre.ebooks.oeb.base import OEBBook, XHTML_MIME
+    from calibre.utils.logging import DevNull
+    oeb = OEBBook(DevNull(), None)
+    para = (
+        '<p>\u201cQuoted\u201d text \u2014 with \u2018smart\u2019 punctuation\u2026</p>'
+        '<table border="1"><tr><td width="10">{0}</td><td valign="top">\u2018cell\u2019</td></tr></table>'
+        '<pre>\u201cpreformatted\u201d</pre><!-- comment -->')
+    for i in range(num_items):
+        body = ''.join(para.format(j) for j in range(num_paragraphs))
+        html = (
+            '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n<?pi data?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>{0}</title></head><body>{1}</body></html>').format(i, body)
+        oeb.manifest.add('c%d' % i, 'chapter%d.html' % i, XHTML_MIME, data=safe_xml_fromstring(html.encode('utf-8')))
+    return oeb
+
+
+def per_item_transforms():
+    from calibre.ebooks.oeb.transforms.linearize_tables import LinearizeTables
+    from calibre.ebooks.oeb.transforms.unsmarten import UnsmartenPunctuation
+    return LinearizeTables, UnsmartenPunctuation
+
+
+class Options(object):
+
+    def __init__(self, parallel_transforms):
+        self.parallel_transforms = parallel_transforms
+
+
+def benchmark(num_items=200, num_paragraphs=200, num_workers=4):
+    ''' Time the per item transforms on a synthetic book, in this process and
+    in worker processes. Run with:
+    calibre-debug -c "from calibre.ebooks.oeb.transforms.parallel import benchmark; benchmark()" '''
+    import time
+    for n in (0, num_workers):
+        oeb = create_book(num_items, num_paragraphs)
+        st = time.monotonic()
+        try:
+            for transform in per_item_transforms():
+                transform()(oeb, Options(n))
+        finally:
+            oeb.clean_temp_files()
+        print('%d documents with %d worker processes: %.2f seconds' % (num_items, n, time.monotonic() - st))
+
+
+def find_tests():
+    import unittest
+
+    class Test(unittest.TestCase):
+
+        def test_parallel_transforms(self):
+            results = []
+            for num_workers in (0, 2):
+                oeb = create_book(MIN_ITEMS + 2)
+                try:
+                    for transform in per_item_transforms():
+                        transform()(oeb, Options(num_workers))
+                    if num_workers:
+                        # One pool is used for all transforms
+                        self.assertIsNotNone(oeb.transform_pool)
+                        self.assertFalse(oeb.transform_pool.failed)
+                    else:
+                        self.assertIsNone(oeb.transform_pool)
+                    results.append([serialize(item.data) for item in sorted(oeb.manifest.items, key=lambda item: item.href)])
+                finally:
+                    oeb.clean_temp_files()
+                self.assertIsNone(oeb.transform_pool)
+            serial, parallel = results
+            self.assertEqual(len(serial), MIN_ITEMS + 2)
+            self.assertEqual(serial, parallel)
+            self.assertNotIn(b'<table', serial[0])
+            self.assertNotIn('\u201c'.encode('utf-8'), serial[0].partition(b'<pre>')[0])
+            self.assertIn(b'<!DOCTYPE html>', serial[0])
+            self.assertIn(b'<?pi data?>', serial[0])
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(Test)
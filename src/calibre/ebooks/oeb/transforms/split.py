@@ -20,6 +20,7 @@
 from calibre.ebooks.oeb.base import (OEB_STYLES, XPNSMAP as NAMESPACES,
         urldefrag, rewrite_links, XHTML, urlnormalize)
 from calibre.ebooks.oeb.polish.split import do_split
+from calibre.ebooks.oeb.stylizer import stylesheet_changed
 from polyglot.builtins import iteritems, range, map, unicode_type
 from polyglot.urllib import unquote
 from css_selectors import Select, SelectorError
@@ -94,6 +95,7 @@ def find_page_breaks(self, item):
                         self.page_break_selectors.add((rule.selectorText, True))
                         if self.remove_css_pagebreaks:
                             rule.style.removeProperty('page-break-before')
+                            stylesheet_changed(rule.parentStyleSheet)
                 except:
                     pass
                 try:
@@ -101,6 +103,7 @@ def find_page_breaks(self, item):
                         self.page_break_selectors.add((rule.selectorText, False))
                         if self.remove_css_pagebreaks:
                             rule.style.removeProperty('page-break-after')
+                            stylesheet_changed(rule.parentStyleSheet)
                 except:
                     pass
         page_breaks = set()
@@ -5,14 +5,18 @@
 __copyright__ = '2011, John Schember <john@nachtimwald.com>'
 __docformat__ = 'restructuredtext en'
 
-from calibre.ebooks.oeb.base import OEB_DOCS, XPath, barename
+from calibre.ebooks.oeb.base import XPath, barename
+from calibre.ebooks.oeb.transforms.parallel import run_per_item
 from calibre.utils.unsmarten import unsmarten_text
 
 
 class UnsmartenPunctuation(object):
 
+    per_item = True
+
     def __init__(self):
         self.html_tags = XPath('descendant::h:*')
+        self.body_tags = XPath('//h:body')
 
     def unsmarten(self, root):
         for x in self.html_tags(root):
@@ -22,9 +26,9 @@ def unsmarten(self, root):
                 if getattr(x, 'tail', None) and x.tail:
                     x.tail = unsmarten_text(x.tail)
 
+    def transform_item(self, root):
+        for body in self.body_tags(root):
+            self.unsmarten(body)
+
     def __call__(self, oeb, context):
-        bx = XPath('//h:body')
-        for x in oeb.manifest.items:
-            if x.media_type in OEB_DOCS:
-                for body in bx(x.data):
-                    self.unsmarten(body)
+        run_per_item(self, oeb, context)
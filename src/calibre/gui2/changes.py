@@ -30,6 +30,8 @@ def handle_changes(changes, gui=None):
         elif isinstance(change, SavedSearchesChanged):
             ss_changed = True
 
+    if not (refresh_ids or added or removed or ss_changed):
+        return
     if added and removed:
         gui.refresh_all()
         return
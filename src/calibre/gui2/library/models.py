@@ -342,6 +342,7 @@ def col_idx(name):
         self.database_changed.emit(db)
         self.stop_metadata_backup()
         self.start_metadata_backup()
+        self.db.new_api.start_fts_indexer()
 
     def start_metadata_backup(self):
         from calibre.db.backup import MetadataBackup
@@ -17,6 +17,7 @@
 from calibre.srv.errors import HTTPNotFound, BookNotFound
 from calibre.srv.routes import endpoint, json
 from calibre.srv.content import get as get_content, icon as get_icon
+from calibre.srv.response_cache import cached_response
 from calibre.srv.utils import http_date, custom_fields_to_display, encode_name, decode_name, get_db
 from calibre.utils.config import prefs, tweaks
 from calibre.utils.date import isoformat, timestampfromdt
@@ -248,6 +249,10 @@ def categories(ctx, rd, library_id):
 
     '''
     db = get_db(ctx, rd, library_id)
+    return cached_response(ctx, rd, db, 'categories', partial(categories_as_list, ctx, rd, db))
+
+
+def categories_as_list(ctx, rd, db):
     with db.safe_read_lock:
         ans = {}
         categories = ctx.get_categories(rd, db, vl=rd.query.get('vl') or '')
@@ -568,12 +573,39 @@ def search(ctx, rd, library_id):
     db = get_db(ctx, rd, library_id)
     query = rd.query.get('query')
     num, offset = get_pagination(rd.query)
-    with db.safe_read_lock:
-        return search_result(ctx, rd, db, query, num, offset, rd.query.get('sort', 'title'), rd.query.get('sort_order', 'asc'), rd.query.get('vl') or '')
+
+    def generate():
+        with db.safe_read_lock:
+            return search_result(ctx, rd, db, query, num, offset, rd.query.get('sort', 'title'), rd.query.get('sort_order', 'asc'), rd.query.get('vl') or '')
+    return cached_response(ctx, rd, db, 'search', generate)
 
 # }}}
 
 
+@endpoint('/ajax/response-cache-stats', postprocess=json)
+def response_cache_stats(ctx, rd):
+    '''
+    Return the number of hits and misses of the response cache, in total and
+    for every endpoint that uses it, along with the amount of memory it uses.
+    Only available to users that are allowed to make changes.
+    '''
+    ctx.check_for_write_access(rd)
+    cache = ctx.response_cache
+    return {'enabled': False} if cache is None else dict(cache.stats(), enabled=True)
+
+
+@endpoint('/ajax/jobs-stats', postprocess=json)
+def jobs_stats(ctx, rd):
+    '''
+    Return the number of running and waiting jobs in each priority class, the
+    number of waiting jobs of each user, how long jobs have waited to be
+    started and whether jobs are being held back for lack of memory. Only
+    available to users that are allowed to make changes.
+    '''
+    ctx.check_for_write_access(rd)
+    return ctx.jobs_manager.stats()
+
+
 @endpoint('/ajax/library-info', postprocess=json)
 def library_info(ctx, rd):
     ' Return info about available libraries '
@@ -14,11 +14,14 @@
 
 from calibre.constants import cache_dir, iswindows
 from calibre.customize.ui import plugin_for_input_format
+from calibre.srv.changes import annotations
 from calibre.srv.errors import BookNotFound, HTTPNotFound
+from calibre.srv.jobs import PRIORITY_INTERACTIVE
 from calibre.srv.metadata import book_as_json
 from calibre.srv.render_book import RENDER_VERSION
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_library_data
+from calibre.utils.config_base import tweaks
 from calibre.utils.filenames import rmtree
 from calibre.utils.serialize import json_dumps
 from polyglot.builtins import as_unicode, itervalues, map
@@ -43,7 +46,7 @@ def books_cache_dir():
     if _books_cache_dir:
         return _books_cache_dir
     base = abspath(os.path.join(cache_dir(), 'srvb'))
-    for d in 'sf':
+    for d in 'sfr':
         try:
             os.makedirs(os.path.join(base, d))
         except EnvironmentError as e:
@@ -70,7 +73,7 @@ def safe_remove(x, is_file=None):
         pass
 
 
-def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
+def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime, user=None):
     global staging_cleaned
     tdir = os.path.join(books_cache_dir(), 's')
     if not staging_cleaned:
@@ -82,30 +85,81 @@ def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
         copy_format_to(f)
     tdir = tempfile.mkdtemp('', '', tdir)
     job_id = ctx.start_job('Render book %s (%s)' % (book_id, fmt), 'calibre.srv.render_book', 'render', args=(
-        pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}),
-        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir))
+        pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}), kwargs={'render_cache_dir': os.path.join(books_cache_dir(), 'r')},
+        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir), in_pool=True, priority=PRIORITY_INTERACTIVE, user=user)
     queued_jobs[bhash] = job_id
     return job_id
 
 
 last_final_clean_time = 0
+# An upper bound on the size of the cache, None when it is not known. The
+# cache is only scanned when this exceeds its maximum size.
+cache_size_estimate = None
 
 
-def clean_final(interval=24 * 60 * 60):
-    global last_final_clean_time
+def clean_final(interval=24 * 60 * 60, new_book=None):
+    ''' Called after the rendered book new_book has been stored. Removes the
+    least recently used rendered books and render cache entries when the cache
+    is larger than its maximum size and, once every interval seconds, the books
+    that have not been accessed for interval seconds. '''
+    global last_final_clean_time, cache_size_estimate
     now = time.time()
-    if now - last_final_clean_time < interval:
-        return
-    last_final_clean_time = now
+    max_size = tweaks['content_server_book_cache_size'] * 1024 * 1024
+    sweep = now - last_final_clean_time >= interval
+    if not sweep and cache_size_estimate is not None:
+        if new_book is not None:
+            # The render cache entries written for the book hold at most its
+            # rendered files, which are in its folder as well
+            cache_size_estimate += 2 * tree_size(new_book)
+        if cache_size_estimate <= max_size:
+            return
+    if sweep:
+        last_final_clean_time = now
     fdir = os.path.join(books_cache_dir(), 'f')
+    entries = []
     for x in os.listdir(fdir):
+        path = os.path.join(fdir, x)
         try:
-            tm = os.path.getmtime(os.path.join(fdir, x,  'calibre-book-manifest.json'))
+            tm = os.path.getmtime(os.path.join(path, 'calibre-book-manifest.json'))
         except EnvironmentError:
             continue
-        if now - tm >= interval:
+        if sweep and now - tm >= interval and path != new_book:
             # This book has not been accessed for a long time, delete it
-            safe_remove(x)
+            safe_remove(path, False)
+        else:
+            entries.append((tm, path, False, tree_size(path)))
+    rdir = os.path.join(books_cache_dir(), 'r')
+    for dirpath, dirnames, filenames in os.walk(rdir):
+        for x in filenames:
+            path = os.path.join(dirpath, x)
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            entries.append((st.st_mtime, path, True, st.st_size))
+    # Remove the least recently used rendered books and files until the cache
+    # fits in its maximum size, the book that was just rendered is kept, even
+    # if it is larger than that on its own, as it is about to be read
+    total = sum(e[-1] for e in entries)
+    entries.sort()
+    for tm, path, is_file, size in entries:
+        if total <= max_size:
+            break
+        if path != new_book:
+            safe_remove(path, is_file)
+            total -= size
+    cache_size_estimate = total
+
+
+def tree_size(path):
+    ans = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for x in filenames:
+            try:
+                ans += os.path.getsize(os.path.join(dirpath, x))
+            except EnvironmentError:
+                pass
+    return ans
 
 
 def job_done(job):
@@ -118,13 +172,18 @@ def job_done(job):
             safe_remove(tdir, False)
         else:
             try:
-                clean_final()
                 dest = os.path.join(books_cache_dir(), 'f', bhash)
                 safe_remove(dest, False)
                 os.rename(tdir, dest)
             except Exception:
                 import traceback
                 failed_jobs[bhash] = (False, traceback.format_exc())
+            else:
+                try:
+                    clean_final(new_book=dest)
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
 
 
 @endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int})
@@ -162,7 +221,7 @@ def book_manifest(ctx, rd, book_id, fmt):
                 return {'aborted':x[0], 'traceback':x[1], 'job_status':'finished'}
             job_id = queued_jobs.get(bhash)
             if job_id is None:
-                job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
+                job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime, rd.username)
     status, result, tb, aborted = ctx.job_status(job_id)
     return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
 
@@ -223,6 +282,7 @@ def set_last_read_position(ctx, rd, library_id, book_id, fmt):
         raise HTTPNotFound('Invalid data')
     db.set_last_read_position(
         book_id, fmt, user=user, device=device, cfi=cfi or None, pos_frac=pos_frac)
+    ctx.notify_changes(db.backend.library_path, annotations((book_id,)))
     rd.outheaders['Content-type'] = 'text/plain'
     return b''
 
@@ -268,6 +328,7 @@ def update_annotations(ctx, rd, library_id, book_id, fmt):
         if val:
             alist.extend(val)
     db.merge_annotations_for_book(book_id, fmt, alist, user_type='web', user=user)
+    ctx.notify_changes(db.backend.library_path, annotations((book_id,)))
     return b''
 
 
@@ -60,6 +60,16 @@ def __init__(self, book_ids):
         self.book_ids = frozenset(book_ids)
 
 
+class AnnotationsChanged(ChangeEvent):
+
+    ''' The annotations or last read positions of books were changed. They
+    are always read from the database, so no in-memory data is affected. '''
+
+    def __init__(self, book_ids):
+        ChangeEvent.__init__(self)
+        self.book_ids = frozenset(book_ids)
+
+
 class SavedSearchesChanged(ChangeEvent):
 
     def __init__(self, added=(), removed=()):
@@ -79,4 +89,5 @@ def __repr__(self):
 formats_removed = FormatsRemoved
 books_deleted = BooksDeleted
 metadata = MetadataChanged
+annotations = AnnotationsChanged
 saved_searches = SavedSearchesChanged
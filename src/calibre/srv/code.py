@@ -22,6 +22,7 @@
 from calibre.srv.metadata import (
     book_as_json, categories_as_json, categories_settings, icon_map
 )
+from calibre.srv.response_cache import cached_response
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data, get_use_roman
 from calibre.utils.config import prefs, tweaks
@@ -38,10 +39,10 @@
 
 @endpoint('', auth_required=False)
 def index(ctx, rd):
-    ans_file = lopen(P('content-server/index-generated.html'), 'rb')
     if not in_develop_mode:
-        return ans_file
-    return ans_file.read().replace(b'__IN_DEVELOP_MODE__', b'1')
+        return ctx.precompressed_store.open(P('content-server/index-generated.html'))
+    with lopen(P('content-server/index-generated.html'), 'rb') as f:
+        return f.read().replace(b'__IN_DEVELOP_MODE__', b'1')
 
 
 @endpoint('/robots.txt', auth_required=False)
@@ -231,15 +232,17 @@ def books(ctx, rd):
     Optional: ?num=50&sort=timestamp.desc&library_id=<default library>
               &search=''&extra_books=''&vl=''
     '''
-    ans = {}
     try:
         num = int(rd.query.get('num', rd.opts.num_per_page))
     except Exception:
         raise HTTPNotFound('Invalid number of books: %r' % rd.query.get('num'))
     library_id, db, sorts, orders, vl = get_basic_query_data(ctx, rd)
-    ans = get_library_init_data(ctx, rd, db, num, sorts, orders, vl)
-    ans['library_id'] = library_id
-    return ans
+
+    def generate():
+        ans = get_library_init_data(ctx, rd, db, num, sorts, orders, vl)
+        ans['library_id'] = library_id
+        return ans
+    return cached_response(ctx, rd, db, 'books', generate)
 
 
 @endpoint('/interface-data/init', postprocess=json)
@@ -250,26 +253,36 @@ def interface_data(ctx, rd):
     Optional: ?num=50&sort=timestamp.desc&library_id=<default library>
               &search=''&extra_books=''&vl=''
     '''
-    ans = basic_interface_data(ctx, rd)
+    library_map, default_library = ctx.library_info(rd)
     ud = {}
     if rd.username:
         # Override session data with stored values for the authenticated user,
         # if any
         ud = ctx.user_manager.get_session_data(rd.username)
         lid = ud.get('library_id')
-        if lid and lid in ans['library_map']:
+        if lid and lid in library_map:
             rd.query.set('library_id', lid)
         usort = ud.get('sort')
         if usort:
             rd.query.set('sort', usort)
-    ans['library_id'], db, sorts, orders, vl = get_basic_query_data(ctx, rd)
-    ans['user_session_data'] = ud
+    library_id, db, sorts, orders, vl = get_basic_query_data(ctx, rd)
     try:
         num = int(rd.query.get('num', rd.opts.num_per_page))
     except Exception:
         raise HTTPNotFound('Invalid number of books: %r' % rd.query.get('num'))
-    ans.update(get_library_init_data(ctx, rd, db, num, sorts, orders, vl))
-    return ans
+
+    def generate():
+        ans = basic_interface_data(ctx, rd)
+        ans['library_id'] = library_id
+        ans['user_session_data'] = ud
+        ans.update(get_library_init_data(ctx, rd, db, num, sorts, orders, vl))
+        return ans
+    # The basic interface data depends on the libraries the user can access
+    # and the output format preference, which can change without the library
+    # changing
+    return cached_response(
+        ctx, rd, db, 'interface_data', generate, json_dumps(ud), json_dumps(library_map),
+        default_library, prefs['output_format'])
 
 
 @endpoint('/interface-data/more-books', postprocess=json, methods=POSTABLE)
@@ -295,18 +308,20 @@ def more_books(ctx, rd):
         raise HTTPBadRequest('Search query missing key: %s' % as_unicode(err))
     except Exception as err:
         raise HTTPBadRequest('Invalid query: %s' % as_unicode(err))
-    ans = {}
-    with db.safe_read_lock:
-        ans['search_result'] = search_result(
-            ctx, rd, db, query, num, offset, sorts, orders, vl
-        )
-        mdata = ans['metadata'] = {}
-        for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
-            if data is not None:
-                mdata[book_id] = data
 
-    return ans
+    def generate():
+        ans = {}
+        with db.safe_read_lock:
+            ans['search_result'] = search_result(
+                ctx, rd, db, query, num, offset, sorts, orders, vl
+            )
+            mdata = ans['metadata'] = {}
+            for book_id in ans['search_result']['book_ids']:
+                data = book_as_json(db, book_id)
+                if data is not None:
+                    mdata[book_id] = data
+        return ans
+    return cached_response(ctx, rd, db, 'more_books', generate, json_dumps((query, offset, sorts, orders, vl)))
 
 
 @endpoint('/interface-data/set-session-data', postprocess=json, methods=POSTABLE)
@@ -6,7 +6,6 @@
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import os, errno
-from io import BytesIO
 from threading import Lock
 from polyglot.builtins import map, unicode_type
 from functools import partial
@@ -21,8 +20,8 @@
 from calibre.library.save_to_disk import find_plugboard
 from calibre.srv.errors import HTTPNotFound, BookNotFound
 from calibre.srv.routes import endpoint, json
+from calibre.srv.thumbnails import size_bucket, thumbnail_format
 from calibre.srv.utils import http_date, get_db, get_use_roman
-from calibre.utils.config_base import tweaks
 from calibre.utils.date import timestampfromdt
 from calibre.utils.img import scale_image, image_from_data
 from calibre.utils.filenames import ascii_filename, atomic_rename
@@ -140,20 +139,29 @@ def cover(ctx, rd, library_id, db, book_id, width=None, height=None):
     mtime = db.cover_last_modified(book_id)
     if mtime is None:
         return generated_cover(ctx, rd, library_id, db, book_id, width, height)
-    prefix = 'cover'
-    if width is None and height is None:
-        def copy_func(dest):
-            db.copy_cover_to(book_id, dest)
-    else:
-        prefix += '-%sx%s' % (width, height)
+    if width is not None or height is not None:
+        return thumbnail(ctx, rd, library_id, db, book_id, width, height, mtime)
+
+    def copy_func(dest):
+        db.copy_cover_to(book_id, dest)
+    return create_file_copy(ctx, rd, 'cover', library_id, book_id, 'jpg', mtime, copy_func)
 
-        def copy_func(dest):
-            buf = BytesIO()
-            db.copy_cover_to(book_id, buf)
-            quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
-            data = scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
-            dest.write(data)
-    return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, copy_func)
+
+def thumbnail(ctx, rd, library_id, db, book_id, width, height, mtime):
+    ''' Thumbnails are served from the thumbnail store, which renders each
+    size only once and is shared by all server processes '''
+    fmt = thumbnail_format(rd.inheaders.get('Accept'))
+    width, height = size_bucket(width, height)
+    try:
+        ans, used_cache = ctx.thumbnail_store.open(db, book_id, width, height, mtime, fmt)
+    except KeyError:
+        # The cover was removed after its mtime was read
+        return generated_cover(ctx, rd, library_id, db, book_id, width, height)
+    if ctx.testing:
+        rd.outheaders['Used-Cache'] = 'yes' if used_cache else 'no'
+    rd.outheaders['Content-Type'] = 'image/' + fmt
+    rd.outheaders['Vary'] = 'Accept'
+    return rd.filesystem_file_with_custom_etag(ans, 'thumb', db.library_id, book_id, width, height, mtime, fmt)
 
 
 def book_filename(rd, book_id, mi, fmt, as_encoded_unicode=False):
@@ -225,7 +233,7 @@ def static(ctx, rd, what):
     path = os.path.relpath(path, base).replace(os.sep, '/')
     path = P('content-server/' + path)
     try:
-        return share_open(path, 'rb')
+        return ctx.precompressed_store.open(path)
     except EnvironmentError:
         raise HTTPNotFound()
 
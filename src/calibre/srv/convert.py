@@ -145,7 +145,7 @@ def queue_job(ctx, rd, library_id, db, fmt, book_id, conversion_data):
         'Convert book %s (%s)' % (book_id, fmt), 'calibre.srv.convert',
         'convert_book', args=(
             src_file.name, opf_file.name, cover_path, conversion_data['output_fmt'], recs),
-        job_done_callback=job_done
+        job_done_callback=job_done, user=rd.username
     )
     expire_old_jobs()
     with cache_lock:
@@ -194,7 +194,7 @@ def conversion_status(ctx, rd, job_id):
             except NoSuchBook:
                 raise HTTPNotFound(
                     'book_id {} not found in library'.format(job_status.book_id))
-            formats_added({job_status.book_id: (fmt,)})
+            ctx.notify_changes(db.backend.library_path, formats_added({job_status.book_id: (fmt,)}))
             ans['size'] = os.path.getsize(job_status.output_path)
             ans['fmt'] = fmt
         return ans
@@ -10,9 +10,12 @@
 
 from calibre.srv.auth import AuthController
 from calibre.srv.errors import HTTPForbidden
+from calibre.srv.changes import BooksAdded, MetadataChanged
 from calibre.srv.library_broker import LibraryBroker, path_for_db
+from calibre.srv.jobs import PRIORITY_USER
 from calibre.srv.routes import Router
 from calibre.srv.users import UserManager
+from calibre.utils.config_base import tweaks
 from calibre.utils.date import utcnow
 from calibre.utils.search_query_parser import ParseException
 from polyglot.builtins import itervalues, filter, unicode_type
@@ -25,6 +28,7 @@ class Context(object):
     jobs_manager = None
     CATEGORY_CACHE_SIZE = 25
     SEARCH_CACHE_SIZE = 100
+    OPDS_ENTRY_CACHE_SIZE = 5000
 
     def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.opts = opts
@@ -35,13 +39,58 @@ def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.ignored_fields = frozenset(filter(None, (x.strip() for x in (opts.ignored_fields or '').split(','))))
         self.displayed_fields = frozenset(filter(None, (x.strip() for x in (opts.displayed_fields or '').split(','))))
         self._notify_changes = notify_changes
+        self._thumbnail_store = None
+        self._response_cache = False
+        self._precompressed_store = None
 
     def notify_changes(self, library_path, change_event):
         if self._notify_changes is not None:
             self._notify_changes(library_path, change_event)
+        if isinstance(change_event, (BooksAdded, MetadataChanged)):
+            for db in self.library_broker.loaded_dbs_for_path(library_path):
+                self.thumbnail_store.warm(db.new_api, change_event.book_ids)
 
-    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
-        return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data)
+    @property
+    def thumbnail_store(self):
+        with self.lock:
+            if self._thumbnail_store is None:
+                from calibre.srv.thumbnails import ThumbnailStore, default_store_path
+                if self.testing:
+                    from calibre.ptempfile import PersistentTemporaryDirectory
+                    path = PersistentTemporaryDirectory('srv-thumbnails')
+                else:
+                    path = default_store_path()
+                self._thumbnail_store = ThumbnailStore(path, tweaks['content_server_thumbnail_cache_size'] * 1024 * 1024)
+            return self._thumbnail_store
+
+    @property
+    def precompressed_store(self):
+        with self.lock:
+            if self._precompressed_store is None:
+                from calibre.srv.precompressed import PrecompressedStore, default_store_path
+                if self.testing:
+                    from calibre.ptempfile import PersistentTemporaryDirectory
+                    path = PersistentTemporaryDirectory('srv-precompressed')
+                else:
+                    path = default_store_path()
+                self._precompressed_store = PrecompressedStore(path)
+            return self._precompressed_store
+
+    @property
+    def response_cache(self):
+        ' The cache for JSON responses, None if it is disabled '
+        with self.lock:
+            if self._response_cache is False:
+                size = tweaks['content_server_response_cache_size']
+                if size > 0:
+                    from calibre.srv.response_cache import ResponseCache
+                    self._response_cache = ResponseCache(size * 1024 * 1024)
+                else:
+                    self._response_cache = None
+            return self._response_cache
+
+    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None, in_pool=False, priority=PRIORITY_USER, user=None):
+        return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data, in_pool, priority, user)
 
     def job_status(self, job_id):
         return self.jobs_manager.job_status(job_id)
@@ -182,6 +231,23 @@ def search(self, request_data, db, query, vl='', report_restriction_errors=False
                 return old[1], None
             return old[1]
 
+    def get_opds_entry(self, db, book_id, render):
+        ''' Return the serialized OPDS entry for the specified book, rendering
+        it with render(db, book_id) only if the book has changed since it was
+        last rendered '''
+        last_modified = db.field_for('last_modified', book_id)
+        with self.lock:
+            cache = self.library_broker.opds_entry_caches[db.server_library_id]
+            old = cache.pop(book_id, None)
+        if old is None or old[0] != last_modified:
+            # Render without holding the lock, as it is slow
+            old = (last_modified, render(db, book_id))
+        with self.lock:
+            cache[book_id] = old
+            if len(cache) > self.OPDS_ENTRY_CACHE_SIZE:
+                cache.popitem(last=False)
+        return old[1]
+
 
 SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert')
 
@@ -26,6 +26,7 @@
     http_date, socket_errors_socket_closed, sort_q_values
 )
 from calibre.utils.monotonic import monotonic
+from calibre.utils.shared_file import share_open
 from calibre.utils.speedups import ReadOnlyFileBuffer
 from polyglot import http_client, reprlib
 from polyglot.builtins import (
@@ -98,6 +99,11 @@ def parse_if_none_match(val):  # {{{
 # }}}
 
 
+def compressible_type(content_type):
+    ct = content_type.partition(';')[0]
+    return not ct or ct.startswith('text/') or ct.startswith('image/svg') or ct in COMPRESSIBLE_TYPES
+
+
 def acceptable_encoding(val, allowed=frozenset({'gzip'})):  # {{{
     for x in sort_q_values(val):
         x = x.lower()
@@ -373,6 +379,15 @@ def __init__(self, data):
         self.content_length = len(data)
 
 
+class CachedOutput(StaticOutput):
+
+    ' Static output whose gzip compressed form is created only once '
+
+    def __init__(self, data):
+        StaticOutput.__init__(self, data)
+        self.gzipped = b''.join(compress_readable_output(BytesIO(self.data)))
+
+
 class HTTPConnection(HTTPRequest):
 
     use_sendfile = False
@@ -653,6 +668,8 @@ def finalize_output(self, output, request, is_http1):
 
         opts = self.opts
         outheaders = request.outheaders
+        precompressed = getattr(output, 'gzipped', None)
+        precompressed_files = getattr(getattr(output, 'output', output), 'precompressed_files', None) or {}
         stat_result = file_metadata(output)
         if stat_result is not None:
             output = filesystem_file_output(output, outheaders, stat_result)
@@ -677,12 +694,15 @@ def finalize_output(self, output, request, is_http1):
             output = dynamic_output(output(), outheaders, etag=output.etag)
         else:
             output = GeneratedOutput(output)
-        ct = outheaders.get('Content-Type', '').partition(';')[0]
-        compressible = (not ct or ct.startswith('text/') or ct.startswith('image/svg') or
-                        ct.partition(';')[0] in COMPRESSIBLE_TYPES)
+        accept_encoding = request.inheaders.get('Accept-Encoding', '')
+        compressible = compressible_type(outheaders.get('Content-Type', ''))
         compressible = (compressible and request.status_code == http_client.OK and
-                        (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
-                        acceptable_encoding(request.inheaders.get('Accept-Encoding', '')) and not is_http1)
+                        (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and not is_http1)
+        encoding = compressed_file = None
+        if compressible:
+            # Prefer a pre-compressed file, if the client accepts its encoding
+            encoding = acceptable_encoding(accept_encoding, frozenset(precompressed_files)) or acceptable_encoding(accept_encoding)
+            compressible = encoding is not None
         accept_ranges = (not compressible and output.accept_ranges is not None and request.status_code == http_client.OK and
                         not is_http1)
         ranges = get_ranges(request.inheaders.get('Range'), output.content_length) if output.accept_ranges and self.method in ('GET', 'HEAD') else None
@@ -709,11 +729,26 @@ def finalize_output(self, output, request, is_http1):
             outheaders.set('ETag', output.etag, replace_all=True)
         if accept_ranges:
             outheaders.set('Accept-Ranges', 'bytes', replace_all=True)
+        if compressible and not ranges and encoding in precompressed_files:
+            try:
+                compressed_file = share_open(precompressed_files[encoding], 'rb')
+            except EnvironmentError:
+                # Removed from the store, compress on the fly if possible
+                encoding = acceptable_encoding(accept_encoding)
+                compressible = encoding is not None
         if compressible and not ranges:
-            outheaders.set('Content-Encoding', 'gzip', replace_all=True)
+            outheaders.set('Content-Encoding', encoding, replace_all=True)
             if getattr(output, 'content_length', None):
                 outheaders.set('Calibre-Uncompressed-Length', '%d' % output.content_length)
-            output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
+            if compressed_file is not None:
+                output = ReadableOutput(compressed_file, etag=output.etag)
+                output.use_sendfile = True
+                compressible = False  # already compressed, so it can be sent with a Content-Length
+            elif precompressed is None:
+                output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
+            else:
+                output = ReadableOutput(ReadOnlyFileBuffer(precompressed), etag=output.etag, content_length=len(precompressed))
+                compressible = False  # already compressed, so it can be sent with a Content-Length
         if output.content_length is not None and not compressible and not ranges:
             outheaders.set('Content-Length', '%d' % output.content_length, replace_all=True)
 
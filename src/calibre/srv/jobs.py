@@ -5,31 +5,90 @@
 
 import os, time
 from itertools import count
-from collections import namedtuple, deque
+from collections import namedtuple, deque, Counter, OrderedDict
 from functools import partial
 from threading import RLock, Thread, Event
 
 from calibre import detect_ncpus, force_unicode
+from calibre.utils.config_base import tweaks
 from calibre.utils.monotonic import monotonic
 from calibre.utils.ipc.simple_worker import fork_job, WorkerError
+from calibre.srv.pool import ProcessPool
 from polyglot.queue import Queue, Empty
 from polyglot.builtins import iteritems, itervalues
 
-StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data')
+StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data in_pool priority user queued_at')
 DoneEvent = namedtuple('DoneEvent', 'job_id')
 
+# Job priorities, waiting jobs with a lower priority number are started first
+PRIORITY_INTERACTIVE, PRIORITY_USER, PRIORITY_BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_USER: 'user', PRIORITY_BACKGROUND: 'background'}
+# How often to check if there is enough memory to start jobs that are being
+# held back for lack of it
+ADMISSION_RETRY_INTERVAL = 1.0
+
+
+def available_memory():
+    from calibre.utils.mem import available_memory
+    return available_memory()
+
+
+class JobQueue(object):
+
+    ''' The jobs waiting to be started. Jobs are started in order of priority,
+    jobs of the same priority from different users are started in turn, so that
+    a user with many waiting jobs does not hold up other users. '''
+
+    def __init__(self):
+        self.priorities = {}
+
+    def __len__(self):
+        return sum(len(q) for users in itervalues(self.priorities) for q in itervalues(users))
+
+    def append(self, ev):
+        users = self.priorities.setdefault(ev.priority, OrderedDict())
+        users.setdefault(ev.user, deque()).append(ev)
+
+    def popleft(self):
+        for priority in sorted(self.priorities):
+            users = self.priorities[priority]
+            if users:
+                user, q = next(iteritems(users))
+                ev = q.popleft()
+                # Move the user to the back of the line
+                del users[user]
+                if q:
+                    users[user] = q
+                return ev
+        raise IndexError('pop from an empty JobQueue')
+
+    def depths(self):
+        return {PRIORITY_NAMES.get(priority, priority): sum(map(len, itervalues(users))) for priority, users in iteritems(self.priorities)}
+
+    def users(self):
+        ans = Counter()
+        for users in itervalues(self.priorities):
+            for user, q in iteritems(users):
+                ans[user] += len(q)
+        return ans
+
+    def oldest(self):
+        return min((q[0].queued_at for users in itervalues(self.priorities) for q in itervalues(users) if q), default=None)
+
 
 class Job(Thread):
 
     daemon = True
 
-    def __init__(self, start_event, events_queue):
+    def __init__(self, start_event, events_queue, pool=None):
         Thread.__init__(self, name='JobsMonitor%s' % start_event.job_id)
+        self.priority, self.user = start_event.priority, start_event.user
         self.abort_event = Event()
         self.events_queue = events_queue
         self.job_name = start_event.name
         self.job_id = start_event.job_id
-        self.func = partial(fork_job, start_event.module, start_event.function, start_event.args, start_event.kwargs, abort=self.abort_event)
+        runner = fork_job if pool is None else pool.run_job
+        self.func = partial(runner, start_event.module, start_event.function, start_event.args, start_event.kwargs, abort=self.abort_event)
         self.data, self.callback = start_event.data, start_event.callback
         self.result = self.traceback = None
         self.done = False
@@ -46,6 +105,10 @@ def run(self):
             import traceback
             self.traceback = err.orig_tb or traceback.format_exc()
             self.log_path = getattr(err, 'log_path', None)
+        except Exception:
+            # The job must always end, otherwise anything waiting for it hangs
+            import traceback
+            self.traceback = traceback.format_exc()
         else:
             self.result, self.log_path = result['result'], result['stdout_stderr']
         self.done = True
@@ -97,21 +160,42 @@ def __init__(self, opts, log):
         self.events = Queue()
         self.job_id = count()
         self.waiting_job_ids = set()
-        self.waiting_jobs = deque()
+        self.waiting_jobs = JobQueue()
         self.max_block = None
         self.shutting_down = False
         self.event_loop = None
-
-    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
+        self.worker_pool = None
+        self.min_free_memory = max(0, tweaks['content_server_job_min_free_memory']) * 1024 * 1024
+        self.available_memory = available_memory
+        self.held_back = False
+        self.wait_times = {}
+        self.num_held_back = 0
+
+    def start_job(
+        self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None, in_pool=False,
+        priority=PRIORITY_USER, user=None
+    ):
+        ''' Run the specified function in a worker process. If in_pool is True
+        the job is run in one of a pool of long lived worker processes that
+        have already imported calibre.srv.render_book, instead of in a new
+        process. When there are more jobs than can be run at once, the waiting
+        jobs are started in order of priority, taking turns between the users
+        that started them. '''
         with self.lock:
             if self.shutting_down:
                 return None
+            if in_pool and self.worker_pool is None:
+                self.worker_pool = ProcessPool(self.max_jobs, warm_up=('calibre.srv.render_book', 'warm_up'))
+                t = Thread(name='PrestartWorkers', target=self.worker_pool.prestart)
+                t.daemon = True
+                t.start()
             if self.event_loop is None:
                 self.event_loop = t = Thread(name='JobsEventLoop', target=self.run)
                 t.daemon = True
                 t.start()
             job_id = next(self.job_id)
-            self.events.put(StartEvent(job_id, name, module, func, args, kwargs or {}, job_done_callback, job_data))
+            self.events.put(StartEvent(
+                job_id, name, module, func, args, kwargs or {}, job_done_callback, job_data, in_pool, priority, user, monotonic()))
             self.waiting_job_ids.add(job_id)
             return job_id
 
@@ -148,6 +232,8 @@ def shutdown(self, timeout=5.0):
             for job in itervalues(self.jobs):
                 job.abort_event.set()
             self.events.put(False)
+            if self.worker_pool is not None:
+                self.worker_pool.shutdown()
 
     def wait_for_shutdown(self, wait_till):
         for job in itervalues(self.jobs):
@@ -174,6 +260,8 @@ def run(self):
                 break
             if ev is None:
                 self.abort_hanging_jobs()
+                if self.held_back:
+                    self.start_waiting_jobs()
             elif isinstance(ev, StartEvent):
                 self.waiting_jobs.append(ev)
                 self.start_waiting_jobs()
@@ -182,17 +270,56 @@ def run(self):
             elif ev is False:
                 break
 
+    def has_memory_for_job(self):
+        # At least one job is always allowed to run, so that waiting jobs are
+        # never held back forever
+        if not self.min_free_memory or not self.jobs:
+            return True
+        try:
+            return self.available_memory() >= self.min_free_memory
+        except Exception:
+            return True
+
     def start_waiting_jobs(self):
         with self.lock:
+            self.held_back = False
             while self.waiting_jobs and len(self.jobs) < self.max_jobs:
+                if not self.has_memory_for_job():
+                    self.held_back = True
+                    self.num_held_back += 1
+                    break
                 ev = self.waiting_jobs.popleft()
-                self.jobs[ev.job_id] = Job(ev, self.events)
+                self.jobs[ev.job_id] = job = Job(ev, self.events, self.worker_pool if ev.in_pool else None)
                 self.waiting_job_ids.discard(ev.job_id)
+                wt = self.wait_times.setdefault(PRIORITY_NAMES.get(ev.priority, ev.priority), {'count': 0, 'total': 0, 'max': 0})
+                wait = job.start_time - ev.queued_at
+                wt['count'] += 1
+                wt['total'] += wait
+                wt['max'] = max(wt['max'], wait)
         self.update_max_block()
 
+    def stats(self):
+        ''' Metrics about the running and waiting jobs, wait times are in
+        seconds '''
+        with self.lock:
+            now = monotonic()
+            oldest = self.waiting_jobs.oldest()
+            running = Counter(PRIORITY_NAMES.get(job.priority, job.priority) for job in itervalues(self.jobs))
+            return {
+                'max_jobs': self.max_jobs,
+                'running': dict(running),
+                'waiting': self.waiting_jobs.depths(),
+                'waiting_per_user': {(user or ''): n for user, n in iteritems(self.waiting_jobs.users())},
+                'longest_wait': 0 if oldest is None else now - oldest,
+                'wait_times': {k: {'count': v['count'], 'max': v['max'], 'mean': v['total'] / v['count']} for k, v in iteritems(self.wait_times)},
+                'held_back_for_memory': self.held_back,
+                'times_held_back_for_memory': self.num_held_back,
+                'min_free_memory': self.min_free_memory,
+            }
+
     def update_max_block(self):
         with self.lock:
-            mb = None
+            mb = ADMISSION_RETRY_INTERVAL if self.held_back else None
             now = monotonic()
             for job in itervalues(self.jobs):
                 if not job.done and not job.abort_event.is_set():
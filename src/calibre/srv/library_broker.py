@@ -112,9 +112,9 @@ def __init__(self, libraries):
             self.library_name_map[library_id] = basename(corrected_path)
             self.original_path_map[path] = original_path
         self.loaded_dbs = {}
-        self.category_caches, self.search_caches, self.tag_browser_caches = (
+        self.category_caches, self.search_caches, self.tag_browser_caches, self.opds_entry_caches = (
             defaultdict(OrderedDict), defaultdict(OrderedDict),
-            defaultdict(OrderedDict))
+            defaultdict(OrderedDict), defaultdict(OrderedDict))
 
     def get(self, library_id=None):
         with self:
@@ -137,6 +137,11 @@ def init_library(self, library_path, is_default_library):
         library_path = self.original_path_map.get(library_path, library_path)
         return init_library(library_path, is_default_library)
 
+    def loaded_dbs_for_path(self, library_path):
+        with self:
+            dbs = tuple(db for db in itervalues(self.loaded_dbs) if db is not None)
+        return tuple(db for db in dbs if samefile(path_for_db(db), library_path))
+
     def close(self):
         with self:
             for db in itervalues(self.loaded_dbs):
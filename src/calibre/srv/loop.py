@@ -8,6 +8,7 @@
 import ipaddress
 import os
 import select
+import selectors
 import socket
 import ssl
 import traceback
@@ -155,6 +156,9 @@ def is_ip_trusted(remote_addr, trusted_ips):
 
 class Connection(object):  # {{{
 
+    # Set by the ServerLoop to be notified of changes to wait_for
+    interest_changed = None
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
         try:
@@ -186,6 +190,19 @@ def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log,
         self.last_activity = monotonic()
         self.ready = True
 
+    @property
+    def wait_for(self):
+        return self._wait_for
+
+    @wait_for.setter
+    def wait_for(self, val):
+        # Can be changed from other threads, for instance, when sending a
+        # WebSocket message, so let the loop know that it has to update the
+        # events it is polling for on this connection
+        self._wait_for = val
+        if self.interest_changed is not None:
+            self.interest_changed(self)
+
     def optimize_for_sending_packet(self):
         start_cork(self.socket)
         self.orig_send_bufsize = self.send_bufsize = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
@@ -365,9 +382,114 @@ def handle_timeout(self):
 # }}}
 
 
+class SelectPoller(object):  # {{{
+
+    ''' Polls for events using select(), which has to be passed all file
+    descriptors on every call and cannot handle more than FD_SETSIZE of them.
+    Used on Windows and as a fallback. '''
+
+    def __init__(self):
+        self.interest = {}
+
+    def register(self, fd, events):
+        ''' Set the events (a combination of selectors.EVENT_READ and
+        selectors.EVENT_WRITE) to poll for on fd, no events means the fd is
+        not polled at all. '''
+        if events:
+            self.interest[fd] = events
+        else:
+            self.interest.pop(fd, None)
+
+    def unregister(self, fd):
+        self.interest.pop(fd, None)
+
+    def poll(self, timeout):
+        ''' Return the lists of readable and writable file descriptors '''
+        read_needed, write_needed = [], []
+        for fd, events in iteritems(self.interest):
+            if events & selectors.EVENT_READ:
+                read_needed.append(fd)
+            if events & selectors.EVENT_WRITE:
+                write_needed.append(fd)
+        readable, writable, _ = select.select(read_needed, write_needed, [], timeout)
+        return readable, writable
+
+    def bad_fds(self):
+        ''' Return the registered file descriptors that are no longer valid '''
+        ans = []
+        for fd in tuple(self.interest):
+            try:
+                select.select([fd], [], [], 0)
+            except (select.error, socket.error) as e:
+                if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
+                    ans.append(fd)
+        return ans
+
+    def close(self):
+        self.interest = {}
+
+
+class SelectorPoller(SelectPoller):
+
+    ''' Polls for events using the most scalable mechanism available, epoll on
+    Linux and kqueue on macOS and the BSDs. The events for a file descriptor
+    are registered once and changed only when the state of its connection
+    changes, so the cost of polling does not grow with the number of idle
+    connections. '''
+
+    def __init__(self):
+        SelectPoller.__init__(self)
+        self.selector = selectors.DefaultSelector()
+
+    def register(self, fd, events):
+        current = self.interest.get(fd, 0)
+        if events == current:
+            return
+        if not events:
+            self.unregister(fd)
+            return
+        if current:
+            self.selector.modify(fd, events)
+        else:
+            self.selector.register(fd, events)
+        self.interest[fd] = events
+
+    def unregister(self, fd):
+        if self.interest.pop(fd, None) is not None:
+            with suppress(KeyError, ValueError, OSError):
+                self.selector.unregister(fd)
+
+    def poll(self, timeout):
+        readable, writable = [], []
+        for key, events in self.selector.select(timeout):
+            if events & selectors.EVENT_READ:
+                readable.append(key.fd)
+            if events & selectors.EVENT_WRITE:
+                writable.append(key.fd)
+        return readable, writable
+
+    def bad_fds(self):
+        ans = []
+        for fd in tuple(self.interest):
+            try:
+                os.fstat(fd)
+            except OSError:
+                ans.append(fd)
+        return ans
+
+    def close(self):
+        SelectPoller.close(self)
+        self.selector.close()
+# }}}
+
+
 class ServerLoop(object):
 
     LISTENING_MSG = 'calibre server listening on'
+    # Use select() instead of epoll/kqueue to poll for events
+    use_select = False
+    # Allow other processes to listen on the same port, used for pre-fork mode
+    reuse_port = False
 
     def __init__(
         self,
@@ -397,6 +519,8 @@ def __init__(
         self.bind_address = ba
         self.bound_address = None
         self.connection_map = {}
+        self.changed_connections = set()
+        self.poller = None
 
         self.ssl_context = None
         if self.opts.ssl_certfile is not None and self.opts.ssl_keyfile is not None:
@@ -498,9 +622,25 @@ def initialize_socket(self):
             self.pre_activated_socket = None
             self.setup_socket()
 
+    def create_poller(self):
+        if not self.use_select and not iswindows:
+            try:
+                return SelectorPoller()
+            except Exception as e:
+                self.log.warn('Failed to create selector, falling back to select() with error:', as_unicode(e))
+        return SelectPoller()
+
     def serve(self):
         self.connection_map = {}
+        self.changed_connections = set()
+        self.poller = self.create_poller()
+        # Connections are checked for inactivity only a few times per timeout
+        # period, rather than on every tick
+        self.timeout_check_interval = self.opts.timeout / 10
+        self.next_timeout_check = monotonic() + self.timeout_check_interval
         self.socket.listen(min(socket.SOMAXCONN, 128))
+        self.poller.register(self.socket.fileno(), selectors.EVENT_READ)
+        self.poller.register(self.control_out.fileno(), selectors.EVENT_READ)
         self.bound_address = ba = self.socket.getsockname()
         if isinstance(ba, tuple):
             ba = ':'.join(map(unicode_type, ba))
@@ -531,6 +671,8 @@ def serve_forever(self):
 
     def setup_socket(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
@@ -552,48 +694,68 @@ def bind(self, family, atype, proto=0):
         self.setup_socket()
         self.socket.bind(self.bind_address)
 
-    def tick(self):
-        now = monotonic()
-        read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
-        has_ssl = self.ssl_context is not None
-        for s, conn in iteritems(self.connection_map):
+    def check_timeouts(self, now):
+        for s, conn in tuple(iteritems(self.connection_map)):
             if now - conn.last_activity > self.opts.timeout:
                 if conn.handle_timeout():
                     conn.last_activity = now
                 else:
-                    remove.append((s, conn))
-                    continue
-            wf = conn.wait_for
+                    self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
+                    self.close(s, conn)
+
+    def update_interest(self):
+        ''' Update the events polled for on all connections whose state has
+        changed since the last tick. Returns the connections that already have
+        data available to read. '''
+        readable, changed = [], self.changed_connections
+        has_ssl = self.ssl_context is not None
+        while changed:
+            try:
+                conn = changed.pop()
+            except KeyError:
+                break
+            s = conn.socket.fileno()
+            if self.connection_map.get(s) is not conn:
+                continue  # Connection was closed
+            wf, events = conn.wait_for, 0
             if wf is READ or wf is RDWR:
-                if wf is RDWR:
-                    write_needed.append(s)
+                events |= selectors.EVENT_READ
+                if has_ssl and not conn.read_buffer.has_data:
+                    # Data that has already been read from the socket and
+                    # is buffered in the SSL object does not cause the
+                    # socket to be readable
+                    conn.drain_ssl_buffer()
+                    if not conn.ready:
+                        self.close(s, conn)
+                        continue
                 if conn.read_buffer.has_data:
                     readable.append(s)
-                else:
-                    if has_ssl:
-                        conn.drain_ssl_buffer()
-                        if conn.ready:
-                            (readable if conn.read_buffer.has_data else read_needed).append(s)
-                        else:
-                            close_needed.append((s, conn))
-                    else:
-                        read_needed.append(s)
-            elif wf is WRITE:
-                write_needed.append(s)
-
-        for s, conn in remove:
-            self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
-            self.close(s, conn)
+            if wf is WRITE or wf is RDWR:
+                events |= selectors.EVENT_WRITE
+            try:
+                self.poller.register(s, events)
+            except (ValueError, KeyError, EnvironmentError) as e:
+                self.log.error('Failed to poll connection, closing it: %s' % as_unicode(e))
+                self.close(s, conn)
+        return readable
 
-        for x, conn in close_needed:
-            self.close(s, conn)
+    def tick(self):
+        now = monotonic()
+        if now >= self.next_timeout_check:
+            self.next_timeout_check = now + self.timeout_check_interval
+            self.check_timeouts(now)
 
+        readable = self.update_interest()
         if readable:
             writable = []
         else:
+            if self.socket.fileno() == -1:
+                self.ready = False
+                self.log.error('Listening socket was unexpectedly terminated')
+                return
             try:
-                readable, writable, _ = select.select([self.socket.fileno(), self.control_out.fileno()] + read_needed, write_needed, [], self.opts.timeout)
-            except ValueError:  # self.socket.fileno() == -1
+                readable, writable = self.poller.poll(max(0, min(self.opts.timeout, self.next_timeout_check - now)))
+            except ValueError:
                 self.ready = False
                 self.log.error('Listening socket was unexpectedly terminated')
                 return
@@ -602,12 +764,12 @@ def tick(self):
                 # e.args[0]
                 if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
                     return
-                for s, conn in tuple(iteritems(self.connection_map)):
-                    try:
-                        select.select([s], [], [], 0)
-                    except (select.error, socket.error) as e:
-                        if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
-                            self.close(s, conn)  # Bad socket, discard
+                for s in self.poller.bad_fds():
+                    conn = self.connection_map.get(s)
+                    if conn is None:
+                        self.poller.unregister(s)
+                    else:
+                        self.close(s, conn)  # Bad socket, discard
                 return
 
         if not self.ready:
@@ -617,6 +779,8 @@ def tick(self):
         for s, conn, event in self.get_actions(readable, writable):
             if s in ignore:
                 continue
+            # The event handler can change the state of the connection
+            self.changed_connections.add(conn)
             try:
                 conn.handle_event(event)
                 if not conn.ready:
@@ -676,6 +840,8 @@ def dispatch_job_results(self):
 
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        if self.poller is not None:
+            self.poller.unregister(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -689,6 +855,8 @@ def get_actions(self, readable, writable):
                     if s > -1:
                         self.connection_map[s] = conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                        conn.interest_changed = self.changed_connections.add
+                        self.changed_connections.add(conn)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -739,6 +907,8 @@ def shutdown(self):
                 self.socket = None
         for s, conn in tuple(iteritems(self.connection_map)):
             self.close(s, conn)
+        if self.poller is not None:
+            self.poller.close()
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
@@ -39,14 +39,16 @@ def atom(ctx, rd, endpoint, output):
         ans = output  # Assume output is already UTF-8 XML
     elif isinstance(output, unicode_type):
         ans = output.encode('utf-8')
-    else:
+    elif etree.iselement(output):
         ans = etree.tostring(output, encoding='utf-8', xml_declaration=True, pretty_print=True)
+    else:
+        ans = output  # Assume output is an iterator over chunks of UTF-8 XML
     return ans
 
 
 def format_tag_string(tags, sep, joinval=', '):
     if tags:
-        tlist = tags if sep is None else [t.strip() for t in tags.split(sep)]
+        tlist = list(tags) if sep is None else [t.strip() for t in tags.split(sep)]
     else:
         tlist = []
     tlist.sort(key=sort_key)
@@ -180,7 +182,7 @@ def CATALOG_GROUP_ENTRY(item, category, request_context, updated):
 
 def ACQUISITION_ENTRY(book_id, updated, request_context):
     field_metadata = request_context.db.field_metadata
-    mi = request_context.db.get_metadata(book_id)
+    mi = request_context.db.get_proxy_metadata(book_id)
     extra = []
     if (mi.rating or 0) > 0:
         rating = rating_to_stars(mi.rating)
@@ -239,6 +241,10 @@ def ACQUISITION_ENTRY(book_id, updated, request_context):
     return ans
 
 
+def acquisition_entry_xml(request_context, db, book_id):
+    return etree.tostring(ACQUISITION_ENTRY(book_id, None, request_context), encoding='utf-8', pretty_print=True)
+
+
 # }}}
 
 default_feed_title = __appname__ + ' ' + _('Library')
@@ -328,8 +334,18 @@ class AcquisitionFeed(NavFeed):
 
     def __init__(self, id_, updated, request_context, items, offsets, page_url, up_url, title=None):
         NavFeed.__init__(self, id_, updated, request_context, offsets, page_url, up_url, title=title)
-        for book_id in items:
-            self.root.append(ACQUISITION_ENTRY(book_id, updated, request_context))
+        # The entries are serialized separately, so that they can be cached
+        render = partial(acquisition_entry_xml, request_context)
+        self.entries = [request_context.ctx.get_opds_entry(request_context.db, book_id, render) for book_id in items]
+
+    def __iter__(self):
+        ' Iterate over the serialized feed, in chunks '
+        raw = etree.tostring(self.root, encoding='utf-8', xml_declaration=True, pretty_print=True)
+        head, sep, tail = raw.rpartition(b'</feed>')
+        yield head
+        for entry in self.entries:
+            yield entry
+        yield sep + tail
 
 
 class CategoryFeed(NavFeed):
@@ -399,7 +415,7 @@ def get_acquisition_feed(rc, ids, offset, page_url, up_url, id_,
         items = items[offsets.offset:offsets.offset+max_items]
         lm = rc.last_modified()
         rc.outheaders['Last-Modified'] = http_date(timestampfromdt(lm))
-        return AcquisitionFeed(id_, lm, rc, items, offsets, page_url, up_url, title=feed_title).root
+        return iter(AcquisitionFeed(id_, lm, rc, items, offsets, page_url, up_url, title=feed_title))
 
 
 def get_all_books(rc, which, page_url, up_url, offset=0):
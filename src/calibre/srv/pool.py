@@ -6,8 +6,9 @@
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import sys
-from threading import Thread
+from threading import Condition, Thread
 
+from calibre.utils.ipc import eintr_retry_call
 from calibre.utils.monotonic import monotonic
 from polyglot.builtins import range
 from polyglot.queue import Queue, Full
@@ -124,3 +125,169 @@ def stop(self, wait_till):
             else:
                 break
         self.workers = [w for w in self.workers if w.is_alive()]
+
+
+# Worker processes are replaced after running this many jobs, to release any
+# memory they have accumulated
+MAX_JOBS_PER_WORKER = 20
+# The default time in seconds a job may run before its worker is killed, the
+# same as for fork_job()
+JOB_TIMEOUT = 300
+
+
+class ProcessPool(object):
+
+    ''' A pool of long lived worker processes, used to run jobs without paying
+    the cost of starting a new process and importing the needed modules for
+    every job. warm_up, if specified, is a (module, function) pair that is run
+    in every worker as soon as it is started. '''
+
+    def __init__(self, size, warm_up=None, max_jobs_per_worker=MAX_JOBS_PER_WORKER):
+        self.size = max(1, size)
+        self.warm_up = warm_up
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.lock = Condition()
+        self.idle = []
+        self.num_workers = 0
+        self.shutting_down = False
+
+    def start_worker(self):
+        from calibre.utils.ipc.simple_worker import offload_worker
+        w = offload_worker()
+        w.jobs_done = 0
+        w.warming_up = False
+        if self.warm_up is not None:
+            # Starting the worker does not wait for it, the result of the warm
+            # up is only read just before the worker is used for the first time
+            try:
+                eintr_retry_call(w.conn.send, tuple(self.warm_up) + ((), {}))
+            except BaseException:
+                w.shutdown()
+                raise
+            w.warming_up = True
+        return w
+
+    def prestart(self, num=None):
+        ''' Start num workers (all of them by default), so that they are ready
+        by the time they are needed '''
+        num = self.size if num is None else min(num, self.size)
+        count = 0
+        with self.lock:
+            while not self.shutting_down and self.num_workers < num:
+                self.num_workers += 1
+                count += 1
+        for i in range(count):
+            try:
+                w = self.start_worker()
+            except Exception:
+                self.worker_gone()
+                raise
+            with self.lock:
+                self.idle.append(w)
+                self.lock.notify()
+
+    def acquire(self, timeout=None):
+        ''' Return an idle worker, starting a new one if the pool is not full.
+        Waits at most timeout seconds for a worker to become idle, if none is
+        available returns None. '''
+        with self.lock:
+            end = None if timeout is None else monotonic() + timeout
+            while not self.idle:
+                if self.shutting_down:
+                    return None
+                if self.num_workers < self.size:
+                    self.num_workers += 1
+                    break
+                left = None if end is None else end - monotonic()
+                if left is not None and left <= 0:
+                    return None
+                self.lock.wait(left)
+            else:
+                return self.idle.pop()
+        try:
+            return self.start_worker()
+        except BaseException:
+            self.worker_gone()
+            raise
+
+    def release(self, w, failed=False):
+        ''' Return a worker obtained from acquire() to the pool. Workers that
+        failed, died or have run too many jobs are replaced. '''
+        w.jobs_done += 1
+        with self.lock:
+            if not failed and not self.shutting_down and w.jobs_done < self.max_jobs_per_worker and w.worker.is_alive:
+                self.idle.append(w)
+                self.lock.notify()
+                return
+        w.shutdown()
+        self.worker_gone()
+
+    def worker_gone(self):
+        with self.lock:
+            self.num_workers -= 1
+            self.lock.notify()
+
+    def call(self, w, module, func, args=(), kwargs=None, abort=None, timeout=None):
+        ''' Run the specified function in the worker w, returning its result.
+        Raises WorkerError if the function fails or the worker dies. If abort
+        is set before the function completes, the worker is killed and None is
+        returned. If the function does not complete within timeout seconds,
+        the worker is killed and WorkerError is raised. In both cases the worker
+        must then be released with failed=True. '''
+        from calibre.utils.ipc.simple_worker import WorkerError
+        end = None if timeout is None else monotonic() + timeout
+
+        def recv():
+            while (abort is not None or end is not None) and not w.conn.poll(0.1):
+                if abort is not None and abort.is_set():
+                    w.worker.kill()
+                    return False
+                if end is not None and monotonic() >= end:
+                    w.worker.kill()
+                    raise WorkerError('Running %s:%s in a worker process timed out after %s seconds' % (module, func, timeout))
+            return True
+
+        try:
+            if w.warming_up:
+                w.warming_up = False
+                if not recv():
+                    return
+                eintr_retry_call(w.conn.recv)
+            eintr_retry_call(w.conn.send, (module, func, tuple(args), kwargs or {}))
+            if not recv():
+                return
+            res = eintr_retry_call(w.conn.recv)
+        except (EOFError, EnvironmentError) as err:
+            raise WorkerError('The worker process died while running %s:%s: %s' % (module, func, err))
+        if res['tb']:
+            raise WorkerError('Running %s:%s in a worker process failed' % (module, func), orig_tb=res['tb'])
+        return res['result']
+
+    def run_job(self, module, func, args=(), kwargs=None, abort=None, timeout=JOB_TIMEOUT):
+        ''' Run a job in a worker from this pool. Has the same interface as
+        :func:`calibre.utils.ipc.simple_worker.fork_job`, except that there is no
+        log of the output of the job. '''
+        from calibre.utils.ipc.simple_worker import WorkerError
+        try:
+            w = self.acquire()
+        except Exception as err:
+            import traceback
+            raise WorkerError('Failed to start a worker process: %s' % err, orig_tb=traceback.format_exc())
+        if w is None:
+            raise WorkerError('The worker pool has been shutdown')
+        failed = True
+        try:
+            result = self.call(w, module, func, args, kwargs, abort, timeout)
+            failed = abort is not None and abort.is_set()
+        finally:
+            self.release(w, failed)
+        return {'result': result, 'stdout_stderr': None}
+
+    def shutdown(self):
+        with self.lock:
+            self.shutting_down = True
+            idle, self.idle = self.idle, []
+            self.lock.notify_all()
+        for w in idle:
+            w.shutdown()
+            self.worker_gone()
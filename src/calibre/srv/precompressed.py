@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Compressed versions of the static files of the Content server, such as the
+large compiled index-generated.html. They are created the first time a file is
+requested and stored on disk, so that the same file is not compressed again
+for every client. A compressed version is created again when the file it was
+created from is modified or calibre is upgraded. Brotli compressed versions are created as well,
+when the brotli module is available.
+'''
+
+import os
+import tempfile
+import zlib
+from hashlib import sha1
+
+from calibre import guess_type
+from calibre.constants import cache_dir, numeric_version
+from calibre.srv.http_response import compress_readable_output, compressible_type
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.shared_file import share_open
+from polyglot.builtins import as_unicode
+
+# Files smaller than this are not worth compressing
+MIN_SIZE = 1024
+
+
+def default_store_path():
+    return os.path.join(cache_dir(), 'srvz')
+
+
+def gzip_compress(src_file):
+    return b''.join(compress_readable_output(src_file, compress_level=zlib.Z_BEST_COMPRESSION))
+
+
+def brotli_compress(src_file):
+    import brotli
+    return brotli.compress(src_file.read())
+
+
+_encoders = None
+
+
+def encoders():
+    global _encoders
+    if _encoders is None:
+        _encoders = {'gzip': gzip_compress}
+        try:
+            import brotli  # noqa
+        except ImportError:
+            pass
+        else:
+            _encoders['br'] = brotli_compress
+    return _encoders
+
+
+class PrecompressedStore(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def compressed_path(self, path, st, encoding):
+        # The size and the calibre version are part of the key, as the files
+        # of packaged and reproducible builds all have the same modification
+        # time, so that alone does not tell if a file has changed
+        key = '%s\0%d\0%s' % (os.path.abspath(path), st.st_size, '.'.join(map(str, numeric_version)))
+        h = as_unicode(sha1(key.encode('utf-8')).hexdigest())
+        return os.path.join(self.path, h + ('.gz' if encoding == 'gzip' else '.' + encoding))
+
+    def ensure_compressed(self, path, st, encoding):
+        ' Return the path to the compressed version of path, creating it if it is missing or out of date '
+        dest = self.compressed_path(path, st, encoding)
+        try:
+            if os.stat(dest).st_mtime_ns == st.st_mtime_ns:
+                return dest
+        except EnvironmentError:
+            pass
+        try:
+            os.makedirs(self.path)
+        except EnvironmentError:
+            pass
+        with share_open(path, 'rb') as f:
+            data = encoders()[encoding](f)
+        fd, tpath = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # The compressed version is up to date as long as it has the same
+        # modification time as the file it was created from
+        os.utime(tpath, ns=(st.st_atime_ns, st.st_mtime_ns))
+        atomic_rename(tpath, dest)
+        return dest
+
+    def open(self, path):
+        ''' Open the file at path, for serving. Compressed versions of it are
+        attached to the returned file object as a map of encoding to path,
+        which is used when the client accepts one of those encodings. '''
+        ans = share_open(path, 'rb')
+        try:
+            st = os.fstat(ans.fileno())
+            if st.st_size >= MIN_SIZE and compressible_type(guess_type(path)[0] or ''):
+                ans.precompressed_files = {
+                    encoding: self.ensure_compressed(path, st, encoding) for encoding in encoders()}
+        except EnvironmentError:
+            pass  # Serve the file as is, compressing it on the fly if needed
+        return ans
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Pre-fork mode for the Content server. A coordinator process forks a number of
+worker processes, each of which runs its own ServerLoop and LibraryBroker. The
+workers all listen on the same port using SO_REUSEPORT, so the kernel
+distributes incoming connections between them. Changes made to a library by
+one worker are sent to the coordinator, which broadcasts them to all other
+workers, which then reload that library from metadata.db.
+'''
+
+import os
+import signal
+import time
+import traceback
+from multiprocessing.connection import Pipe, wait
+from threading import Lock, Thread
+
+from calibre.srv.changes import AnnotationsChanged
+from calibre.utils.monotonic import monotonic
+from polyglot.builtins import iteritems, itervalues
+
+# Workers that die within this many seconds of being started are not
+# restarted, as they are most likely failing on startup
+MIN_WORKER_LIFETIME = 5
+
+
+class ChangesRelay(object):
+
+    ' Used as the notify_changes callback in a worker, sends changes to the coordinator '
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = Lock()
+
+    def __call__(self, library_path, change_event):
+        with self.lock:
+            try:
+                self.conn.send((library_path, change_event))
+            except EnvironmentError:
+                pass  # The coordinator has exited
+
+
+def apply_changes(library_broker, library_path, change_event):
+    ''' Reload the library at library_path, if it is loaded, as it has been
+    changed by another worker '''
+    if isinstance(change_event, AnnotationsChanged):
+        # Annotations are not held in memory
+        return
+    for db in library_broker.loaded_dbs_for_path(library_path):
+        db.new_api.reload_from_db()
+
+
+def listen_for_changes(conn, library_broker, log):
+    while True:
+        try:
+            library_path, change_event = conn.recv()
+        except (EOFError, EnvironmentError):
+            break
+        try:
+            apply_changes(library_broker, library_path, change_event)
+        except Exception:
+            log.exception('Failed to apply change made by another worker: %r' % change_event)
+
+
+def start_change_listener(conn, library_broker, log):
+    t = Thread(target=listen_for_changes, args=(conn, library_broker, log), name='ChangeListener')
+    t.daemon = True
+    t.start()
+    return t
+
+
+class Coordinator(object):
+
+    def __init__(self, num_workers, run_worker, log):
+        ''' run_worker is called in each forked worker process, with the
+        connection to use for sending and receiving change events. '''
+        self.num_workers = num_workers
+        self.run_worker = run_worker
+        self.log = log
+        self.workers = {}
+        self.stopped = False
+
+    def spawn(self):
+        conn, child_conn = Pipe()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                conn.close()
+                for w in itervalues(self.workers):
+                    w['conn'].close()
+                # Workers are shutdown by the coordinator
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                for sig in (signal.SIGTERM, signal.SIGHUP):
+                    signal.signal(sig, signal.SIG_DFL)
+                self.run_worker(child_conn)
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        child_conn.close()
+        self.workers[pid] = {'conn': conn, 'started': monotonic(), 'alive': True}
+        self.log('Started worker process:', pid)
+
+    def broadcast(self, sender, msg):
+        for pid, w in iteritems(self.workers):
+            if pid != sender and w['alive']:
+                try:
+                    w['conn'].send(msg)
+                except EnvironmentError:
+                    w['alive'] = False
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            w = self.workers.pop(pid, None)
+            if w is None:
+                continue
+            w['conn'].close()
+            if self.stopped:
+                continue
+            if monotonic() - w['started'] < MIN_WORKER_LIFETIME:
+                self.log.error('Worker process %d failed on startup, shutting down' % pid)
+                self.stop()
+            else:
+                self.log.warn('Worker process %d exited unexpectedly, restarting it' % pid)
+                self.spawn()
+
+    def stop(self):
+        self.stopped = True
+
+    def serve_forever(self):
+        for i in range(self.num_workers):
+            self.spawn()
+        while not self.stopped:
+            conn_map = {w['conn']:pid for pid, w in iteritems(self.workers) if w['alive']}
+            for conn in wait(list(conn_map), timeout=0.5):
+                pid = conn_map[conn]
+                try:
+                    msg = conn.recv()
+                except (EOFError, EnvironmentError):
+                    self.workers[pid]['alive'] = False
+                else:
+                    self.broadcast(pid, msg)
+            self.reap()
+        self.shutdown()
+
+    def shutdown(self, timeout=10):
+        self.stopped = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except EnvironmentError:
+                pass
+        end = monotonic() + timeout
+        while self.workers and monotonic() < end:
+            self.reap()
+            if self.workers:
+                time.sleep(0.05)
+        for pid, w in iteritems(self.workers):
+            self.log.warn('Worker process %d failed to shutdown, killing it' % pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except EnvironmentError:
+                pass
+        self.workers = {}
@@ -3,20 +3,22 @@
 # License: GPLv3 Copyright: 2016, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import atexit
 import json
 import os
 import re
 import sys
-import time
-from collections import defaultdict
+import tempfile
+import traceback
+from collections import defaultdict, deque
 from datetime import datetime
 from functools import partial
+from hashlib import sha1
 from itertools import count
 from lxml.etree import Comment
-from math import ceil
+from threading import Thread
 
 from calibre import detect_ncpus, force_unicode, prepare_string_for_xml
-from calibre.constants import iswindows
 from calibre.customize.ui import plugin_for_input_format
 from calibre.ebooks.oeb.base import (
     OEB_DOCS, OEB_STYLES, OPF, XHTML, XHTML_NS, XLINK, XPath as _XPath,
@@ -30,12 +32,9 @@
 from calibre.ebooks.oeb.polish.pretty import pretty_script_or_style
 from calibre.ebooks.oeb.polish.toc import from_xpaths, get_landmarks, get_toc
 from calibre.ebooks.oeb.polish.utils import guess_type
-from calibre.ptempfile import PersistentTemporaryDirectory
 from calibre.srv.metadata import encode_datetime
-from calibre.srv.opts import grouper
 from calibre.utils.date import EPOCH
-from calibre.utils.filenames import rmtree
-from calibre.utils.ipc.simple_worker import start_pipe_worker
+from calibre.utils.filenames import atomic_rename
 from calibre.utils.logging import default_log
 from calibre.utils.serialize import (
     json_dumps, json_loads, msgpack_dumps, msgpack_loads
@@ -47,7 +46,7 @@
     as_base64_unicode as encode_component, from_base64_bytes,
     from_base64_unicode as decode_component
 )
-from polyglot.builtins import as_bytes, iteritems, map, unicode_type
+from polyglot.builtins import as_bytes, as_unicode, iteritems, map, unicode_type
 from polyglot.urllib import quote, urlparse
 
 RENDER_VERSION = 1
@@ -412,44 +411,30 @@ def handle_link(a, attr='href'):
         f.write(shtml)
 
 
+_render_pool = None
+
+
+def render_pool():
+    ''' The pool of worker processes shared by all renders in this process '''
+    global _render_pool
+    if _render_pool is None:
+        from calibre.srv.pool import ProcessPool
+        _render_pool = ProcessPool(detect_ncpus() - 1, warm_up=('calibre.srv.render_book', 'warm_up'))
+        atexit.register(_render_pool.shutdown)
+    return _render_pool
+
+
 class RenderManager(object):
 
     def __init__(self, max_workers):
         self.max_workers = max_workers
-
-    def launch_worker(self):
-        with lopen(os.path.join(self.tdir, '{}.json'.format(len(self.workers))), 'wb') as output:
-            error = lopen(os.path.join(self.tdir, '{}.error'.format(len(self.workers))), 'wb')
-            p = start_pipe_worker('from calibre.srv.render_book import worker_main; worker_main()', stdout=error, stderr=error)
-            p.output_path = output.name
-            p.error_path = error.name
-        self.workers.append(p)
+        self.num_other_workers = 0
 
     def __enter__(self):
-        self.workers = []
-        self.tdir = PersistentTemporaryDirectory()
         return self
 
     def __exit__(self, *a):
-        while self.workers:
-            p = self.workers.pop()
-            if p.poll() is not None:
-                continue
-            p.terminate()
-            if not iswindows and p.poll() is None:
-                time.sleep(0.02)
-                if p.poll() is None:
-                    p.kill()
-        del self.workers
-        try:
-            rmtree(self.tdir)
-        except EnvironmentError:
-            time.sleep(0.1)
-            try:
-                rmtree(self.tdir)
-            except EnvironmentError:
-                pass
-        del self.tdir
+        pass
 
     def launch_workers(self, names, in_process_container):
         num_workers = min(detect_ncpus(), len(names))
@@ -459,53 +444,91 @@ def launch_workers(self, names, in_process_container):
             if len(names) < 3 or sum(os.path.getsize(in_process_container.name_path_map[n]) for n in names) < 128 * 1024:
                 num_workers = 1
         if num_workers > 1:
-            num_other_workers = num_workers - 1
-            while len(self.workers) < num_other_workers:
-                self.launch_worker()
+            self.num_other_workers = num_workers - 1
+            render_pool().prestart(self.num_other_workers)
         return num_workers
 
     def __call__(self, names, args, in_process_container):
-        num_workers = len(self.workers) + 1
-        if num_workers == 1:
+        if not self.num_other_workers:
             return [process_book_files(names, *args, container=in_process_container)]
 
-        group_sz = int(ceil(len(names) / num_workers))
-        groups = tuple(grouper(group_sz, names))
-        for group, worker in zip(groups[:-1], self.workers):
-            worker.stdin.write(as_bytes(msgpack_dumps((worker.output_path, group,) + args)))
-            worker.stdin.flush(), worker.stdin.close()
-            worker.job_sent = True
-
-        for worker in self.workers:
-            if not hasattr(worker, 'job_sent'):
-                worker.stdin.write(b'_'), worker.stdin.flush(), worker.stdin.close()
-
-        error = None
-        results = [process_book_files(groups[-1], *args, container=in_process_container)]
-        for worker in self.workers:
-            if not hasattr(worker, 'job_sent'):
-                worker.wait()
-                continue
-            if worker.wait() != 0:
-                with lopen(worker.error_path, 'rb') as f:
-                    error = f.read().decode('utf-8', 'replace')
-            else:
-                with lopen(worker.output_path, 'rb') as f:
-                    results.append(msgpack_loads(f.read()))
-        if error is not None:
-            raise Exception('Render worker failed with error:\n' + error)
+        # Files are handed out one at a time, to whichever process is free, so
+        # that a few large files do not leave the other processes idle
+        queue = deque(names)
+        results, errors = [], []
+        feeders = []
+        for i in range(self.num_other_workers):
+            t = Thread(target=self.feed_worker, args=(queue, args, results, errors), name='RenderFeeder%d' % i)
+            t.daemon = True
+            t.start()
+            feeders.append(t)
+        try:
+            while queue and not errors:
+                try:
+                    name = queue.popleft()
+                except IndexError:
+                    break
+                results.append(process_book_files((name,), *args, container=in_process_container))
+        finally:
+            queue.clear()
+            for t in feeders:
+                t.join()
+        if errors:
+            raise Exception('Render worker failed with error:\n' + errors[0])
         return results
 
+    def feed_worker(self, queue, args, results, errors):
+        from calibre.srv.pool import JOB_TIMEOUT
+        pool = render_pool()
+        w = None
+        while w is None and queue:
+            w = pool.acquire(timeout=0.1)
+        if w is None:
+            return
+        failed = True
+        try:
+            while not errors:
+                try:
+                    name = queue.popleft()
+                except IndexError:
+                    break
+                results.append(pool.call(w, 'calibre.srv.render_book', 'process_book_file', (name,) + tuple(args), timeout=JOB_TIMEOUT))
+            pool.call(w, 'calibre.srv.render_book', 'forget_worker_container', timeout=JOB_TIMEOUT)
+            failed = False
+        except Exception as err:
+            errors.append(getattr(err, 'orig_tb', None) or traceback.format_exc())
+        finally:
+            pool.release(w, failed)
+
+
+def warm_up():
+    ''' Run in render pool workers when they are started, so that the modules
+    needed for rendering are loaded before the first render. Importing this
+    module loads most of them. Plugins are not needed for rendering a file and
+    initializing them is slow, so it is not done here. '''
+    from calibre_extensions.html_as_json import serialize
+    serialize
+
 
-def worker_main():
-    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
-    raw = stdin.read()
-    if raw == b'_':
-        return
-    args = msgpack_loads(raw)
-    result = process_book_files(*args[1:])
-    with open(args[0], 'wb') as f:
-        f.write(as_bytes(msgpack_dumps(result)))
+worker_container = None
+
+
+def process_book_file(name, container_dir, opfpath, virtualize_resources, link_uid, data_for_clone, render_cache=None):
+    ''' Process a single file in a render pool worker, re-using the container
+    created for the previous file of the same book '''
+    global worker_container
+    key = container_dir, opfpath, link_uid
+    if worker_container is None or worker_container[0] != key:
+        container = SimpleContainer(container_dir, opfpath, default_log, clone_data=data_for_clone)
+        container.cloned = False
+        worker_container = key, container
+    return process_book_files(
+        (name,), container_dir, opfpath, virtualize_resources, link_uid, data_for_clone, render_cache, container=worker_container[1])
+
+
+def forget_worker_container():
+    global worker_container
+    worker_container = None
 
 
 def virtualize_html(container, name, link_uid, link_to_map, virtualized_names):
@@ -540,7 +563,72 @@ def handle_link(a, attr='href'):
     return name in changed
 
 
-def process_book_files(names, container_dir, opfpath, virtualize_resources, link_uid, data_for_clone, container=None):
+def render_cache_key(container, name, virtualize_resources, manifest_key):
+    ''' The key of the processed version of the file name in the render cache.
+    It depends on the contents of the file and on manifest_key, which
+    represents everything else in the book that processing the file depends
+    on. '''
+    h = sha1(json_dumps((RENDER_VERSION, name, virtualize_resources, manifest_key)))
+    with container.open(name, 'rb') as f:
+        h.update(f.read())
+    return as_unicode(h.hexdigest())
+
+
+def manifest_key(container):
+    return as_unicode(sha1(json_dumps(sorted(
+        (name, mt, container.has_name_and_is_not_empty(name)) for name, mt in iteritems(container.mime_map)))).hexdigest())
+
+
+def load_rendered_file(container, name, cache_dir, key, link_uid, link_to_map, html_data, virtualized_names):
+    path = os.path.join(cache_dir, key[:2], key)
+    try:
+        with lopen(path, 'rb') as f:
+            entry = msgpack_loads(f.read())
+        os.utime(path, None)
+    except EnvironmentError:
+        return False
+    # The link_uid is different for every render, it is random so it cannot
+    # occur anywhere else in the file
+    data = entry['data'].replace(entry['link_uid'].encode('utf-8'), link_uid.encode('utf-8'))
+    with container.open(name, 'wb') as f:
+        f.write(data)
+    for lname, frags in iteritems(entry['links']):
+        for frag in frags:
+            link_to_map.setdefault(lname, {}).setdefault(frag, set()).add(name)
+    if entry['html_data'] is not None:
+        html_data[name] = entry['html_data']
+    if entry['virtualized']:
+        virtualized_names.add(name)
+    return True
+
+
+def store_rendered_file(container, name, cache_dir, key, link_uid, link_to_map, html_data, virtualized_names):
+    links = {}
+    for lname, frag_map in iteritems(link_to_map):
+        frags = [frag for frag, names in iteritems(frag_map) if name in names]
+        if frags:
+            links[lname] = frags
+    with lopen(container.name_to_abspath(name), 'rb') as f:
+        data = f.read()
+    entry = msgpack_dumps({
+        'link_uid': link_uid, 'data': data, 'links': links,
+        'html_data': html_data.get(name), 'virtualized': name in virtualized_names})
+    base = os.path.join(cache_dir, key[:2])
+    try:
+        os.makedirs(base)
+    except EnvironmentError:
+        pass
+    fd, tpath = tempfile.mkstemp(suffix='.tmp', dir=base)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(entry)
+    atomic_rename(tpath, os.path.join(base, key))
+
+
+def process_book_files(names, container_dir, opfpath, virtualize_resources, link_uid, data_for_clone, render_cache=None, container=None):
+    ''' Process the specified files, returning data about them. render_cache,
+    if not None, is a (cache directory, manifest key) pair, files found in the
+    cache are copied from it instead of being processed and the processed
+    versions of other files are added to it. '''
     if container is None:
         container = SimpleContainer(container_dir, opfpath, default_log, clone_data=data_for_clone)
         container.cloned = False
@@ -550,6 +638,11 @@ def process_book_files(names, container_dir, opfpath, virtualize_resources, link
     for name in names:
         if name is None:
             continue
+        key = None
+        if render_cache is not None:
+            key = render_cache_key(container, name, virtualize_resources, render_cache[1])
+            if load_rendered_file(container, name, render_cache[0], key, link_uid, link_to_map, html_data, virtualized_names):
+                continue
         mt = container.mime_map[name].lower()
         if mt in OEB_DOCS:
             root = container.parsed(name)
@@ -563,12 +656,17 @@ def process_book_files(names, container_dir, opfpath, virtualize_resources, link
             transform_style_sheet(container, name, link_uid, virtualize_resources, virtualized_names)
         elif mt == 'image/svg+xml':
             transform_svg_image(container, name, link_uid, virtualize_resources, virtualized_names)
+        if key is not None:
+            try:
+                store_rendered_file(container, name, render_cache[0], key, link_uid, link_to_map, html_data, virtualized_names)
+            except EnvironmentError:
+                pass  # The cache is only an optimization
     return link_to_map, html_data, virtualized_names
 
 
 def process_exploded_book(
     book_fmt, opfpath, input_fmt, tdir, render_manager, log=None, book_hash=None, save_bookmark_data=False,
-    book_metadata=None, virtualize_resources=True
+    book_metadata=None, virtualize_resources=True, render_cache_dir=None
 ):
     log = log or default_log
     container = SimpleContainer(tdir, opfpath, log)
@@ -579,11 +677,9 @@ def needs_work(mt):
         return mt in OEB_STYLES or mt in OEB_DOCS or mt == 'image/svg+xml'
 
     def work_priority(name):
-        # ensure workers with large files or stylesheets
-        # have the less names
-        size = os.path.getsize(container.name_path_map[name]),
-        is_html = container.mime_map.get(name) in OEB_DOCS
-        return (0 if is_html else 1), size
+        # Process the largest files first, so that the render workers do not
+        # end up waiting for a large file started last
+        return -os.path.getsize(container.name_path_map[name])
 
     if not is_comic:
         render_manager.launch_workers(tuple(n for n, mt in iteritems(container.mime_map) if needs_work(mt)), container)
@@ -643,9 +739,10 @@ def work_priority(name):
         (n for n, mt in iteritems(container.mime_map) if needs_work(mt)),
         key=work_priority)
 
+    render_cache = None if render_cache_dir is None else (render_cache_dir, manifest_key(container))
     results = render_manager(
         names, (
-            tdir, opfpath, virtualize_resources, book_render_data['link_uid'], container.data_for_clone()
+            tdir, opfpath, virtualize_resources, book_render_data['link_uid'], container.data_for_clone(), render_cache
         ), container
     )
     ltm = book_render_data['link_to_map']
@@ -780,7 +877,10 @@ def get_stored_annotations(container, bookmark_data):
                 yield {'type': 'last-read', 'pos': epubcfi, 'pos_type': 'epubcfi', 'timestamp': EPOCH}
 
 
-def render(pathtoebook, output_dir, book_hash=None, serialize_metadata=False, extract_annotations=False, virtualize_resources=True, max_workers=1):
+def render(
+    pathtoebook, output_dir, book_hash=None, serialize_metadata=False, extract_annotations=False, virtualize_resources=True, max_workers=1,
+    render_cache_dir=None
+):
     pathtoebook = os.path.abspath(pathtoebook)
     with RenderManager(max_workers) as render_manager:
         mi = None
@@ -793,7 +893,7 @@ def render(pathtoebook, output_dir, book_hash=None, serialize_metadata=False, ex
         container, bookmark_data = process_exploded_book(
             book_fmt, opfpath, input_fmt, output_dir, render_manager,
             book_hash=book_hash, save_bookmark_data=extract_annotations,
-            book_metadata=mi, virtualize_resources=virtualize_resources
+            book_metadata=mi, virtualize_resources=virtualize_resources, render_cache_dir=render_cache_dir
         )
         if serialize_metadata:
             from calibre.ebooks.metadata.book.serialize import metadata_as_dict
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A cache of the JSON responses of the endpoints used to build the book list
+and the Tag browser. The responses are keyed by the library state, as given
+by the number of times the library has been written to in this process, which
+includes reloading it after it was changed by another process, so any change
+to the library causes fresh responses to be generated, the stale ones are
+eventually evicted as the least recently used. Responses are stored together with their gzip compressed form,
+so they can be sent without compressing them again.
+'''
+
+from collections import Counter, OrderedDict
+from threading import Lock
+
+from calibre.srv.http_response import CachedOutput
+from calibre.utils.serialize import json_dumps
+
+
+class ResponseCache(object):
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = Lock()
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits, self.misses = Counter(), Counter()
+
+    def __call__(self, key, generate):
+        ''' Return the cached response for key, calling generate() to create
+        it if it is not present. The first item of key must be the name of the
+        endpoint. '''
+        endpoint = key[0]
+        with self.lock:
+            ans = self.items.get(key)
+            if ans is not None:
+                self.items.move_to_end(key)
+                self.hits[endpoint] += 1
+                return ans
+            self.misses[endpoint] += 1
+        ans = CachedOutput(json_dumps(generate()))
+        size = ans.content_length + len(ans.gzipped)
+        if size > self.max_size:
+            return ans
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= old.content_length + len(old.gzipped)
+            self.items[key] = ans
+            self.size += size
+            while self.size > self.max_size:
+                old = self.items.popitem(last=False)[1]
+                self.size -= old.content_length + len(old.gzipped)
+        return ans
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint in set(self.hits) | set(self.misses):
+                hits, misses = self.hits[endpoint], self.misses[endpoint]
+                endpoints[endpoint] = {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses)}
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+            return {
+                'hits': hits, 'misses': misses, 'hit_rate': (hits / (hits + misses)) if hits + misses else 0,
+                'entries': len(self.items), 'size': self.size, 'max_size': self.max_size, 'endpoints': endpoints,
+            }
+
+
+def normalized_query(query):
+    return tuple(sorted(query.items()))
+
+
+def cached_response(ctx, rd, db, endpoint, generate, *extra):
+    ''' Return the JSON data created by generate() for the specified endpoint
+    from the response cache. The response depends on the query, the
+    user and the state of the library, extra can be used to specify anything
+    else it depends on. '''
+    cache = ctx.response_cache
+    if cache is None:
+        return generate()
+    key = (endpoint, db.server_library_id, db.write_count, rd.username,
+           ctx.restriction_for(rd, db), normalized_query(rd.query)) + extra
+    return cache(key, generate)
+
@@ -9,6 +9,7 @@
 from operator import attrgetter
 
 from calibre.srv.errors import HTTPSimpleResponse, HTTPNotFound, RouteError
+from calibre.srv.http_response import StaticOutput
 from calibre.srv.utils import http_date
 from calibre.utils.serialize import msgpack_dumps, json_dumps, MSGPACK_MIME
 from polyglot.builtins import iteritems, itervalues, unicode_type, range, zip, filter
@@ -20,7 +21,7 @@
 
 def json(ctx, rd, endpoint, output):
     rd.outheaders.set('Content-Type', 'application/json; charset=UTF-8', replace_all=True)
-    if isinstance(output, bytes) or hasattr(output, 'fileno'):
+    if isinstance(output, (bytes, StaticOutput)) or hasattr(output, 'fileno'):
         ans = output  # Assume output is already UTF-8 encoded json
     else:
         ans = json_dumps(output)
@@ -60,14 +60,14 @@ def daemonize():  # {{{
 
 class Server(object):
 
-    def __init__(self, libraries, opts):
+    def __init__(self, libraries, opts, notify_changes=None):
         log = access_log = None
         log_size = opts.max_log_size * 1024 * 1024
         if opts.log:
             log = RotatingLog(opts.log, max_size=log_size)
         if opts.access_log:
             access_log = RotatingLog(opts.access_log, max_size=log_size)
-        self.handler = Handler(libraries, opts)
+        self.handler = Handler(libraries, opts, notify_changes=notify_changes)
         if opts.custom_list_template:
             with lopen(os.path.expanduser(opts.custom_list_template), 'rb') as f:
                 self.handler.router.ctx.custom_list_template = json.load(f)
@@ -139,6 +139,16 @@ def create_option_parser():
             default=False,
             action='store_true',
             help=_('Run process in background as a daemon (Linux only).'))
+        parser.add_option(
+            '--processes',
+            default=1,
+            type='int',
+            help=_(
+                'Number of server processes to run. If larger than one, a'
+                ' coordinating process starts that many worker processes, that'
+                ' share the listening port and each have their own copy of the'
+                ' libraries. Useful for making use of multiple CPU cores on'
+                ' busy servers (Linux only).'))
     parser.add_option(
         '--pidfile', default=None, help=_('Write process PID to the specified file'))
     parser.add_option(
@@ -186,10 +196,14 @@ def ensure_single_instance():
 
 def main(args=sys.argv):
     opts, args = create_option_parser().parse_args(args)
+    num_processes = getattr(opts, 'processes', 1)
     if opts.auto_reload and not opts.manage_users:
         if getattr(opts, 'daemonize', False):
             raise SystemExit(
                 'Cannot specify --auto-reload and --daemonize at the same time')
+        if num_processes > 1:
+            raise SystemExit(
+                'Cannot specify --auto-reload and --processes at the same time')
         from calibre.srv.auto_reload import NoAutoReload, auto_reload
         try:
             from calibre.utils.logging import default_log
@@ -224,6 +238,15 @@ def main(args=sys.argv):
         raise SystemExit('The --log option must point to a file, not a directory')
     if opts.access_log and os.path.isdir(opts.access_log):
         raise SystemExit('The --access-log option must point to a file, not a directory')
+    if num_processes > 1:
+        if getattr(opts, 'daemonize', False):
+            if not opts.log:
+                raise SystemExit(
+                    'In order to daemonize you must specify a log file, you can use /dev/stdout to log to screen even as a daemon'
+                )
+            daemonize()
+        write_pidfile(opts)
+        return run_workers(libraries, opts, num_processes)
     try:
         server = Server(libraries, opts)
     except BadIPSpec as e:
@@ -234,12 +257,20 @@ def main(args=sys.argv):
                 'In order to daemonize you must specify a log file, you can use /dev/stdout to log to screen even as a daemon'
             )
         daemonize()
-    if opts.pidfile:
-        with lopen(opts.pidfile, 'wb') as f:
-            f.write(unicode_type(os.getpid()).encode('ascii'))
+    write_pidfile(opts)
     signal.signal(signal.SIGTERM, lambda s, f: server.stop())
     if not getattr(opts, 'daemonize', False) and not iswindows:
         signal.signal(signal.SIGHUP, lambda s, f: server.stop())
+    serve(server)
+
+
+def write_pidfile(opts):
+    if opts.pidfile:
+        with lopen(opts.pidfile, 'wb') as f:
+            f.write(unicode_type(os.getpid()).encode('ascii'))
+
+
+def serve(server):
     # Needed for dynamic cover generation, which uses Qt for drawing
     from calibre.gui2 import ensure_app, load_builtin_fonts
     ensure_app(), load_builtin_fonts()
@@ -248,3 +279,26 @@ def main(args=sys.argv):
             server.serve_forever()
         finally:
             shutdown_delete_service()
+
+
+def run_workers(libraries, opts, num_processes):
+    from calibre.srv.prefork import ChangesRelay, Coordinator, start_change_listener
+    from calibre.utils.logging import default_log
+
+    def run_worker(conn):
+        try:
+            server = Server(libraries, opts, notify_changes=ChangesRelay(conn))
+        except BadIPSpec as e:
+            raise SystemExit('{}'.format(e))
+        server.loop.reuse_port = True
+        start_change_listener(conn, server.handler.router.ctx.library_broker, server.loop.log)
+        signal.signal(signal.SIGTERM, lambda s, f: server.stop())
+        serve(server)
+
+    log = RotatingLog(opts.log, max_size=opts.max_log_size * 1024 * 1024) if opts.log else default_log
+    coordinator = Coordinator(num_processes, run_worker, log)
+    signal.signal(signal.SIGTERM, lambda s, f: coordinator.stop())
+    if not getattr(opts, 'daemonize', False):
+        signal.signal(signal.SIGHUP, lambda s, f: coordinator.stop())
+    with HandleInterrupt(coordinator.stop):
+        coordinator.serve_forever()
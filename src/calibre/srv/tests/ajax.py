@@ -85,6 +85,57 @@ def test_ajax_categories(self):  # {{{
             self.ae(set(data['book_ids']), {2})
     # }}}
 
+    def test_response_cache(self):  # {{{
+        'Test the cache of JSON responses'
+        with self.create_server() as server:
+            conn = server.connect()
+            self.ae(make_request(conn, '/response-cache-stats')[0].status, FORBIDDEN)
+        with self.create_server(local_write=True) as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            conn = server.connect()
+            request = partial(make_request, conn)
+
+            def stats():
+                return request('/response-cache-stats')[1]
+
+            url = '/search?' + urlencode({'query': 'tags:"=Tag One"', 'sort_order': 'asc'})
+            r, data = request(url)
+            self.ae(r.status, OK)
+            self.ae(data['book_ids'], [1, 2])
+            self.ae(stats()['endpoints']['search'], {'hits': 0, 'misses': 1, 'hit_rate': 0})
+            r, xdata = request(url)
+            self.ae(data, xdata)
+            r, zdata = request(url, headers={'Accept-Encoding':'gzip'})
+            self.ae(r.getheader('Content-Encoding'), 'gzip')
+            self.ae(int(r.getheader('Content-Length')), len(zdata))
+            self.ae(json.loads(zlib.decompress(zdata, 16+zlib.MAX_WBITS)), data)
+            s = stats()
+            self.ae((s['hits'], s['misses']), (2, 1))
+            # The order of the query parameters does not matter
+            request('/search?' + urlencode([('sort_order', 'asc'), ('query', 'tags:"=Tag One"')]))
+            self.ae(stats()['hits'], 3)
+
+            # Changing the library invalidates the cached responses
+            db.set_field('tags', {1: 'Tag Two'})
+            r, data = request(url)
+            self.ae(data['book_ids'], [2])
+            self.ae(stats()['misses'], 2)
+            # As does reloading it after a change by another process, even
+            # within the same second
+            db.backend.execute('UPDATE books SET title="changed outside" WHERE id=1')
+            request(url)
+            db.reload_from_db()
+            r, data = request('/search?' + urlencode({'query': 'title:"=changed outside"'}))
+            self.ae(data['book_ids'], [1])
+            request(url)
+            self.ae(stats()['endpoints']['search']['misses'], 4)
+
+            r, data = request('/categories')
+            r, xdata = request('/categories')
+            self.ae(data, xdata)
+            self.ae(stats()['endpoints']['categories']['hits'], 1)
+    # }}}
+
     def test_srv_restrictions(self):  # {{{
         ' Test that virtual lib. + search restriction works on all end points'
         with self.create_server(auth=True, auth_mode='basic') as server:
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Benchmarks for the server, run with:
+
+    calibre-debug -e src/calibre/srv/tests/benchmark.py [connections]
+
+connections (the default) measures the latency of requests made while the server has a
+large number of idle keep-alive connections open, using both the select() and
+epoll/kqueue based pollers.
+'''
+
+import socket
+import sys
+import time
+
+from calibre.constants import iswindows
+from calibre.srv.tests.base import TestServer
+from calibre.utils.monotonic import monotonic
+from polyglot import http_client
+
+# select() cannot handle file descriptors larger than FD_SETSIZE (usually
+# 1024), remember that the client and server ends of every connection are
+# both in this process
+SELECT_LIMIT = 450
+
+
+def raise_fd_limit(needed):
+    if iswindows:
+        return
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        if hard != resource.RLIM_INFINITY:
+            needed = min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+
+def open_idle_connections(server, num):
+    ans = []
+    while len(ans) < num:
+        # Connect in batches so as not to overflow the listen backlog
+        for i in range(min(100, num - len(ans))):
+            ans.append(socket.create_connection(server.address, timeout=10))
+        end = monotonic() + 10
+        while server.loop.num_active_connections < len(ans) and monotonic() < end:
+            time.sleep(0.001)
+    return ans
+
+
+def measure_latency(server, num_requests=200):
+    conn = server.connect()
+    times = []
+    for i in range(num_requests):
+        st = monotonic()
+        conn.request('GET', '/test', 'body')
+        r = conn.getresponse()
+        r.read()
+        if r.status != http_client.OK:
+            raise SystemExit('Request failed with status: %s' % r.status)
+        times.append(monotonic() - st)
+    conn.close()
+    times.sort()
+    return 1000 * sum(times) / len(times), 1000 * times[int(len(times) * 0.99) - 1]
+
+
+def connections_benchmark(counts=(100, 400, 1000, 5000)):
+    raise_fd_limit(2 * max(counts) + 100)
+    print('%-8s %12s %12s %12s' % ('poller', 'connections', 'mean (ms)', 'p99 (ms)'))
+    for use_select in (True, False):
+        name = 'select' if use_select else 'selector'
+        for num in counts:
+            if use_select and num > SELECT_LIMIT:
+                continue
+            server = TestServer(lambda data:(data.path[0] + data.read().decode('utf-8')), timeout=600)
+            server.loop.use_select = use_select
+            with server:
+                idle = open_idle_connections(server, num)
+                if server.loop.num_active_connections < num:
+                    print('Only %d of %d connections could be opened' % (server.loop.num_active_connections, num))
+                mean, p99 = measure_latency(server)
+                print('%-8s %12d %12.3f %12.3f' % (name, server.loop.num_active_connections, mean, p99))
+                for s in idle:
+                    s.close()
+
+
+BENCHMARKS = {'connections': connections_benchmark}
+
+
+def main():
+    BENCHMARKS.get(sys.argv[-1], connections_benchmark)()
+
+
+if __name__ == '__main__':
+    main()
@@ -69,6 +69,50 @@ def test(src, url, sz=None):
             test('images/lt.png', '/icon/lt.png?sz=full')
             test('images/lt.png', '/icon/lt.png', sz=48)
             test('images/lt.png', '/icon/lt.png?sz=16', sz=16)
+
+            # Compressed versions of static files are created only once
+            raw = P('content-server/reset.css', data=True)
+            store = server.handler.router.ctx.precompressed_store
+            path = store.compressed_path(P('content-server/reset.css'), os.stat(P('content-server/reset.css')), 'gzip')
+            for i in range(2):
+                conn.request('GET', '/static/reset.css', headers={'Accept-Encoding': 'gzip'})
+                r = conn.getresponse()
+                self.ae(r.status, http_client.OK)
+                self.ae(r.getheader('Content-Encoding'), 'gzip')
+                data = r.read()
+                self.ae(int(r.getheader('Content-Length')), len(data))
+                self.ae(zlib.decompress(data, 16 + zlib.MAX_WBITS), raw)
+                if i == 0:
+                    mtime = os.stat(path).st_mtime_ns
+                    self.ae(mtime, os.stat(P('content-server/reset.css')).st_mtime_ns)
+            self.ae(os.stat(path).st_mtime_ns, mtime)
+            conn.request('GET', '/static/reset.css')
+            r = conn.getresponse()
+            self.assertIsNone(r.getheader('Content-Encoding'))
+            self.ae(r.read(), raw)
+
+        # Files changed without changing their modification time, as by an
+        # upgrade, get new compressed versions
+        import calibre.srv.precompressed as pc
+        from calibre.ptempfile import TemporaryDirectory
+        with TemporaryDirectory() as tdir:
+            store = pc.PrecompressedStore(os.path.join(tdir, 'store'))
+            src = os.path.join(tdir, 'x.css')
+
+            def compressed(data, version=pc.numeric_version):
+                with open(src, 'wb') as f:
+                    f.write(data)
+                os.utime(src, ns=(0, 10**18))
+                orig, pc.numeric_version = pc.numeric_version, version
+                try:
+                    with open(store.ensure_compressed(src, os.stat(src), 'gzip'), 'rb') as f:
+                        return zlib.decompress(f.read(), 16 + zlib.MAX_WBITS)
+                finally:
+                    pc.numeric_version = orig
+
+            self.ae(compressed(b'a' * 2000), b'a' * 2000)
+            self.ae(compressed(b'b' * 3000), b'b' * 3000)
+            self.ae(compressed(b'c' * 3000, (1000, 0, 0)), b'c' * 3000)
     # }}}
 
     def test_get(self):  # {{{
@@ -226,6 +270,86 @@ def change_cover(count, book_id=2):
 
     # }}}
 
+    def test_thumbnails(self):  # {{{
+        'Test the thumbnail store'
+        from calibre.srv.thumbnails import ThumbnailStore, size_bucket, webp_supported
+        self.ae(size_bucket(60, 80), (60, 80))
+        self.ae(size_bucket(61, 0), (80, 20))
+        self.ae(size_bucket(401, 263), (500, 280))
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            conn = server.connect()
+
+            def get(book_id, q='', headers=None):
+                conn.request('GET', '/get/thumb/%s' % book_id + (('?' + q) if q else ''), headers=headers or {})
+                r = conn.getresponse()
+                return r, r.read()
+
+            r, data = get(1, 'sz=97x131')
+            self.ae(r.status, http_client.OK)
+            self.ae(r.getheader('Used-Cache'), 'no')
+            self.ae(r.getheader('Content-Type'), 'image/jpeg')
+            etag = r.getheader('ETag')
+            self.assertFalse(etag.startswith('W/'))
+            # Sizes in the same bucket share a thumbnail
+            r, data2 = get(1, 'sz=100x140')
+            self.ae(r.getheader('Used-Cache'), 'yes')
+            self.ae(data, data2)
+            self.ae(r.getheader('ETag'), etag)
+            r, data = get(1, 'sz=100x140', headers={'If-None-Match': etag})
+            self.ae(r.status, http_client.NOT_MODIFIED)
+            if webp_supported():
+                r, data = get(1, 'sz=100x140', headers={'Accept': 'image/webp,*/*'})
+                self.ae(r.status, http_client.OK)
+                self.ae(r.getheader('Content-Type'), 'image/webp')
+                self.ae(r.getheader('Used-Cache'), 'no')
+                self.assertNotEqual(r.getheader('ETag'), etag)
+
+        # Least recently used thumbnails are removed when the store is full
+        store = ThumbnailStore(os.path.join(self.library_path, 'thumbnails'), 0)
+        mtime = db.cover_last_modified(1)
+        store.max_size = len(store.open(db, 1, 60, 80, mtime, 'jpeg')[0].read())
+        self.ae(store.total_size, store.max_size)
+        store.open(db, 1, 60, 80, mtime, 'jpeg')[0].close()
+        self.ae(store.open(db, 1, 60, 80, mtime, 'jpeg')[1], True)
+        store.open(db, 1, 100, 100, mtime, 'jpeg')[0].close()
+        self.ae(len(store.index), 1)
+        self.ae(store.open(db, 1, 60, 80, mtime, 'jpeg')[1], False)
+        self.ae(store.most_requested_sizes()[0], (60, 80, 'jpeg'))
+        # A new store picks up existing thumbnails
+        store2 = ThumbnailStore(store.path, store.max_size)
+        self.ae(store2.open(db, 1, 60, 80, mtime, 'jpeg')[1], True)
+    # }}}
+
+    def test_opds_acquisition_feed(self):  # {{{
+        'Test the streamed OPDS acquisition feeds'
+        from calibre.utils.xml_parse import safe_xml_fromstring
+        from polyglot.binary import as_hex_unicode
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            entries = server.handler.router.ctx.library_broker.opds_entry_caches[db.server_library_id]
+            conn = server.connect()
+
+            def titles():
+                conn.request('GET', '/opds/navcatalog/' + as_hex_unicode('Otitle'))
+                r = conn.getresponse()
+                self.ae(r.status, http_client.OK)
+                self.ae(r.getheader('Transfer-Encoding'), 'chunked')
+                root = safe_xml_fromstring(r.read())
+                return [x.text for x in root.xpath('//*[local-name()="entry"]/*[local-name()="title"]')]
+
+            self.ae(set(titles()), set(db.all_field_for('title', db.all_book_ids()).values()))
+            self.ae(set(entries), db.all_book_ids())
+            first = dict(entries)
+            titles()
+            for book_id in first:
+                self.assertIs(first[book_id], entries[book_id])
+            db.set_field('title', {1: 'AAA changed'})
+            self.ae(titles()[0], 'AAA changed')
+            self.assertIsNot(first[1], entries[1])
+            self.assertIs(first[2], entries[2])
+    # }}}
+
     def test_char_count(self):  # {{{
         from calibre.srv.render_book import get_length
         from calibre.ebooks.oeb.parse_utils import html5_parse
@@ -263,3 +387,92 @@ def t(html, body_children, nsmap=('http://www.w3.org/1999/xhtml',)):
         text = 'a' * (127 * 1024)
         t('<p>{0}<p>{0}'.format(text), [{"n":"p","x":text}, {'n':'p','x':text}])
     # }}}
+
+    def test_render_cache(self):  # {{{
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.render_book import SimpleContainer, manifest_key, process_book_files
+        from calibre.utils.logging import default_log
+        files = {
+            'content.opf': '''<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="uid">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Test</dc:title><dc:identifier id="uid">x</dc:identifier></metadata>
+<manifest><item id="a" href="a.html" media-type="application/xhtml+xml"/><item id="b" href="b.html" media-type="application/xhtml+xml"/>
+<item id="s" href="s.css" media-type="text/css"/></manifest><spine><itemref idref="a"/><itemref idref="b"/></spine></package>''',
+            'a.html': '<html xmlns="http://www.w3.org/1999/xhtml"><head><link rel="stylesheet" href="s.css"/></head>'
+            '<body><p id="one">One <a href="b.html#two">link</a></p></body></html>',
+            'b.html': '<html xmlns="http://www.w3.org/1999/xhtml"><body><p id="two">Two</p></body></html>',
+            's.css': 'p { color: red }',
+        }
+        names = ('a.html', 'b.html', 's.css')
+
+        def render(tdir, link_uid, cache_dir=None, changed=None):
+            for name, raw in files.items():
+                if name == changed:
+                    raw = raw.replace('Two', 'Three')
+                with open(os.path.join(tdir, name), 'wb') as f:
+                    f.write(raw.encode('utf-8'))
+            opfpath = os.path.join(tdir, 'content.opf')
+            c = SimpleContainer(tdir, opfpath, default_log)
+            render_cache = None if cache_dir is None else (cache_dir, manifest_key(c))
+            ans = process_book_files(names, tdir, opfpath, True, link_uid, None, render_cache, container=c)
+            output = {}
+            for name in names:
+                with open(os.path.join(tdir, name), 'rb') as f:
+                    output[name] = f.read()
+            return ans, output
+
+        with TemporaryDirectory() as cache_dir:
+            for changed in (None, 'b.html'):
+                with TemporaryDirectory() as a, TemporaryDirectory() as b, TemporaryDirectory() as c:
+                    render(a, 'uid1', cache_dir, changed)
+                    cached = render(b, 'uid2', cache_dir, changed)
+                    uncached = render(c, 'uid2', changed=changed)
+                    self.ae(cached, uncached)
+                    self.assertIn(b'uid2', cached[1]['a.html'])
+                    self.assertNotIn(b'uid1', cached[1]['a.html'])
+            entries = [x for dirpath, dirnames, filenames in os.walk(cache_dir) for x in filenames]
+            # Only the changed file needed to be processed again
+            self.ae(len(entries), len(names) + 1)
+
+        # The size of the cache is kept within its maximum size after every
+        # render, the age based cleanup is only done once in a while
+        import calibre.srv.books as books
+        from calibre.utils.config_base import Tweak
+        orig = books.cache_dir, books._books_cache_dir, books.last_final_clean_time, books.cache_size_estimate
+        with TemporaryDirectory() as tdir, Tweak('content_server_book_cache_size', 1):
+            books.cache_dir = lambda: tdir
+            books._books_cache_dir, books.last_final_clean_time, books.cache_size_estimate = None, 0, None
+            try:
+                fdir = os.path.join(books.books_cache_dir(), 'f')
+
+                def store(name, size, age=0, clean=True):
+                    path = os.path.join(fdir, name)
+                    os.mkdir(path)
+                    mpath = os.path.join(path, 'calibre-book-manifest.json')
+                    with open(mpath, 'wb') as f:
+                        f.write(b'x' * size)
+                    tm = time.time() - age
+                    os.utime(mpath, (tm, tm))
+                    if clean:
+                        books.clean_final(new_book=path)
+                    return path
+
+                day = 24 * 60 * 60
+                old = store('old', 1000, age=2 * day, clean=False)
+                first = store('first', 250 * 1024, age=10)
+                self.assertFalse(os.path.exists(old))
+                for i in range(3):
+                    store('b%d' % i, 250 * 1024, age=9 - i)
+                self.ae(sorted(os.listdir(fdir)), ['b0', 'b1', 'b2', 'first'])
+                store('b3', 250 * 1024)
+                self.assertFalse(os.path.exists(first))
+                self.ae(sorted(os.listdir(fdir)), ['b0', 'b1', 'b2', 'b3'])
+                old = store('old', 1000, age=2 * day)
+                self.assertTrue(os.path.exists(old))
+                total = sum(books.tree_size(os.path.join(fdir, x)) for x in os.listdir(fdir))
+                self.assertLessEqual(total, 1024 * 1024)
+                # A book larger than the maximum size is kept when it is stored
+                store('big', 2 * 1024 * 1024)
+                self.ae(os.listdir(fdir), ['big'])
+            finally:
+                books.cache_dir, books._books_cache_dir, books.last_final_clean_time, books.cache_size_estimate = orig
+    # }}}
@@ -11,6 +11,7 @@
 from glob import glob
 from threading import Event
 
+from calibre.constants import iswindows
 from calibre.srv.pre_activated import has_preactivated_support
 from calibre.srv.tests.base import BaseTest, TestServer
 from calibre.ptempfile import TemporaryDirectory
@@ -191,6 +192,37 @@ def set(data, rpos, wpos, state):
         set(b'123456\n7', 4, 2, READ)
         self.ae(buf.readline(), b'56\n')
 
+    def test_pollers(self):
+        'Test serving many idle connections with both pollers'
+        from calibre.srv.loop import SelectorPoller
+        for use_select in (False, True):
+            server = TestServer(lambda data:(data.path[0] + data.read().decode('utf-8')), timeout=5)
+            server.loop.use_select = use_select
+            with server:
+                idle = [socket.create_connection(server.address, timeout=5) for i in range(50)]
+                for i in range(200):
+                    if server.loop.num_active_connections >= len(idle):
+                        break
+                    time.sleep(0.01)
+                self.ae(server.loop.num_active_connections, len(idle))
+                self.ae(isinstance(server.loop.poller, SelectorPoller), not use_select and not iswindows)
+                for i in range(3):
+                    conn = server.connect()
+                    conn.request('GET', '/test', 'body%d' % i)
+                    r = conn.getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(r.read(), ('testbody%d' % i).encode('ascii'))
+                    conn.close()
+                # Connections closed by the client are removed from the poller
+                for s in idle:
+                    s.close()
+                for i in range(200):
+                    if server.loop.num_active_connections == 0 and len(server.loop.poller.interest) == 2:
+                        break
+                    time.sleep(0.01)
+                self.ae(server.loop.num_active_connections, 0)
+                self.ae(len(server.loop.poller.interest), 2)
+
     def test_ssl(self):
         'Test serving over SSL'
         address = '127.0.0.1'
@@ -298,6 +330,116 @@ def job_status(jid):
         jm.start_job('simple test', 'calibre.srv.jobs', 'sleep_test', args=(1.0,))
         jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
 
+    def test_jobs_scheduling(self):
+        'Test the order in which waiting jobs are started'
+        from calibre.srv.jobs import (
+            PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, PRIORITY_USER, JobQueue,
+            JobsManager, StartEvent
+        )
+        q = JobQueue()
+
+        def ev(job_id, priority, user):
+            return StartEvent(job_id, 'test', 'calibre.srv.jobs', 'sleep_test', (0,), {}, None, None, False, priority, user, monotonic())
+
+        for i in range(5):
+            q.append(ev(i, PRIORITY_USER, 'a'))
+        q.append(ev(5, PRIORITY_USER, 'b'))
+        q.append(ev(6, PRIORITY_BACKGROUND, 'b'))
+        q.append(ev(7, PRIORITY_INTERACTIVE, 'c'))
+        self.assertEqual(q.depths(), {'user': 6, 'background': 1, 'interactive': 1})
+        self.assertEqual(q.users(), {'a': 5, 'b': 2, 'c': 1})
+        # Users with jobs of the same priority take turns
+        self.assertEqual([q.popleft().job_id for i in range(len(q))], [7, 0, 5, 1, 2, 3, 4, 6])
+
+        # Jobs are held back when there is not enough memory, except for the first one
+        O = namedtuple('O', 'max_jobs max_job_time')
+        jm = JobsManager(O(2, 5), None)
+        jm.min_free_memory, jm.available_memory = 1, lambda: 0
+        try:
+            job_ids = [jm.start_job('test', 'calibre.srv.jobs', 'sleep_test', args=(1.0,)) for i in range(2)]
+            while jm.job_status(job_ids[0])[0] == 'waiting':
+                time.sleep(0.01)
+            self.assertEqual(jm.job_status(job_ids[1])[0], 'waiting')
+            stats = jm.stats()
+            self.assertTrue(stats['held_back_for_memory'])
+            self.assertEqual(stats['waiting'], {'user': 1})
+            jm.available_memory = lambda: 2
+            while jm.job_status(job_ids[1])[0] == 'waiting':
+                time.sleep(0.01)
+            self.assertEqual(jm.stats()['wait_times']['user']['count'], 2)
+        finally:
+            jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
+
+    def test_process_pool(self):
+        'Test the pool of worker processes'
+        from calibre.srv.pool import ProcessPool
+        from calibre.utils.ipc.simple_worker import WorkerError
+        pool = ProcessPool(1, max_jobs_per_worker=2)
+        try:
+            w = pool.acquire()
+            pid = w.worker.pid
+            self.assertIsNone(pool.acquire(timeout=0.01))
+            pool.release(w)
+            self.assertEqual(pool.run_job('calibre.srv.jobs', 'sleep_test', args=(0.01,))['result'], 0.01)
+            # The worker has run two jobs and so must have been replaced
+            w = pool.acquire()
+            self.assertNotEqual(pid, w.worker.pid)
+            with self.assertRaises(WorkerError) as cm:
+                pool.call(w, 'calibre.srv.jobs', 'error_test')
+            self.assertIn('a testing error', cm.exception.orig_tb)
+            abort = Event()
+            abort.set()
+            self.assertIsNone(pool.call(w, 'calibre.srv.jobs', 'sleep_test', args=(10,), abort=abort))
+            pool.release(w, failed=True)
+            self.assertEqual(pool.num_workers, 0)
+            # Jobs that take too long are killed
+            w = pool.acquire()
+            with self.assertRaises(WorkerError) as cm:
+                pool.call(w, 'calibre.srv.jobs', 'sleep_test', args=(10,), timeout=0.2)
+            self.assertIn('timed out', str(cm.exception))
+            pool.release(w, failed=True)
+            self.assertEqual(pool.num_workers, 0)
+            with self.assertRaises(WorkerError):
+                pool.run_job('calibre.srv.jobs', 'sleep_test', args=(10,), timeout=0.2)
+            self.assertEqual(pool.num_workers, 0)
+        finally:
+            pool.shutdown()
+
+        # Workers that cannot be started
+        class FailingPool(ProcessPool):
+
+            def start_worker(self):
+                raise EnvironmentError('a testing failure to start a worker')
+
+        pool = FailingPool(1)
+        try:
+            with self.assertRaises(WorkerError) as cm:
+                pool.run_job('calibre.srv.jobs', 'sleep_test', args=(0.01,))
+            self.assertIn('a testing failure', cm.exception.orig_tb)
+            self.assertEqual(pool.num_workers, 0)
+        finally:
+            pool.shutdown()
+        from calibre.srv.jobs import JobsManager
+        O = namedtuple('O', 'max_jobs max_job_time')
+
+        class FakeLog(list):
+
+            def error(self, *args):
+                self.append(' '.join(args))
+        jm = JobsManager(O(1, 5), FakeLog())
+        jm.worker_pool = FailingPool(1)
+        try:
+            job_id = jm.start_job('fail to start', 'calibre.srv.jobs', 'sleep_test', args=(0.01,), in_pool=True)
+            end = monotonic() + 5
+            while jm.job_status(job_id)[0] in ('waiting', 'running') and monotonic() < end:
+                time.sleep(0.01)
+            status, result, tb, was_aborted = jm.job_status(job_id)
+            self.assertEqual(status, 'finished')
+            self.assertIsNone(result)
+            self.assertIn('a testing failure', tb)
+        finally:
+            jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
+
 
 def find_tests():
     import unittest
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+import json
+import os
+import socket
+import time
+from multiprocessing.connection import Pipe
+from unittest import skipIf
+
+from calibre.constants import iswindows
+from calibre.srv.tests.base import LibraryBaseTest, TestServer
+from calibre.utils.logging import ThreadSafeLog
+from polyglot import http_client
+
+
+class PreforkTest(LibraryBaseTest):
+
+    @skipIf(not hasattr(socket, 'SO_REUSEPORT'), 'SO_REUSEPORT not available')
+    def test_reuse_port(self):
+        'Test servers sharing a port'
+        def handler(data):
+            return data.path[0] + data.read().decode('utf-8')
+        first = TestServer(handler)
+        first.loop.reuse_port = True
+        with first:
+            second = TestServer(handler, port=first.address[1])
+            second.loop.reuse_port = True
+            with second:
+                self.ae(first.address, second.address)
+                for i in range(10):
+                    conn = first.connect()
+                    conn.request('GET', '/test', 'body')
+                    r = conn.getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(r.read(), b'testbody')
+                    conn.close()
+
+    def test_change_propagation(self):
+        'Test that changes made by one worker are applied in the others'
+        from calibre.srv.changes import metadata
+        from calibre.srv.library_broker import LibraryBroker
+        from calibre.srv.prefork import ChangesRelay, start_change_listener
+        brokers = LibraryBroker([self.library_path]), LibraryBroker([self.library_path])
+        writer, reader = (b.get().new_api for b in brokers)
+        self.ae(writer.field_for('title', 1), reader.field_for('title', 1))
+        worker_conn, coordinator_in = Pipe()
+        coordinator_out, listener_conn = Pipe()
+        start_change_listener(listener_conn, brokers[1], ThreadSafeLog(level=ThreadSafeLog.ERROR))
+
+        writer.set_field('title', {1: 'changed by another worker'})
+        ChangesRelay(worker_conn)(writer.backend.library_path, metadata({1}))
+        # The coordinator forwards the change to the other workers
+        coordinator_out.send(coordinator_in.recv())
+        for i in range(500):
+            if reader.field_for('title', 1) == 'changed by another worker':
+                break
+            time.sleep(0.01)
+        self.ae(reader.field_for('title', 1), 'changed by another worker')
+        coordinator_out.close()
+        for b in brokers:
+            b.close()
+
+    def test_change_notification(self):
+        'Test that changes made through the server are sent to the other workers'
+        from calibre.srv.changes import AnnotationsChanged
+        events = []
+        with self.create_server() as server:
+            ctx = server.handler.router.ctx
+            ctx._notify_changes = lambda library_path, change_event: events.append(change_event)
+            db = ctx.library_broker.get(None)
+            conn = server.connect()
+            for path, data in (
+                ('/book-set-last-read-position', {'device': 'test', 'cfi': '/2/4', 'pos_frac': 0.5}),
+                ('/book-update-annotations', {}),
+            ):
+                conn.request('POST', ctx.url_for(path, library_id=db.server_library_id, book_id=1, fmt='FMT1'), body=json.dumps(data))
+                r = conn.getresponse()
+                r.read()
+                self.ae(r.status, http_client.OK)
+        self.ae([type(e) for e in events], [AnnotationsChanged, AnnotationsChanged])
+        self.ae(events[0].book_ids, {1})
+
+    @skipIf(iswindows, 'fork() not available')
+    def test_coordinator(self):
+        'Test the coordinator relaying changes between workers and restarting them'
+        from calibre.srv import prefork
+        from calibre.srv.prefork import Coordinator
+        report_conn, worker_report_conn = Pipe(duplex=False)
+
+        def run_worker(conn):
+            # Announce a change, then report the changes from other workers
+            conn.send(os.getpid())
+            while True:
+                try:
+                    msg = conn.recv()
+                except EOFError:
+                    break
+                if msg == 'exit':
+                    break
+                worker_report_conn.send((os.getpid(), msg))
+
+        def relay(pids):
+            # What Coordinator.serve_forever() does for each worker
+            for pid in pids:
+                conn = c.workers[pid]['conn']
+                self.assertTrue(conn.poll(10))
+                c.broadcast(pid, conn.recv())
+
+        def reports(num):
+            ans = {}
+            for i in range(num):
+                self.assertTrue(report_conn.poll(10))
+                pid, msg = report_conn.recv()
+                ans.setdefault(pid, set()).add(msg)
+            return ans
+
+        def wait_for_exit(pid):
+            for i in range(500):
+                c.reap()
+                if pid not in c.workers:
+                    break
+                time.sleep(0.01)
+            self.assertNotIn(pid, c.workers)
+
+        orig_lifetime = prefork.MIN_WORKER_LIFETIME
+        c = Coordinator(3, run_worker, ThreadSafeLog(level=ThreadSafeLog.ERROR))
+        try:
+            for i in range(c.num_workers):
+                c.spawn()
+            pids = set(c.workers)
+            self.ae(len(pids), 3)
+            relay(pids)
+            self.ae(reports(6), {pid: pids - {pid} for pid in pids})
+
+            # A worker that exits is restarted
+            prefork.MIN_WORKER_LIFETIME = 0
+            victim = min(pids)
+            c.workers[victim]['conn'].send('exit')
+            wait_for_exit(victim)
+            self.ae(len(c.workers), 3)
+            new_pid = (set(c.workers) - pids).pop()
+            relay((new_pid,))
+            self.ae(reports(2), {pid: {new_pid} for pid in pids - {victim}})
+            self.assertFalse(c.stopped)
+
+            # A worker that exits soon after being started stops the server
+            prefork.MIN_WORKER_LIFETIME = 1000
+            c.workers[new_pid]['conn'].send('exit')
+            wait_for_exit(new_pid)
+            self.assertTrue(c.stopped)
+            self.ae(len(c.workers), 2)
+        finally:
+            prefork.MIN_WORKER_LIFETIME = orig_lifetime
+            c.shutdown()
+        self.ae(c.workers, {})
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2020, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A store of rendered cover thumbnails, kept as files on disk so they can be
+sent using sendfile() and shared by all server processes. Requested sizes
+are rounded up into buckets, so that the many slightly different sizes
+browsers ask for, depending on their device pixel ratio, map onto a few
+files. The store is limited in total size, the least recently used
+thumbnails are removed first.
+'''
+
+import os
+import tempfile
+from collections import Counter, OrderedDict
+from hashlib import sha1
+from threading import Lock, Thread
+
+from calibre import fit_image
+from calibre.constants import cache_dir
+from calibre.utils.config_base import tweaks
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.serialize import json_dumps
+from calibre.utils.shared_file import share_open
+from polyglot.builtins import as_unicode
+from polyglot.queue import Queue
+
+# Increase this to invalidate all stored thumbnails when the way they are
+# rendered changes
+THUMBNAIL_VERSION = 1
+# The number of most requested sizes to render when warming the store
+NUM_WARM_SIZES = 3
+
+
+def default_store_path():
+    return os.path.join(cache_dir(), 'srvt')
+
+
+def size_bucket(width, height):
+    ' Round the requested size up, in steps that grow with the size '
+    def bucket(x):
+        step = 20 if x <= 400 else 100
+        return max(step, ((x + step - 1) // step) * step)
+    return bucket(width), bucket(height)
+
+
+_webp_supported = None
+
+
+def webp_supported():
+    global _webp_supported
+    if _webp_supported is None:
+        from qt.core import QImageWriter
+        _webp_supported = 'webp' in {x.data().decode('utf-8') for x in QImageWriter.supportedImageFormats()}
+    return _webp_supported
+
+
+def thumbnail_format(accept_header):
+    ' The format to use for clients that send the specified Accept header '
+    if accept_header and 'image/webp' in accept_header and webp_supported():
+        return 'webp'
+    return 'jpeg'
+
+
+def compression_quality():
+    return min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
+
+
+def render_thumbnail(cover_data, width, height, fmt):
+    from qt.core import Qt
+    from calibre.utils.img import image_from_data, image_to_data
+    img = image_from_data(cover_data)
+    scaled, nwidth, nheight = fit_image(img.width(), img.height(), width, height)
+    if scaled:
+        img = img.scaled(nwidth, nheight, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+    return image_to_data(img, compression_quality=compression_quality(), fmt=fmt)
+
+
+class ThumbnailStore(object):
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = Lock()
+        self.index = None
+        self.total_size = 0
+        self.requested_sizes = Counter()
+        self.warm_queue = Queue()
+        self.warm_thread = None
+
+    def thumbnail_path(self, library_uuid, book_id, width, height, mtime, fmt):
+        raw = json_dumps((library_uuid, book_id, width, height, mtime, fmt, compression_quality(), THUMBNAIL_VERSION))
+        h = as_unicode(sha1(raw).hexdigest())
+        return os.path.join(self.path, h[:2], h + ('.jpg' if fmt == 'jpeg' else '.' + fmt))
+
+    def ensure_index(self):
+        # Build the index of existing thumbnails, oldest first, on first use
+        if self.index is not None:
+            return
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except EnvironmentError:
+                    continue
+                if name.endswith('.tmp'):
+                    # Left over from a crash while writing
+                    try:
+                        os.remove(path)
+                    except EnvironmentError:
+                        pass
+                    continue
+                entries.append((st.st_mtime, path, st.st_size))
+        entries.sort()
+        self.index = OrderedDict((path, size) for mtime, path, size in entries)
+        self.total_size = sum(size for mtime, path, size in entries)
+
+    def add(self, path, data):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except EnvironmentError:
+            pass
+        fd, tpath = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        atomic_rename(tpath, path)
+        with self.lock:
+            self.ensure_index()
+            self.total_size += len(data) - self.index.pop(path, 0)
+            self.index[path] = len(data)
+            self.evict()
+
+    def evict(self):
+        while self.total_size > self.max_size and len(self.index) > 1:
+            path, size = self.index.popitem(last=False)
+            self.total_size -= size
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                pass
+
+    def open(self, db, book_id, width, height, mtime, fmt, count_request=True):
+        ''' Return an open file containing the thumbnail for the specified
+        book and whether it was already present in the store, rendering it if
+        necessary. '''
+        if count_request:
+            with self.lock:
+                self.requested_sizes[(width, height, fmt)] += 1
+        path = self.thumbnail_path(db.library_id, book_id, width, height, mtime, fmt)
+        try:
+            ans = share_open(path, 'rb')
+        except EnvironmentError:
+            pass
+        else:
+            with self.lock:
+                self.ensure_index()
+                if path in self.index:
+                    self.index.move_to_end(path)
+            return ans, True
+        cdata = db.cover(book_id)
+        if not cdata:
+            raise KeyError('The book %r has no cover' % book_id)
+        self.add(path, render_thumbnail(cdata, width, height, fmt))
+        return share_open(path, 'rb'), False
+
+    def most_requested_sizes(self):
+        with self.lock:
+            return tuple(x for x, count in self.requested_sizes.most_common(NUM_WARM_SIZES))
+
+    def warm(self, db, book_ids):
+        ''' Render thumbnails in the most requested sizes for the specified
+        books in the background '''
+        sizes = self.most_requested_sizes()
+        if not sizes or not book_ids:
+            return
+        self.warm_queue.put((db, tuple(book_ids), sizes))
+        with self.lock:
+            if self.warm_thread is None:
+                self.warm_thread = t = Thread(target=self.warm_worker, name='WarmThumbnails')
+                t.daemon = True
+                t.start()
+
+    def warm_worker(self):
+        while True:
+            db, book_ids, sizes = self.warm_queue.get()
+            for book_id in book_ids:
+                try:
+                    mtime = db.cover_last_modified(book_id)
+                    if mtime is None:
+                        continue
+                    for width, height, fmt in sizes:
+                        self.open(db, book_id, width, height, mtime, fmt, count_request=False)[0].close()
+                except Exception:
+                    # The book may have been deleted or the library closed
+                    pass
+
@@ -17,7 +17,7 @@
 from calibre.constants import DEBUG
 from calibre.utils.formatter_functions import formatter_functions
 from calibre.utils.icu import strcmp
-from polyglot.builtins import unicode_type, error_message
+from polyglot.builtins import error_message, itervalues, unicode_type
 
 
 class Node(object):
@@ -683,7 +683,7 @@ def error(self, message, line_number):
         raise ValueError(m)
 
     def program(self, funcs, parent, prog, val, is_call=False, args=None,
-                global_vars=None, break_reporter=None):
+                global_vars=None, break_reporter=None, compiled=None):
         self.parent = parent
         self.parent_kwargs = parent.kwargs
         self.parent_book = parent.book
@@ -698,7 +698,12 @@ def program(self, funcs, parent, prog, val, is_call=False, args=None,
             self.break_reporter = None
 
         try:
-            if is_call:
+            if compiled is not None and self.break_reporter is None:
+                # compiled is prog compiled by _Compiler
+                if is_call:
+                    self.locals = {'*arg_' + str(dex): v for dex, v in enumerate(args)}
+                ret = compiled(self)
+            elif is_call:
                 ret =  self.do_node_call(CallNode(1, prog, None), args=args)
             else:
                 ret = self.expression_list(prog)
@@ -1132,10 +1137,480 @@ def expr(self, prog):
         except (ValueError, ExecutionBase, StopException) as e:
             raise e
         except Exception as e:
-            if (DEBUG):
-                traceback.print_exc()
-            self.error(_("Internal error evaluating an expression: '{0}'").format(str(e)),
-                       prog.line_number)
+            self.internal_error(e, prog.line_number)
+
+    def internal_error(self, e, line_number):
+        if (DEBUG):
+            traceback.print_exc()
+        self.error(_("Internal error evaluating an expression: '{0}'").format(str(e)),
+                   line_number)
+
+
+class _Compiler(object):
+    '''
+    Compiles the tree produced by :class:`_Parser` into a tree of closures,
+    which is much faster to execute than walking the tree in the interpreter,
+    as the dispatch on node type and the checks for the break reporter are
+    done once, at compile time. The closures take the :class:`_Interpreter`
+    as their only argument and use its state (locals, globals, the book
+    being formatted, etc.), they must behave exactly as the corresponding
+    do_node_* methods do when there is no break reporter, including the
+    errors they raise. The interpreter is still used when there is a break
+    reporter, i.e. in the template tester/debugger.
+    '''
+
+    def compile(self, prog):
+        ' Compile a program, i.e. a list of expressions '
+        return self.expression_list(prog)
+
+    def expression_list(self, prog):
+        exprs = tuple(self.expr(p) for p in prog)
+        if len(exprs) == 1:
+            f = exprs[0]
+
+            def run(ctx):
+                try:
+                    return f(ctx)
+                except (BreakExecuted, ContinueExecuted) as e:
+                    e.set_value('')
+                    raise e
+            return run
+
+        def run(ctx):
+            val = ''
+            try:
+                for f in exprs:
+                    val = f(ctx)
+            except (BreakExecuted, ContinueExecuted) as e:
+                e.set_value(val)
+                raise e
+            return val
+        return run
+
+    def expr(self, prog):
+        if isinstance(prog, list):
+            return self.expression_list(prog)
+        return self.NODE_COMPILERS[prog.node_type](self, prog)
+
+    def compile_string_infix(self, prog):
+        left, right = self.expr(prog.left), self.expr(prog.right)
+        op, line_number = _Interpreter.INFIX_STRING_COMPARE_OPS.get(prog.operator), prog.line_number
+        message = _("Error during string comparison: operator '{0}'").format(prog.operator)
+
+        def run(ctx):
+            try:
+                return '1' if op(left(ctx), right(ctx)) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ctx.error(message, line_number)
+        return run
+
+    def compile_numeric_infix(self, prog):
+        left, right = self.expr(prog.left), self.expr(prog.right)
+        op, line_number = _Interpreter.INFIX_NUMERIC_COMPARE_OPS.get(prog.operator), prog.line_number
+        message = _("Value used in comparison is not a number: operator '{0}'").format(prog.operator)
+
+        def run(ctx):
+            try:
+                fdn = ctx.float_deal_with_none
+                return '1' if op(fdn(left(ctx)), fdn(right(ctx))) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ctx.error(message, line_number)
+        return run
+
+    def compile_if(self, prog):
+        condition = self.expr(prog.condition)
+        then_part = self.expression_list(prog.then_part)
+        else_part = self.expression_list(prog.else_part) if prog.else_part else None
+
+        def run(ctx):
+            if condition(ctx):
+                return then_part(ctx)
+            if else_part is not None:
+                return else_part(ctx)
+            return ''
+        return run
+
+    def compile_rvalue(self, prog):
+        name, line_number = prog.name, prog.line_number
+
+        def run(ctx):
+            try:
+                return ctx.locals[name]
+            except:
+                ctx.error(_("Unknown identifier '{0}'").format(name), line_number)
+        return run
+
+    def compile_func(self, prog):
+        args = tuple(self.expr(arg) for arg in prog.expression_list)
+        id_, line_number = prog.name.strip(), prog.line_number
+
+        def run(ctx):
+            try:
+                return ctx.funcs[id_].eval_(ctx.parent, ctx.parent_kwargs, ctx.parent_book,
+                                            ctx.locals, *[a(ctx) for a in args])
+            except (ValueError, ExecutionBase, StopException) as e:
+                raise e
+            except Exception as e:
+                ctx.internal_error(e, line_number)
+        return run
+
+    def compile_call(self, prog):
+        args = tuple(self.expr(arg) for arg in prog.expression_list)
+        # The called template is compiled when it is first run, as stored
+        # templates can be recursive
+        function = prog.function
+        body = None
+
+        def run(ctx):
+            nonlocal body
+            vals = [a(ctx) for a in args]
+            if body is None:
+                body = self.expression_list(function)
+            saved_locals = ctx.locals
+            ctx.locals = {'*arg_' + str(dex): v for dex, v in enumerate(vals)}
+            try:
+                val = body(ctx)
+            except ReturnExecuted as e:
+                val = e.get_value()
+            ctx.locals = saved_locals
+            return val
+        return run
+
+    def compile_arguments(self, prog):
+        args = tuple(('*arg_' + str(dex), arg.left, self.expr(arg.right)) for dex, arg in enumerate(prog.expression_list))
+
+        def run(ctx):
+            for key, name, default in args:
+                ctx.locals[name] = ctx.locals.get(key, default(ctx))
+            return ''
+        return run
+
+    def compile_globals(self, prog):
+        args = tuple((arg.left, self.expr(arg.right)) for arg in prog.expression_list)
+
+        def run(ctx):
+            res = ''
+            for name, default in args:
+                res = ctx.locals[name] = ctx.global_vars.get(name, default(ctx))
+            return res
+        return run
+
+    def compile_set_globals(self, prog):
+        args = tuple((arg.left, self.expr(arg.right)) for arg in prog.expression_list)
+
+        def run(ctx):
+            res = ''
+            for name, default in args:
+                res = ctx.global_vars[name] = ctx.locals.get(name, default(ctx))
+            return res
+        return run
+
+    def compile_constant(self, prog):
+        value = prog.value
+        return lambda ctx: value
+
+    def compile_field(self, prog):
+        expression, line_number = self.expr(prog.expression), prog.line_number
+
+        def run(ctx):
+            try:
+                name = expression(ctx)
+                try:
+                    return ctx.parent.get_value(name, [], ctx.parent_kwargs)
+                except:
+                    ctx.error(_("Unknown field '{0}'").format(name), line_number)
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ctx.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return run
+
+    def compile_raw_field(self, prog):
+        expression, line_number = self.expr(prog.expression), prog.line_number
+        default = None if prog.default is None else self.expr(prog.default)
+
+        def run(ctx):
+            try:
+                name = expression(ctx)
+                res = getattr(ctx.parent_book, name, None)
+                if res is None and default is not None:
+                    return default(ctx)
+                if res is not None and isinstance(res, list):
+                    fm = ctx.parent_book.metadata_for_field(name)
+                    if fm is None:
+                        return ', '.join(res)
+                    return fm['is_multiple']['list_to_ui'].join(res)
+                return unicode_type(res)
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ctx.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return run
+
+    def compile_assign(self, prog):
+        name, right = prog.left, self.expr(prog.right)
+
+        def run(ctx):
+            t = ctx.locals[name] = right(ctx)
+            return t
+        return run
+
+    def compile_first_non_empty(self, prog):
+        exprs = tuple(self.expr(e) for e in prog.expression_list)
+
+        def run(ctx):
+            for expr in exprs:
+                if v := expr(ctx):
+                    return v
+            return ''
+        return run
+
+    def compile_for(self, prog):
+        line_number, variable = prog.line_number, prog.variable
+        separator = None if prog.separator is None else self.expr(prog.separator)
+        list_field_expr = self.expr(prog.list_field_expr)
+        block = self.expression_list(prog.block)
+
+        def run(ctx):
+            try:
+                sep = ',' if separator is None else separator(ctx)
+                f = list_field_expr(ctx)
+                res = getattr(ctx.parent_book, f, f)
+                if res is not None:
+                    if not isinstance(res, list):
+                        res = [r.strip() for r in res.split(sep) if r.strip()]
+                    ret = ''
+                    try:
+                        for x in res:
+                            try:
+                                ctx.locals[variable] = x
+                                ret = block(ctx)
+                            except ContinueExecuted as e:
+                                ret = e.get_value()
+                    except BreakExecuted as e:
+                        ret = e.get_value()
+                return ret
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception as e:
+                ctx.error(_("Unhandled exception '{0}'").format(e), line_number)
+        return run
+
+    def compile_break(self, prog):
+        def run(ctx):
+            raise BreakExecuted()
+        return run
+
+    def compile_continue(self, prog):
+        def run(ctx):
+            raise ContinueExecuted()
+        return run
+
+    def compile_return(self, prog):
+        expr = self.expr(prog.expr)
+
+        def run(ctx):
+            e = ReturnExecuted()
+            e.set_value(expr(ctx))
+            raise e
+        return run
+
+    def compile_contains(self, prog):
+        value_expression, test_expression = self.expr(prog.value_expression), self.expr(prog.test_expression)
+        match_expression, not_match_expression = self.expr(prog.match_expression), self.expr(prog.not_match_expression)
+        line_number = prog.line_number
+
+        def run(ctx):
+            v = value_expression(ctx)
+            t = test_expression(ctx)
+            try:
+                matched = re.search(t, v, flags=re.I)
+            except Exception as e:
+                ctx.internal_error(e, line_number)
+            if matched:
+                return match_expression(ctx)
+            return not_match_expression(ctx)
+        return run
+
+    def compile_logop(self, prog):
+        left, right, line_number = self.expr(prog.left), self.expr(prog.right), prog.line_number
+        op = {
+            'and': lambda ctx: left(ctx) and right(ctx),
+            'or': lambda ctx: left(ctx) or right(ctx),
+        }.get(prog.operator)
+
+        def run(ctx):
+            try:
+                return '1' if op(ctx) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ctx.error(_("Error during operator evaluation: "
+                            "operator '{0}'").format(prog.operator), line_number)
+        return run
+
+    def compile_logop_unary(self, prog):
+        expr, line_number = self.expr(prog.expr), prog.line_number
+        op = _Interpreter.LOGICAL_UNARY_OPS.get(prog.operator)
+
+        def run(ctx):
+            try:
+                return '1' if op(expr(ctx)) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ctx.error(_("Error during operator evaluation: "
+                            "operator '{0}'").format(prog.operator), line_number)
+        return run
+
+    def compile_binary_arithop(self, prog):
+        left, right, line_number = self.expr(prog.left), self.expr(prog.right), prog.line_number
+        op = _Interpreter.ARITHMETIC_BINARY_OPS.get(prog.operator)
+
+        def run(ctx):
+            try:
+                answer = op(float(left(ctx)), float(right(ctx)))
+                return unicode_type(answer if modf(answer)[0] != 0 else int(answer))
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ctx.error(_("Error during operator evaluation: "
+                            "operator '{0}'").format(prog.operator), line_number)
+        return run
+
+    def compile_unary_arithop(self, prog):
+        expr, line_number = self.expr(prog.expr), prog.line_number
+        op = _Interpreter.ARITHMETIC_UNARY_OPS.get(prog.operator)
+
+        def run(ctx):
+            try:
+                answer = op(float(expr(ctx)))
+                return unicode_type(answer if modf(answer)[0] != 0 else int(answer))
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ctx.error(_("Error during operator evaluation: "
+                            "operator '{0}'").format(prog.operator), line_number)
+        return run
+
+    def compile_character(self, prog):
+        expr, line_number = self.expr(prog.expression), prog.line_number
+
+        def run(ctx):
+            key = expr(ctx)
+            ret = ctx.characters.get(key, None)
+            if ret is None:
+                ctx.error(_("Function {0}: invalid character name '{1}")
+                          .format('character', key), line_number)
+            return ret
+        return run
+
+    def compile_print(self, prog):
+        args = tuple(self.expr(arg) for arg in prog.arguments)
+
+        def run(ctx):
+            res = [a(ctx) for a in args]
+            print(res)
+            return res[0] if res else ''
+        return run
+
+    NODE_COMPILERS = {
+        Node.NODE_IF:             compile_if,
+        Node.NODE_ASSIGN:         compile_assign,
+        Node.NODE_CONSTANT:       compile_constant,
+        Node.NODE_RVALUE:         compile_rvalue,
+        Node.NODE_FUNC:           compile_func,
+        Node.NODE_FIELD:          compile_field,
+        Node.NODE_RAW_FIELD:      compile_raw_field,
+        Node.NODE_COMPARE_STRING: compile_string_infix,
+        Node.NODE_COMPARE_NUMERIC:compile_numeric_infix,
+        Node.NODE_ARGUMENTS:      compile_arguments,
+        Node.NODE_CALL:           compile_call,
+        Node.NODE_FIRST_NON_EMPTY:compile_first_non_empty,
+        Node.NODE_FOR:            compile_for,
+        Node.NODE_GLOBALS:        compile_globals,
+        Node.NODE_SET_GLOBALS:    compile_set_globals,
+        Node.NODE_CONTAINS:       compile_contains,
+        Node.NODE_BINARY_LOGOP:   compile_logop,
+        Node.NODE_UNARY_LOGOP:    compile_logop_unary,
+        Node.NODE_BINARY_ARITHOP: compile_binary_arithop,
+        Node.NODE_UNARY_ARITHOP:  compile_unary_arithop,
+        Node.NODE_PRINT:          compile_print,
+        Node.NODE_BREAK:          compile_break,
+        Node.NODE_CONTINUE:       compile_continue,
+        Node.NODE_RETURN:         compile_return,
+        Node.NODE_CHARACTER:      compile_character,
+        }
+
+
+class _UnknownFields(Exception):
+    pass
+
+
+class _FieldsCollector(object):
+    '''
+    Finds the names of the fields a template reads, by walking its parse tree.
+    Raises _UnknownFields if they cannot be determined, for example if the
+    name of a field is computed or a function that could read any field is
+    called.
+    '''
+
+    def __init__(self, formatter, funcs):
+        self.formatter, self.funcs = formatter, funcs
+        self.fields, self.seen = set(), set()
+
+    def program(self, text):
+        f = self.formatter
+        self.tree(f.gpm_parser.program(f, self.funcs, f.lex_scanner.scan(text)))
+
+    def constant(self, prog):
+        while isinstance(prog, (list, tuple)) and len(prog) == 1:
+            prog = prog[0]
+        if isinstance(prog, ConstantNode):
+            return prog.value
+
+    def field(self, name):
+        if name is None:
+            raise _UnknownFields()
+        self.fields.add(name)
+
+    def function(self, func, args):
+        # args are the values of the arguments if they are constants, None
+        # otherwise
+        if func.fields_read is None:
+            raise _UnknownFields()
+        self.fields.update(func.fields_read)
+        for i in func.field_args:
+            self.field(args[i] if i < len(args) else None)
+
+    def tree(self, prog):
+        if isinstance(prog, (list, tuple)):
+            for p in prog:
+                self.tree(p)
+            return
+        if not isinstance(prog, Node):
+            return
+        nt = prog.node_type
+        if nt in (Node.NODE_FIELD, Node.NODE_RAW_FIELD):
+            self.field(self.constant(prog.expression))
+        elif nt == Node.NODE_FOR:
+            # The value of the expression is the name of the field to iterate over
+            self.field(self.constant(prog.list_field_expr))
+        elif nt == Node.NODE_FUNC:
+            self.function(self.funcs[prog.name.strip()], [self.constant(a) for a in prog.expression_list])
+        elif nt == Node.NODE_CALL:
+            # Stored templates can be recursive
+            if id(prog.function) not in self.seen:
+                self.seen.add(id(prog.function))
+                self.tree(prog.function)
+            self.tree(prog.expression_list)
+            return
+        for val in itervalues(vars(prog)):
+            self.tree(val)
 
 
 class TemplateFormatter(string.Formatter):
@@ -1145,6 +1620,9 @@ class TemplateFormatter(string.Formatter):
 
     _validation_string = 'This Is Some Text THAT SHOULD be LONG Enough.%^&*'
 
+    # Compile programs that are cached in the template cache, see _Compiler
+    compile_templates = True
+
     # Dict to do recursion detection. It is up to the individual get_value
     # method to use it. It is cleared when starting to format a template
     composite_values = {}
@@ -1158,6 +1636,7 @@ def __init__(self):
         self.funcs = formatter_functions().get_functions()
         self.gpm_parser = _Parser()
         self.gpm_interpreter = _Interpreter()
+        self.gpm_compiler = _Compiler()
 
     def _do_format(self, val, fmt):
         if not fmt or not val:
@@ -1224,15 +1703,20 @@ def _explode_format_string(self, fmt):
         ], flags=re.DOTALL)
 
     def _eval_program(self, val, prog, column_name, global_vars, break_reporter):
+        # Programs that are run many times, i.e. those in the template cache,
+        # are compiled, others are only run once, so they are interpreted
         if column_name is not None and self.template_cache is not None:
-            tree = self.template_cache.get(column_name, None)
+            tree, compiled = self.template_cache.get(column_name, (None, None))
             if not tree:
                 tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
-                self.template_cache[column_name] = tree
+                compiled = self.gpm_compiler.compile(tree) if self.compile_templates else None
+                self.template_cache[column_name] = tree, compiled
         else:
             tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
+            compiled = None
         return self.gpm_interpreter.program(self.funcs, self, tree, val,
-                                global_vars=global_vars, break_reporter=break_reporter)
+                                global_vars=global_vars, break_reporter=break_reporter,
+                                compiled=compiled)
 
     def _eval_sfm_call(self, template_name, args, global_vars):
         func = self.funcs[template_name]
@@ -1241,9 +1725,62 @@ def _eval_sfm_call(self, template_name, args, global_vars):
             tree = self.gpm_parser.program(self, self.funcs,
                            self.lex_scanner.scan(func.program_text[len('program:'):]))
             func.cached_parse_tree = tree
+        compiled = func.cached_compiled_program
+        if compiled is None or compiled[0] is not tree:
+            compiled = func.cached_compiled_program = tree, self.gpm_compiler.compile(tree)
         return self.gpm_interpreter.program(self.funcs, self, tree, None,
-                                            is_call=True, args=args,
-                                            global_vars=global_vars)
+                                            is_call=True, args=args, global_vars=global_vars,
+                                            compiled=compiled[1] if self.compile_templates else None)
+
+    def fields_used(self, fmt, template_functions=None):
+        '''
+        Return the set of names of the fields read by the template fmt, as
+        they are used in the template, or None if they cannot be determined.
+        '''
+        funcs = template_functions or formatter_functions().get_functions()
+        c = _FieldsCollector(self, funcs)
+        try:
+            if fmt.startswith('program:'):
+                c.program(fmt[len('program:'):])
+                return c.fields
+            for literal, key, spec, conversion in self.parse(fmt):
+                if key:
+                    c.fields.add(key)
+                if not spec:
+                    continue
+                if '{' in spec:
+                    # Nested replacement fields
+                    return None
+                # Same logic as format_field()
+                spec = self._explode_format_string(spec)[0]
+                if spec.startswith('\''):
+                    p = 0
+                else:
+                    p = spec.find(':\'')
+                    if p >= 0:
+                        p += 1
+                if p >= 0 and spec[-1] == '\'':
+                    c.program(spec[p+1:-1])
+                    continue
+                p = spec.find('(')
+                if p < 0 or spec[-1] != ')':
+                    continue
+                colon = spec[0:p].find(':')
+                func = funcs.get(spec[colon + 1:p].strip())
+                if func is None:
+                    continue
+                if not func.is_python:
+                    c.program(func.program_text[len('program:'):])
+                elif func.arg_count == 2:
+                    c.function(func, [None, spec[p+1:-1]])
+                else:
+                    args = self.arg_parser.scan(spec[p+1:])[0]
+                    c.function(func, [None] + [self.backslash_comma_to_comma.sub(',', a) for a in args])
+        except (_UnknownFields, ValueError):
+            # ValueError is raised for invalid templates
+            return None
+        return c.fields
+
     # ################# Override parent classes methods #####################
 
     def get_value(self, key, args, kwargs):
@@ -128,6 +128,14 @@ class FormatterFunction(object):
     arg_count = 0
     aliases = []
     is_python = True
+    # The names of the metadata fields the function reads from the book,
+    # other than those passed to it as arguments. None means unknown, i.e.
+    # the function could read any field, or that its result depends on
+    # something other than the metadata of the book, such as the date.
+    fields_read = None
+    # The indices of the arguments that are the names of fields the function
+    # reads
+    field_args = ()
 
     def evaluate(self, formatter, kwargs, mi, locals, *args):
         raise NotImplementedError()
@@ -144,6 +152,8 @@ def eval_(self, formatter, kwargs, mi, locals, *args):
 
 class BuiltinFormatterFunction(FormatterFunction):
 
+    fields_read = ()
+
     def __init__(self):
         formatter_functions().register_builtin(self)
         eval_func = inspect.getmembers(self.__class__,
@@ -372,6 +382,7 @@ class BuiltinTemplate(BuiltinFormatterFunction):
     name = 'template'
     arg_count = 1
     category = 'Recursion'
+    fields_read = None
 
     __doc__ = doc = _('template(x) -- evaluates x as a template. The evaluation is done '
             'in its own context, meaning that variables are not shared between '
@@ -392,6 +403,7 @@ class BuiltinEval(BuiltinFormatterFunction):
     name = 'eval'
     arg_count = 1
     category = 'Recursion'
+    fields_read = None
     __doc__ = doc = _('eval(template) -- evaluates the template, passing the local '
             'variables (those \'assign\'ed to) instead of the book metadata. '
             ' This permits using the template processor to construct complex '
@@ -458,6 +470,7 @@ class BuiltinField(BuiltinFormatterFunction):
     name = 'field'
     arg_count = 1
     category = 'Get values from metadata'
+    field_args = (0,)
     __doc__ = doc = _('field(lookup_name) -- returns the metadata field named by lookup_name')
 
     def evaluate(self, formatter, kwargs, mi, locals, name):
@@ -468,6 +481,7 @@ class BuiltinRawField(BuiltinFormatterFunction):
     name = 'raw_field'
     arg_count = -1
     category = 'Get values from metadata'
+    field_args = (0,)
     __doc__ = doc = _('raw_field(lookup_name [, optional_default]) -- returns the '
             'metadata field named by lookup_name without applying any formatting. '
             'It evaluates and returns the optional second argument '
@@ -489,6 +503,7 @@ class BuiltinRawList(BuiltinFormatterFunction):
     name = 'raw_list'
     arg_count = 2
     category = 'Get values from metadata'
+    field_args = (0,)
     __doc__ = doc = _('raw_list(lookup_name, separator) -- returns the metadata list '
             'named by lookup_name without applying any formatting or sorting and '
             'with items separated by separator.')
@@ -519,6 +534,7 @@ class BuiltinLookup(BuiltinFormatterFunction):
     name = 'lookup'
     arg_count = -1
     category = 'Iterating over values'
+    fields_read = None
     __doc__ = doc = _('lookup(val, [pattern, field,]+ else_field) -- '
             'like switch, except the arguments are field (metadata) names, not '
             'text. The value of the appropriate field will be fetched and used. '
@@ -906,6 +922,7 @@ class BuiltinApproximateFormats(BuiltinFormatterFunction):
     name = 'approximate_formats'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = ('formats',)
     __doc__ = doc = _('approximate_formats() -- return a comma-separated '
                   'list of formats that at one point were associated with the '
                   'book. There is no guarantee that this list is correct, '
@@ -934,6 +951,7 @@ class BuiltinFormatsModtimes(BuiltinFormatterFunction):
     name = 'formats_modtimes'
     arg_count = 1
     category = 'Get values from metadata'
+    fields_read = ('formats',)
     __doc__ = doc = _('formats_modtimes(date_format) -- return a comma-separated '
                   'list of colon-separated items representing modification times '
                   'for the formats of a book. The date_format parameter '
@@ -958,6 +976,7 @@ class BuiltinFormatsSizes(BuiltinFormatterFunction):
     name = 'formats_sizes'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = ('formats',)
     __doc__ = doc = _('formats_sizes() -- return a comma-separated list of '
                       'colon-separated items representing sizes in bytes '
                       'of the formats of a book. You can use the select '
@@ -978,6 +997,7 @@ class BuiltinFormatsPaths(BuiltinFormatterFunction):
     name = 'formats_paths'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = ('formats', 'path')
     __doc__ = doc = _('formats_paths() -- return a comma-separated list of '
                       'colon-separated items representing full path to '
                       'the formats of a book. You can use the select '
@@ -1218,6 +1238,7 @@ class BuiltinBooksize(BuiltinFormatterFunction):
     name = 'booksize'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = ('size',)
     __doc__ = doc = _('booksize() -- return value of the size field. '
                 'This function works only in the GUI. If you want to use this value '
                 'in save-to-disk or send-to-device templates then you '
@@ -1242,6 +1263,7 @@ class BuiltinOndevice(BuiltinFormatterFunction):
     name = 'ondevice'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = ('ondevice',)
     __doc__ = doc = _('ondevice() -- return Yes if ondevice is set, otherwise return '
               'the empty string. This function works only in the GUI. If you want to '
               'use this value in save-to-disk or send-to-device templates then you '
@@ -1261,6 +1283,7 @@ class BuiltinAnnotationCount(BuiltinFormatterFunction):
     name = 'annotation_count'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = None
     __doc__ = doc = _('annotation_count() -- return the total number of annotations '
                       'of all types attached to the current book. '
                       'This function works only in the GUI.')
@@ -1281,6 +1304,7 @@ class BuiltinIsMarked(BuiltinFormatterFunction):
     name = 'is_marked'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = None
     __doc__ = doc = _("is_marked() -- check whether the book is 'marked' in "
                       "calibre. If it is then return the value of the mark, "
                       "either 'true' or the comma-separated list of named "
@@ -1302,6 +1326,7 @@ class BuiltinSeriesSort(BuiltinFormatterFunction):
     name = 'series_sort'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = ('series',)
     __doc__ = doc = _('series_sort() -- return the series sort value')
 
     def evaluate(self, formatter, kwargs, mi, locals):
@@ -1314,6 +1339,7 @@ class BuiltinHasCover(BuiltinFormatterFunction):
     name = 'has_cover'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = ('cover',)
     __doc__ = doc = _('has_cover() -- return Yes if the book has a cover, '
                       'otherwise return the empty string')
 
@@ -1579,6 +1605,7 @@ class BuiltinToday(BuiltinFormatterFunction):
     name = 'today'
     arg_count = 0
     category = 'Date functions'
+    fields_read = None
     __doc__ = doc = _('today() -- '
             'return a date string for today. This value is designed for use in '
             'format_date or days_between, but can be manipulated like any '
@@ -1659,6 +1686,7 @@ class BuiltinCurrentLibraryName(BuiltinFormatterFunction):
     name = 'current_library_name'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = None
     __doc__ = doc = _('current_library_name() -- '
             'return the last name on the path to the current calibre library. '
             'This function can be called in template program mode using the '
@@ -1673,6 +1701,7 @@ class BuiltinCurrentLibraryPath(BuiltinFormatterFunction):
     name = 'current_library_path'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = None
     __doc__ = doc = _('current_library_path() -- '
                 'return the path to the current calibre library. This function can '
                 'be called in template program mode using the template '
@@ -1704,6 +1733,7 @@ class BuiltinVirtualLibraries(BuiltinFormatterFunction):
     name = 'virtual_libraries'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = None
     __doc__ = doc = _('virtual_libraries() -- return a comma-separated list of '
                       'Virtual libraries that contain this book. This function '
                       'works only in the GUI. If you want to use these values '
@@ -1724,6 +1754,7 @@ class BuiltinUserCategories(BuiltinFormatterFunction):
     name = 'user_categories'
     arg_count = 0
     category = 'Get values from metadata'
+    fields_read = None
     __doc__ = doc = _('user_categories() -- return a comma-separated list of '
                       'the user categories that contain this book. This function '
                       'works only in the GUI. If you want to use these values '
@@ -1759,6 +1790,7 @@ class BuiltinAuthorLinks(BuiltinFormatterFunction):
     name = 'author_links'
     arg_count = 2
     category = 'Get values from metadata'
+    fields_read = None
     __doc__ = doc = _('author_links(val_separator, pair_separator) -- returns '
                       'a string containing a list of authors and that author\'s '
                       'link values in the '
@@ -1785,6 +1817,7 @@ class BuiltinAuthorSorts(BuiltinFormatterFunction):
     name = 'author_sorts'
     arg_count = 1
     category = 'Get values from metadata'
+    fields_read = ('authors',)
     __doc__ = doc = _('author_sorts(val_separator) -- returns a string '
                       'containing a list of author\'s sort values for the '
                       'authors of the book. The sort is the one in the author '
@@ -1807,6 +1840,7 @@ class BuiltinConnectedDeviceName(BuiltinFormatterFunction):
     name = 'connected_device_name'
     arg_count = 1
     category = 'Get values from metadata'
+    fields_read = None
     __doc__ = doc = _("connected_device_name(storage_location) -- if a device is "
                       "connected then return the device name, otherwise return "
                       "the empty string. Each storage location on a device can "
@@ -1840,6 +1874,7 @@ class BuiltinConnectedDeviceUUID(BuiltinFormatterFunction):
     name = 'connected_device_uuid'
     arg_count = 1
     category = 'Get values from metadata'
+    fields_read = None
     __doc__ = doc = _("connected_device_uuid(storage_location) -- if a device is "
                       "connected then return the device uuid (unique id), "
                       "otherwise return the empty string. Each storage location "
@@ -1874,6 +1909,7 @@ class BuiltinCheckYesNo(BuiltinFormatterFunction):
     name = 'check_yes_no'
     arg_count = 4
     category = 'If-then-else'
+    field_args = (0,)
     __doc__ = doc = _('check_yes_no(field_name, is_undefined, is_false, is_true) '
                       '-- checks the value of the yes/no field named by the '
                       'lookup key field_name for a value specified by the '
@@ -2079,6 +2115,8 @@ def __init__(self, name, doc, arg_count, program_text, is_python):
         self.arg_count = arg_count
         self.program_text = program_text
         self.cached_parse_tree = None
+        # A tuple of (parse tree, compiled program)
+        self.cached_compiled_program = None
 
     def to_pref(self):
         return [self.name, self.doc, self.arg_count, self.program_text]
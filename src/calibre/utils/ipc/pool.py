@@ -24,6 +24,7 @@
 WorkerResult = namedtuple('WorkerResult', 'id result is_terminal_failure worker')
 TerminalFailure = namedtuple('TerminalFailure', 'message tb job_id')
 File = namedtuple('File', 'name')
+WarmUp = namedtuple('WarmUp', 'module func')
 
 MAX_SIZE = 30 * 1024 * 1024  # max size of data to send over the connection (old versions of windows cannot handle arbitrary data lengths)
 
@@ -95,6 +96,7 @@ def __init__(self, p, conn, events, name):
         self.process, self.conn = p, conn
         self.events = events
         self.name = name or ''
+        self.jobs_done = 0
 
     def __call__(self, job):
         eintr_retry_call(self.conn.send_bytes, pickle_dumps(job))
@@ -122,9 +124,16 @@ class Pool(Thread):
 
     daemon = True
 
-    def __init__(self, max_workers=None, name=None):
+    def __init__(self, max_workers=None, name=None, max_jobs_per_worker=0, warm_up=None):
+        ''' If max_jobs_per_worker is non-zero, workers are replaced by new
+        ones after running that many jobs, releasing any memory they have
+        accumulated. warm_up can be a (module, func) pair, func will be called
+        in every worker when it starts, before it runs any jobs, and all
+        max_workers workers are started immediately. '''
         Thread.__init__(self, name=name)
         self.max_workers = max_workers or detect_ncpus()
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.warm_up = warm_up
         self.available_workers = []
         self.busy_workers = {}
         self.pending_jobs = []
@@ -197,6 +206,8 @@ def create_worker(self):
         w = Worker(p, b, self.events, self.name)
         if self.common_data != pickle_dumps(None):
             w.set_common_data(self.common_data)
+        if self.warm_up is not None:
+            eintr_retry_call(w.conn.send_bytes, pickle_dumps(WarmUp(*self.warm_up)))
         return w
 
     def start_worker(self):
@@ -210,9 +221,29 @@ def start_worker(self):
             self.terminal_error()
             return False
 
+    def retire_worker(self, worker):
+        try:
+            worker(None)
+        except Exception:
+            pass
+
+        def reap():
+            try:
+                worker.process.wait()
+            except Exception:
+                pass
+            try:
+                worker.conn.close()
+            except Exception:
+                pass
+        reaper = Thread(target=reap, name='ReapPoolWorker')
+        reaper.daemon = True
+        reaper.start()
+
     def run(self):
-        if self.start_worker() is False:
-            return
+        for i in range(self.max_workers if self.warm_up is not None else 1):
+            if self.start_worker() is False:
+                return
 
         while True:
             event = self.events.get()
@@ -233,14 +264,22 @@ def handle_event(self, event):
             return self.run_job(job)
         elif isinstance(event, WorkerResult):
             worker_result = event
-            self.busy_workers.pop(worker_result.worker, None)
-            self.available_workers.append(worker_result.worker)
+            worker = worker_result.worker
+            self.busy_workers.pop(worker, None)
+            worker.jobs_done += 1
+            recycle = not worker_result.is_terminal_failure and 0 < self.max_jobs_per_worker <= worker.jobs_done
+            if not recycle:
+                self.available_workers.append(worker)
             self.tracker.task_done()
             if worker_result.is_terminal_failure:
                 self.terminal_failure = TerminalFailure('Worker process crashed while executing job', worker_result.result.traceback, worker_result.id)
                 self.terminal_error()
                 return False
             self.results.put(worker_result)
+            if recycle:
+                self.retire_worker(worker)
+                if self.start_worker() is False:
+                    return False
         else:
             self.common_data = pickle_dumps(event)
             if len(self.common_data) > MAX_SIZE:
@@ -351,6 +390,13 @@ def worker_main(conn):
             return 1
         if job is None:
             break
+        if isinstance(job, WarmUp):
+            try:
+                getattr(import_module(job.module), job.func)()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+            continue
         if not isinstance(job, Job):
             if isinstance(job, File):
                 with lopen(job.name, 'rb') as f:
@@ -448,6 +494,16 @@ def get_results(pool, ignore_fail=False):
         raise SystemExit('Common data was not returned correctly')
     p.shutdown(), p.join()
 
+    # Test recycling of workers
+    p = Pool(max_workers=2, name='Test', max_jobs_per_worker=3, warm_up=('os', 'getpid'))
+    for i in range(30):
+        p(i, 'import os\ndef x(i):\n return os.getpid()', 'x', i)
+    p.wait_for_tasks(30)
+    pids = {r.value for r in itervalues(get_results(p))}
+    if len(pids) < 10:
+        raise SystemExit('Workers were not recycled, only %d distinct workers were used' % len(pids))
+    p.shutdown(), p.join()
+
     # Test exceptions in jobs
     p = Pool(name='Test')
     for i in range(1000):
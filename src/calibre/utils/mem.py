@@ -24,6 +24,12 @@ def get_memory():
     return psutil.Process(os.getpid()).memory_info().rss
 
 
+def available_memory():
+    'Return the amount of memory available for starting new processes, in bytes'
+    import psutil
+    return psutil.virtual_memory().available
+
+
 def memory(since=0.0):
     'Return memory used in MB. The value of since is subtracted from the used memory'
     ans = get_memory()
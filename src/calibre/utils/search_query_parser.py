@@ -19,6 +19,7 @@
 '''
 
 import weakref, re
+from time import monotonic
 
 from calibre.constants import preferred_encoding
 from calibre.utils.icu import sort_key
@@ -286,6 +287,19 @@ def msg(self):
         return ""
 
 
+def format_explain_log(log):
+    ''' Format the plan recorded in SearchQueryParser.explain_log as text,
+    one line per evaluated node, indented to show the query structure, in the
+    order the nodes were evaluated. '''
+    lines = []
+    for e in log:
+        lines.append('{indent}{node}  [cost: {cost:.2f} selectivity: {selectivity:.2f}] {candidates} -> {matches} in {time:.2f} ms{cached}'.format(
+            indent='    ' * e['depth'], node=e['node'], cost=e['cost'], selectivity=e['selectivity'],
+            candidates=e['candidates'], matches=e.get('matches', 0), time=e.get('time', 0) * 1000,
+            cached=' (cached)' if e['cached'] else ''))
+    return '\n'.join(lines)
+
+
 class SearchQueryParser(object):
     '''
     Parses a search query.
@@ -326,6 +340,11 @@ def __init__(self, locations, test=False, optimize=False, lookup_saved_search=No
         self.parser = Parser()
         self.lookup_saved_search = global_lookup_saved_search if lookup_saved_search is None else lookup_saved_search
         self.sqp_parse_cache = parse_cache
+        # Set to a list to record the plan used to evaluate queries, see
+        # format_explain_log()
+        self.explain_log = None
+        self.current_explain_entry = None
+        self.explain_depth = 0
 
     def sqp_change_locations(self, locations):
         self.sqp_initialize(locations, optimize=self.optimize)
@@ -360,6 +379,7 @@ def _walk_expr(self, tree):
     def parse(self, query, candidates=None):
         # empty the list of searches used for recursion testing
         self.recurse_level = 0
+        self.explain_depth = 0
         self.searches_seen = set()
         candidates = self.universal_set()
         return self._parse(query, candidates=candidates)
@@ -397,21 +417,105 @@ def method(self, group_name):
         return getattr(self, 'evaluate_'+group_name)
 
     def evaluate(self, parse_result, candidates):
-        return self.method(parse_result[0])(parse_result[1:], candidates)
+        if self.explain_log is None:
+            return self.method(parse_result[0])(parse_result[1:], candidates)
+        cost, selectivity = self.plan_cost(parse_result)
+        entry = self.current_explain_entry = {
+            'depth': self.explain_depth, 'node': self.describe_node(parse_result),
+            'cost': cost, 'selectivity': selectivity, 'candidates': len(candidates),
+            'cached': False,
+        }
+        self.explain_log.append(entry)
+        self.explain_depth += 1
+        st = monotonic()
+        try:
+            ans = self.method(parse_result[0])(parse_result[1:], candidates)
+        finally:
+            self.explain_depth -= 1
+        entry['time'] = monotonic() - st
+        entry['matches'] = len(ans)
+        return ans
+
+    # Query planning {{{
+
+    def flatten(self, op, argument):
+        ''' Return the list of operands of a chain of and or or operators,
+        so that they can be evaluated in any order. '''
+        ans = []
+        for node in argument:
+            if node[0] == op:
+                ans.extend(self.flatten(op, node[1:]))
+            else:
+                ans.append(node)
+        return ans
+
+    def estimate_token_cost(self, location, query):
+        '''
+        Return a tuple of (cost, selectivity) for the specified search. cost is
+        the relative cost of checking a single candidate and selectivity the
+        estimated fraction of candidates that will match. Re-implement in sub
+        classes to enable re-ordering of and/or operands, by default all
+        operands are evaluated in the order they are written.
+        '''
+        return 1.0, 0.5
+
+    def plan_cost(self, tree):
+        op = tree[0]
+        if op == 'token':
+            return self.estimate_token_cost(tree[1], tree[2])
+        if op == 'not':
+            cost, selectivity = self.plan_cost(tree[1])
+            return cost, 1 - selectivity
+        costs = [self.plan_cost(x) for x in self.flatten(op, tree[1:])]
+        cost = sum(c for c, s in costs)
+        rest = 1.0
+        for c, s in costs:
+            rest *= s if op == 'and' else (1 - s)
+        return cost, (rest if op == 'and' else 1 - rest)
+
+    def plan(self, op, nodes):
+        '''
+        Return nodes in the order they should be evaluated. Operands of and are
+        evaluated only on the candidates matched by the previous operands, so
+        cheap operands that match few candidates should come first. Operands
+        of or are evaluated only on the candidates not matched by the previous
+        operands, so cheap operands that match many candidates should come
+        first. Ties are broken by the written order.
+        '''
+        if len(nodes) < 2:
+            return nodes
+        costs = tuple(self.plan_cost(n) for n in nodes)
+        if op == 'and':
+            rank = lambda i: (costs[i][1] - 1) / max(costs[i][0], 1e-6)
+        else:
+            rank = lambda i: -costs[i][1] / max(costs[i][0], 1e-6)
+        return [nodes[i] for i in sorted(range(len(nodes)), key=rank)]
+
+    def describe_node(self, tree):
+        if tree[0] == 'token':
+            return '%s:%s' % (tree[1], tree[2])
+        return tree[0].upper()
+    # }}}
 
     def evaluate_and(self, argument, candidates):
-        # RHS checks only those items matched by LHS
-        # returns result of RHS check: RHmatches(LHmatches(c))
-        #  return self.evaluate(argument[0]).intersection(self.evaluate(argument[1]))
-        l = self.evaluate(argument[0], candidates)
-        return l.intersection(self.evaluate(argument[1], l))
+        # Each operand checks only those items matched by the previous
+        # operands, returns the items matched by all operands. Once no items
+        # are left, the remaining operands are still evaluated, on no items,
+        # so that invalid queries always raise ParseException.
+        ans = candidates
+        for node in self.plan('and', self.flatten('and', argument)):
+            ans = ans.intersection(self.evaluate(node, ans))
+        return ans
 
     def evaluate_or(self, argument, candidates):
-        # RHS checks only those elements not matched by LHS
-        # returns LHS union RHS: LHmatches(c) + RHmatches(c-LHmatches(c))
-        #  return self.evaluate(argument[0]).union(self.evaluate(argument[1]))
-        l = self.evaluate(argument[0], candidates)
-        return l.union(self.evaluate(argument[1], candidates.difference(l)))
+        # Each operand checks only those items not matched by the previous
+        # operands, returns the items matched by any operand
+        ans = set()
+        for node in self.plan('or', self.flatten('or', argument)):
+            matches = self.evaluate(node, candidates)
+            ans |= matches
+            candidates = candidates.difference(matches)
+        return ans
 
     def evaluate_not(self, argument, candidates):
         # unary op checks only candidates. Result: list of items matching
@@ -179,10 +179,17 @@ def __call__(self, selector, root=None):
         specify root, then only tags that are root or descendants of root are
         returned. Note that this can be very expensive if root has a lot of
         descendants. '''
+        for item in self.select_parsed(get_parsed_selector(selector), root=root):
+            yield item
+
+    def select_parsed(self, parsed_selectors, root=None):
+        ''' Same as calling this object, except that it takes a list of
+        selectors as returned by :func:`parse`, so that the same selectors can
+        be used on many trees without parsing them again. '''
         seen = set()
         if root is not None:
             root = frozenset(self.itertag(root))
-        for parsed_selector in get_parsed_selector(selector):
+        for parsed_selector in parsed_selectors:
             for item in self.iterparsedselector(parsed_selector):
                 if item not in seen and (root is None or item in root):
                     yield item
@@ -667,6 +667,7 @@ def pcss(main, *selectors, **kwargs):
             'outer-div', 'li-div', 'foobar-div'])  # case-insensitive in HTML
         self.ae(pcss('div div'), ['li-div'])
         self.ae(pcss('div, div div'), ['outer-div', 'li-div', 'foobar-div'])
+        self.ae([e.get('id') for e in select.select_parsed(parse('div, div div'))], ['outer-div', 'li-div', 'foobar-div'])
         self.ae(pcss('a[name]'), ['name-anchor'])
         self.ae(pcss('a[NAme]'), ['name-anchor'])  # case-insensitive in HTML:
         self.ae(pcss('a[rel]'), ['tag-anchor', 'nofollow-anchor'])